@@ -0,0 +1,38 @@
+"""
+The shopping bag's session format.
+
+A bag is stored in the session as {"v": BAG_VERSION, "items": items}, where
+items has the structure {item_id: {size: quantity}}. Items without a size use
+"" as their size.
+
+Bags saved in the old format, where each item was either a quantity or
+{"items_by_size": {size: quantity}}, are migrated when they're read, and saved
+in the new format the next time the bag changes.
+"""
+
+BAG_VERSION = 2
+
+
+def parse_bag(data):
+    """Return the items of a bag read from the session or order metadata."""
+    if not data:
+        return {}
+    if data.get("v") == BAG_VERSION:
+        return data["items"]
+    return _migrate_v1_bag(data)
+
+
+def serialize_bag(items):
+    """Return a bag's items in the format stored in the session."""
+    return {"v": BAG_VERSION, "items": items}
+
+
+def _migrate_v1_bag(data):
+    """Return the items of a bag saved in the original, unversioned format."""
+    items = {}
+    for item_id, item_data in data.items():
+        if isinstance(item_data, int):
+            items[item_id] = {"": item_data}
+        else:
+            items[item_id] = dict(item_data["items_by_size"])
+    return items
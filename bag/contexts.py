@@ -1,11 +1,107 @@
 from decimal import Decimal
+from functools import cached_property, partial
+
 from django.conf import settings
-from django.shortcuts import get_object_or_404
+from django.db import DEFAULT_DB_ALIAS
 from products.models import Product
+from products.snapshots import product_snapshots
+
+from .bags import parse_bag, serialize_bag
+
+LAZY_BAG_KEYS = (
+    "bag_items",
+    "delivery",
+    "free_delivery_delta",
+    "grand_total",
+    "product_count",
+    "total",
+)
 
 
 def bag_contents(request):
-    """Return shopping bag context items."""
+    """
+    Return shopping bag context items.
+
+    Each bag item is a callable, which templates call when they first read it.
+    The bag is only computed once, and only if a template reads from it.
+    """
+    lazy_bag = request_bag_context(request)
+    context = {key: partial(lazy_bag.get, key) for key in LAZY_BAG_KEYS}
+    context["free_delivery_threshold"] = settings.FREE_DELIVERY_THRESHOLD
+    return context
+
+
+def request_bag_context(request, current_prices=False):
+    """
+    Return the bag context for the request.
+
+    The same LazyBagContext is shared by every consumer during the request, so
+    the bag is only resolved and priced once. Pass current_prices=True
+    wherever the customer is charged: the bag is then priced from the
+    products in the database rather than product snapshots, for the rest of
+    the request.
+    """
+    lazy_bag = getattr(request, "_bag_context", None)
+    if lazy_bag is None or (current_prices and lazy_bag.snapshots):
+        lazy_bag = LazyBagContext(request, snapshots=not current_prices)
+        request._bag_context = lazy_bag
+    return lazy_bag
+
+
+def save_bag(request, bag):
+    """Save the bag's items to the session."""
+    request.session["bag"] = serialize_bag(bag)
+    invalidate_bag_context(request)
+
+
+def invalidate_bag_context(request):
+    """Discard the request's bag context after the bag has been changed."""
+    request.__dict__.pop("_bag_context", None)
+
+
+class LazyBagContext:
+    """Shopping bag context, computed on first access and then memoized."""
+
+    def __init__(self, request, snapshots=True):
+        self.request = request
+        self.snapshots = snapshots
+
+    @cached_property
+    def bag(self):
+        """Return the items of the bag stored in the session."""
+        return parse_bag(self.request.session.get("bag"))
+
+    @cached_property
+    def products(self):
+        """Return a dict of {item_id: product} for the bag's products."""
+        if self.snapshots:
+            return bag_products(self.bag)
+        return current_bag_products(self.bag)
+
+    @cached_property
+    def context(self):
+        """Return the computed bag context."""
+        return compute_bag_context(self.bag, self.products)
+
+    def has_missing_products(self):
+        """Return True if any product in the bag is not in the database."""
+        return any(str(item_id) not in self.products for item_id in self.bag)
+
+    def get(self, key):
+        """Return a single bag context item."""
+        return self.context[key]
+
+    def __getitem__(self, key):
+        return self.context[key]
+
+
+def compute_bag_context(bag, products=None):
+    """
+    Return the shopping bag context for a bag's items.
+
+    Pass products (a dict of {item_id: product}) if they've already been
+    fetched, otherwise they're fetched here.
+    """
     context = {
         "bag_items": [],
         "delivery": 0,
@@ -15,13 +111,44 @@ def bag_contents(request):
         "product_count": 0,
         "total": 0,
     }
-    bag = request.session.get("bag", {})
-    for item_id, item_data in bag.items():
-        _update_context_for_bag_item(context, item_id, item_data)
+    if products is None:
+        products = bag_products(bag)
+    for item_id, items_by_size in bag.items():
+        product = products.get(str(item_id))
+        if product:
+            _update_context_for_bag_item(
+                context, item_id, items_by_size, product
+            )
     _update_context_for_delivery(context)
     return context
 
 
+def bag_products(bag):
+    """
+    Return a dict of {item_id: product} for every product in the bag.
+
+    Products are snapshots from the worker's product snapshot cache, and any
+    that aren't cached are fetched in a single query. Products that are no
+    longer in the database are left out, so a stale bag can't 404 an
+    unrelated page.
+    """
+    products = product_snapshots(bag)
+    return {str(pk): product for pk, product in products.items()}
+
+
+def current_bag_products(bag):
+    """
+    Return a dict of {item_id: product} for every product in the bag.
+
+    Unlike bag_products, the products are read from the primary database, so
+    their prices are current. Products that are no longer in the database are
+    left out.
+    """
+    pks = [int(pk) for pk in bag if str(pk).isdigit()]
+    products = Product.objects.using(DEFAULT_DB_ALIAS).in_bulk(pks)
+    return {str(pk): product for pk, product in products.items()}
+
+
 def _update_context_for_delivery(context):
     """
     Update bag context based on delivery fee.
@@ -39,10 +166,8 @@ def _update_context_for_delivery(context):
     context["grand_total"] = total + delivery
 
 
-def _update_context_for_bag_item(context, item_id, item_data):
+def _update_context_for_bag_item(context, item_id, items_by_size, product):
     """Update context for a shopping bag item."""
-    product = get_object_or_404(Product, pk=item_id)
-    items_by_size = _get_items_by_size(item_data)
     for size, quantity in items_by_size.items():
         context["total"] += product.price * quantity
         context["product_count"] += quantity
@@ -56,21 +181,6 @@ def _update_context_for_bag_item(context, item_id, item_data):
         context["bag_items"].append(item)
 
 
-def _get_items_by_size(item_data):
-    """
-    Return a dict with the structure {size: quantity}.
-
-    If the item has no size, return {"": quantity}.
-    """
-    item_data_is_quantity = isinstance(item_data, int)
-    if item_data_is_quantity:
-        size = ""
-        quantity = item_data
-        return {size: quantity}
-    else:
-        return item_data["items_by_size"]
-
-
 def _free_delivery_delta(total):
     """Return delta between order total and free delivery threshold."""
     return settings.FREE_DELIVERY_THRESHOLD - total
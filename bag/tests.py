@@ -1,3 +1,53 @@
+from decimal import Decimal
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from products.catalogue import forget_catalogue_version
+from products.models import Product
+from products.snapshots import clear_snapshots
+
+from .bags import serialize_bag
+
+
+class BagQueryTests(TestCase):
+    def setUp(self):
+        clear_snapshots()
+        forget_catalogue_version()
+        self.product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+
+    def catalogue_queries(self, queries):
+        """Return the queries that read the products or their version."""
+        return [
+            query["sql"] for query in queries if "products_" in query["sql"]
+        ]
+
+    def test_a_warm_worker_changes_the_bag_without_catalogue_queries(self):
+        add_url = reverse("add_to_bag", args=[self.product.pk])
+        self.client.post(add_url, {"quantity": 1, "redirect_url": "/"})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(add_url, {"quantity": 1, "redirect_url": "/"})
+            self.client.post(
+                reverse("adjust_bag", args=[self.product.pk]),
+                {"quantity": 3},
+            )
+            self.client.post(
+                reverse("remove_from_bag", args=[self.product.pk])
+            )
+
+        self.assertEqual(self.catalogue_queries(queries), [])
+        self.assertEqual(self.client.session["bag"], serialize_bag({}))
+
+    def test_a_cold_worker_reads_the_version_and_the_product(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                reverse("add_to_bag", args=[self.product.pk]),
+                {"quantity": 1, "redirect_url": "/"},
+            )
 
-# Create your tests here.
+        self.assertEqual(len(self.catalogue_queries(queries)), 2)
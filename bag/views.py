@@ -1,12 +1,15 @@
 from django.contrib import messages
+from django.http import Http404
 from django.shortcuts import (
-    get_object_or_404,
     HttpResponse,
     redirect,
     render,
     reverse,
 )
 from products.models import Product
+from products.snapshots import product_snapshot
+
+from .contexts import request_bag_context, save_bag
 
 
 def view_bag(request):
@@ -16,99 +19,115 @@ def view_bag(request):
 
 def add_to_bag(request, item_id):
     """Add item to the bag and refresh the product detail page."""
-    bag = request.session.get("bag", {})
+    bag = request_bag_context(request).bag
     quantity = int(request.POST.get("quantity"))
     size = request.POST.get("product_size")
     if size:
         _update_bag_with_sized_items(request, item_id, bag, quantity, size)
     else:
         _update_bag_with_unsized_items(request, item_id, bag, quantity)
-    request.session["bag"] = bag
+    save_bag(request, bag)
     return redirect(request.POST.get("redirect_url"))
 
 
 def adjust_bag(request, item_id):
     """Adjust the quantity of an item in the bag."""
-    bag = request.session.get("bag")
+    bag = request_bag_context(request).bag
     quantity = int(request.POST.get("quantity"))
     size = request.POST.get("product_size")
-    product = get_object_or_404(Product, pk=item_id)
+    product = _get_product(item_id)
     message = None
-    if size:
-        if quantity > 0:
-            bag[item_id]["items_by_size"][size] = quantity
+    if quantity > 0:
+        bag.setdefault(item_id, {})[size or ""] = quantity
+        if size:
             message = (
                 f"Updated {product.name} size {size.upper()} "
                 f"quantity to {quantity}!"
             )
         else:
-            del bag[item_id]["items_by_size"][size]
-            if not bag[item_id]["items_by_size"]:
-                del bag[item_id]
-            message = f"Removed {product.name} size {size.upper()} from bag!"
-    else:
-        if quantity > 0:
-            bag[item_id] = quantity
             message = f"Updated {product.name} quantity to {quantity}!"
-        else:
-            del bag[item_id]
-            message = f"Removed {product.name} from bag!"
+    else:
+        _remove_from_bag(bag, item_id, size)
+        message = _removed_message(product, size)
     messages.success(request, message)
-    request.session["bag"] = bag
+    save_bag(request, bag)
     return redirect(reverse("view_bag"))
 
 
 def remove_from_bag(request, item_id):
     """Remove an item from the bag."""
     try:
-        product = get_object_or_404(Product, pk=item_id)
-        bag = request.session.get("bag")
+        product = _get_product(item_id)
+        bag = request_bag_context(request).bag
         size = request.POST.get("product_size")
-        message = None
-        if size:
-            del bag[item_id]["items_by_size"][size]
-            if not bag[item_id]["items_by_size"]:
-                del bag[item_id]
-            message = f"Removed {product.name} size {size.upper()} from bag!"
-        else:
-            del bag[item_id]
-            message = f"Removed {product.name} from bag!"
-        messages.success(request, message)
-        request.session.modified = True
+        _remove_from_bag(bag, item_id, size)
+        messages.success(request, _removed_message(product, size))
+        save_bag(request, bag)
         return HttpResponse(status=200)
     except Exception as e:
         messages.error(request, f"Error removing item: {e}")
         return HttpResponse(status=500)
 
 
+def _get_product(item_id):
+    """
+    Return a bag item's product from the product snapshot cache.
+
+    Raise Http404 if there's no such product.
+    """
+    try:
+        return product_snapshot(item_id)
+    except Product.DoesNotExist:
+        raise Http404("No Product matches the given query.")
+
+
+def _remove_from_bag(bag, item_id, size):
+    """
+    Remove an item from the bag.
+
+    If the item has a size, only remove that size.
+    """
+    if size:
+        del bag[item_id][size]
+        if not bag[item_id]:
+            del bag[item_id]
+    else:
+        del bag[item_id]
+
+
+def _removed_message(product, size):
+    """Return the message for an item removed from the bag."""
+    if size:
+        return f"Removed {product.name} size {size.upper()} from bag!"
+    return f"Removed {product.name} from bag!"
+
+
 def _update_bag_with_unsized_items(request, item_id, bag, quantity):
     """Update the bag with items that don't have a size."""
-    product = get_object_or_404(Product, pk=item_id)
+    product = _get_product(item_id)
     message = None
-    if item_id in bag:
-        bag[item_id] += quantity
-        message = f"Updated {product.name} quantity to {bag[item_id]}"
+    items_by_size = bag.setdefault(item_id, {})
+    if "" in items_by_size:
+        items_by_size[""] += quantity
+        message = f"Updated {product.name} quantity to {items_by_size[""]}"
     else:
-        bag[item_id] = quantity
+        items_by_size[""] = quantity
         message = f"Added {product.name} to your bag!"
     messages.success(request, message)
 
 
 def _update_bag_with_sized_items(request, item_id, bag, quantity, size):
     """Update the bag with items that have a size."""
-    product = get_object_or_404(Product, pk=item_id)
+    product = _get_product(item_id)
     message = None
-    if item_id in bag:
-        if size in bag[item_id]["items_by_size"]:
-            bag[item_id]["items_by_size"][size] += quantity
-            message = (
-                f"Updated {product.name} size {size.upper()} "
-                f"quantity to {bag[item_id]["items_by_size"][size]}"
-            )
-        else:
-            bag[item_id]["items_by_size"][size] = quantity
-            message = f"Added {product.name} size {size.upper()} to your bag!"
+    items_by_size = bag.setdefault(item_id, {})
+    if size in items_by_size:
+        items_by_size[size] += quantity
+        message = (
+            f"Updated {product.name} size {size.upper()} "
+            f"quantity to {items_by_size[size]}"
+        )
     else:
-        bag[item_id] = {"items_by_size": {size: quantity}}
+        items_by_size[size] = quantity
         message = f"Added {product.name} size {size.upper()} to your bag!"
     messages.success(request, message)
@@ -0,0 +1,448 @@
+"""
+Request metrics, shared between workers and exported for Prometheus.
+
+MetricsMiddleware times every request, labelled by URL name. It records the
+wall time, the time and number of database queries, template rendering time,
+and time spent calling Stripe and sending email. Templates are timed by
+TemplateBackend and email by EmailBackend. Stripe and SMTP calls made outside
+requests, for example by the email worker, are recorded too.
+
+Each process keeps its histograms in memory and writes them to its own file
+in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds. The metrics view adds up
+every process's file, so it reports the totals for all workers. A process
+deletes its file when it exits, and the file of a process that was killed is
+deleted once it hasn't been written for METRICS_FILE_TTL seconds.
+
+Requests slower than SLOW_REQUEST_SECONDS are logged with their SQL.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import (
+    DjangoTemplates,
+    Template,
+    reraise,
+)
+
+logger = logging.getLogger("boutique_ado.slow_requests")
+
+SECONDS_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# Histogram name: (help text, buckets)
+HISTOGRAMS = {
+    "boutique_ado_request_seconds": (
+        "Request wall time, by URL name.",
+        SECONDS_BUCKETS,
+    ),
+    "boutique_ado_request_db_seconds": (
+        "Time spent running database queries per request, by URL name.",
+        SECONDS_BUCKETS,
+    ),
+    "boutique_ado_request_queries": (
+        "Database queries per request, by URL name.",
+        QUERY_BUCKETS,
+    ),
+    "boutique_ado_request_template_seconds": (
+        "Time spent rendering templates per request, by URL name.",
+        SECONDS_BUCKETS,
+    ),
+    "boutique_ado_request_stripe_seconds": (
+        "Time spent calling Stripe per request, by URL name.",
+        SECONDS_BUCKETS,
+    ),
+    "boutique_ado_request_smtp_seconds": (
+        "Time spent sending email per request, by URL name.",
+        SECONDS_BUCKETS,
+    ),
+    "boutique_ado_external_call_seconds": (
+        "Stripe and SMTP call time in any process, by service and "
+        "operation.",
+        SECONDS_BUCKETS,
+    ),
+}
+COUNTERS = {
+    "boutique_ado_responses_total": (
+        "Responses, by URL name and status code."
+    ),
+}
+EXTERNAL_SERVICES = ("stripe", "smtp")
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """The time a single request has spent on each kind of work."""
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.queries = []
+        self.query_count = 0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.external_seconds = {
+            service: 0.0 for service in EXTERNAL_SERVICES
+        }
+
+    def record_query(self, execute, sql, params, many, context):
+        """Time a database query. Used as a connection execute wrapper."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.db_seconds += duration
+            self.query_count += 1
+            if len(self.queries) < settings.SLOW_REQUEST_MAX_QUERIES:
+                self.queries.append((duration, sql))
+
+
+class MetricsMiddleware:
+    """Record metrics for each request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = RequestMetrics()
+        token = _current.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(
+                            request_metrics.record_query
+                        )
+                    )
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        wall_seconds = time.perf_counter() - start
+        view = view_name(request)
+        _record_request(
+            view, response.status_code, wall_seconds, request_metrics
+        )
+        if wall_seconds >= settings.SLOW_REQUEST_SECONDS:
+            _log_slow_request(request, view, wall_seconds, request_metrics)
+        return response
+
+
+class TemplateBackend(DjangoTemplates):
+    """The Django template backend, timing each render."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(
+                self.engine.get_template(template_name), self
+            )
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        request_metrics = _current.get()
+        if request_metrics is None:
+            return super().render(context, request)
+        # Templates rendered inside another template are only counted once
+        request_metrics.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            request_metrics.template_depth -= 1
+            if request_metrics.template_depth == 0:
+                request_metrics.template_seconds += (
+                    time.perf_counter() - start
+                )
+
+
+class EmailBackend(BaseEmailBackend):
+    """Send email with METRICS_EMAIL_BACKEND, timing each call."""
+
+    def __init__(self, fail_silently=False, **kwargs):
+        super().__init__(fail_silently=fail_silently)
+        self.backend = get_connection(
+            settings.METRICS_EMAIL_BACKEND,
+            fail_silently=fail_silently,
+            **kwargs,
+        )
+
+    def open(self):
+        with _external_call("smtp", "open"):
+            return self.backend.open()
+
+    def close(self):
+        with _external_call("smtp", "close"):
+            return self.backend.close()
+
+    def send_messages(self, email_messages):
+        with _external_call("smtp", "send"):
+            return self.backend.send_messages(email_messages)
+
+
+def record_external_call(service, operation, seconds):
+    """Record a call to Stripe or the mail server."""
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.external_seconds[service] += seconds
+    with _lock:
+        _observe(
+            "boutique_ado_external_call_seconds",
+            (("service", service), ("operation", operation)),
+            seconds,
+        )
+    _flush_if_due()
+
+
+def export_metrics():
+    """Return every process's metrics, in the Prometheus text format."""
+    flush()
+    histograms = {}
+    counters = {}
+    for data in _read_process_files():
+        for name, labels, buckets, total, count in data["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(
+                key, [[0] * len(buckets), 0.0, 0]
+            )
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+        for name, labels, value in data["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+    return _prometheus_text(histograms, counters)
+
+
+def flush():
+    """Write this process's metrics to its file in METRICS_DIR."""
+    global _last_flush
+    with _lock:
+        data = {
+            "histograms": [
+                [name, labels, buckets, total, count]
+                for (name, labels), (buckets, total, count) in (
+                    _histograms.items()
+                )
+            ],
+            "counters": [
+                [name, labels, value]
+                for (name, labels), value in _counters.items()
+            ],
+        }
+        _last_flush = time.monotonic()
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    path = _process_file()
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as metrics_file:
+        json.dump(data, metrics_file)
+    os.replace(temporary_path, path)
+
+
+def _record_request(view, status_code, wall_seconds, request_metrics):
+    labels = (("view", view),)
+    with _lock:
+        _observe("boutique_ado_request_seconds", labels, wall_seconds)
+        _observe(
+            "boutique_ado_request_db_seconds",
+            labels,
+            request_metrics.db_seconds,
+        )
+        _observe(
+            "boutique_ado_request_queries",
+            labels,
+            request_metrics.query_count,
+        )
+        _observe(
+            "boutique_ado_request_template_seconds",
+            labels,
+            request_metrics.template_seconds,
+        )
+        for service, seconds in request_metrics.external_seconds.items():
+            _observe(
+                f"boutique_ado_request_{service}_seconds", labels, seconds
+            )
+        key = (
+            "boutique_ado_responses_total",
+            labels + (("status", str(status_code)),),
+        )
+        _counters[key] = _counters.get(key, 0) + 1
+    _flush_if_due()
+
+
+def _observe(name, labels, value):
+    """Add a value to a histogram. The caller must hold _lock."""
+    buckets = HISTOGRAMS[name][1]
+    histogram = _histograms.get((name, labels))
+    if histogram is None:
+        histogram = _histograms[(name, labels)] = [
+            [0] * len(buckets),
+            0.0,
+            0,
+        ]
+    index = bisect_left(buckets, value)
+    if index < len(buckets):
+        histogram[0][index] += 1
+    histogram[1] += value
+    histogram[2] += 1
+
+
+@contextmanager
+def _external_call(service, operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_external_call(
+            service, operation, time.perf_counter() - start
+        )
+
+
+def _flush_if_due():
+    if time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        try:
+            flush()
+        except OSError:
+            logger.exception("Couldn't write the metrics file.")
+
+
+def view_name(request):
+    """Return the URL name of the request's view, to label its metrics."""
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.view_name or match._func_path
+
+
+def _log_slow_request(request, view, wall_seconds, request_metrics):
+    queries = "\n".join(
+        f"  {duration * 1000:.1f}ms  {sql}"
+        for duration, sql in request_metrics.queries
+    )
+    logger.warning(
+        "Slow request: %s %s (%s) took %.0fms, with %d queries taking "
+        "%.0fms, templates %.0fms, Stripe %.0fms, SMTP %.0fms\n%s",
+        request.method,
+        request.get_full_path(),
+        view,
+        wall_seconds * 1000,
+        request_metrics.query_count,
+        request_metrics.db_seconds * 1000,
+        request_metrics.template_seconds * 1000,
+        request_metrics.external_seconds["stripe"] * 1000,
+        request_metrics.external_seconds["smtp"] * 1000,
+        queries,
+    )
+
+
+def _process_file():
+    return os.path.join(
+        settings.METRICS_DIR, f"{socket.gethostname()}-{os.getpid()}.json"
+    )
+
+
+def _read_process_files():
+    """
+    Yield the metrics written by each process.
+
+    Files that haven't been written for METRICS_FILE_TTL seconds were left
+    by processes that died without deleting them, and are deleted.
+    """
+    expired = time.time() - settings.METRICS_FILE_TTL
+    for filename in os.listdir(settings.METRICS_DIR):
+        if not filename.endswith((".json", ".json.tmp")):
+            continue
+        path = os.path.join(settings.METRICS_DIR, filename)
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+                continue
+            if filename.endswith(".tmp"):
+                continue
+            with open(path) as file:
+                yield json.load(file)
+        except (OSError, ValueError):
+            continue
+
+
+def _remove_process_file():
+    """Delete this process's metrics file, when the process exits."""
+    try:
+        os.remove(_process_file())
+    except OSError:
+        pass
+
+
+def _prometheus_text(histograms, counters):
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), (counts, total, count) in sorted(
+            histograms.items()
+        ):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (("le", _number(bound)),)
+                lines.append(
+                    f"{name}_bucket{_labels(bucket_labels)} {cumulative}"
+                )
+            lines.append(
+                f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}"
+            )
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    for name, help_text in COUNTERS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    pairs = ",".join(
+        f'{key}="{_escape(str(value))}"' for key, value in labels
+    )
+    return f"{{{pairs}}}"
+
+
+def _escape(value):
+    return (
+        value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    )
+
+
+def _number(value):
+    return repr(float(value))
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_last_flush = 0.0
+atexit.register(_remove_process_file)
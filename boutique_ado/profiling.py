@@ -0,0 +1,181 @@
+"""
+On-demand profiling of single requests, for superusers.
+
+A superuser can profile any request by adding ?profile=1 to its URL, or by
+sending an X-Profile: 1 header. The request is run under cProfile with every
+SQL query recorded, and the result is saved to PROFILE_DIR. Only the latest
+PROFILE_HISTORY profiles are kept. They're listed at /profiling/.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .metrics import view_name
+
+
+class ProfilerMiddleware:
+    """
+    Profile requests from superusers who ask for it.
+
+    Must come after AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not _wants_profile(request):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        queries = []
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(_query_recorder(queries))
+                )
+            start = time.perf_counter()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already running in this thread
+                return self.get_response(request)
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+            duration = time.perf_counter() - start
+        response["X-Profile-Id"] = save_profile(
+            request, response, profiler, queries, duration
+        )
+        return response
+
+
+def save_profile(request, response, profiler, queries, duration):
+    """
+    Save a request's profile and SQL trace, dropping the oldest profiles.
+
+    Return (str): The new profile's ID.
+    """
+    now = timezone.now()
+    profile_id = f"{now:%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    stats = pstats.Stats(profiler)
+    profile = {
+        "id": profile_id,
+        "created": now.isoformat(),
+        "method": request.method,
+        "path": request.get_full_path(),
+        "view": view_name(request),
+        "user": request.user.get_username(),
+        "status": response.status_code,
+        "duration": duration,
+        "profiled_seconds": stats.total_tt,
+        "function_calls": stats.total_calls,
+        "functions": _top_functions(stats),
+        "query_count": len(queries),
+        "query_seconds": sum(query["duration"] for query in queries),
+        "queries": queries[:settings.PROFILE_MAX_QUERIES],
+    }
+    os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+    path = _profile_path(profile_id)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as profile_file:
+        json.dump(profile, profile_file)
+    os.replace(temporary_path, path)
+    for old_id in _profile_ids()[settings.PROFILE_HISTORY:]:
+        try:
+            os.remove(_profile_path(old_id))
+        except FileNotFoundError:
+            pass
+    return profile_id
+
+
+def list_profiles():
+    """Return the saved profiles, newest first, without their details."""
+    profiles = []
+    for profile_id in _profile_ids():
+        profile = load_profile(profile_id)
+        if profile is not None:
+            del profile["functions"], profile["queries"]
+            profiles.append(profile)
+    return profiles
+
+
+def load_profile(profile_id):
+    """Return a saved profile, or None if it's been dropped."""
+    try:
+        with open(_profile_path(profile_id)) as profile_file:
+            return json.load(profile_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _wants_profile(request):
+    asked = request.GET.get("profile") or request.headers.get("X-Profile")
+    return bool(asked) and request.user.is_superuser
+
+
+def _query_recorder(queries):
+    """Return an execute wrapper that adds each query to queries."""
+
+    def record_query(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append(
+                {
+                    "sql": sql,
+                    "params": repr(params),
+                    "duration": time.perf_counter() - start,
+                }
+            )
+
+    return record_query
+
+
+def _top_functions(stats):
+    """Return the functions that took the most cumulative time."""
+    rows = sorted(
+        stats.stats.items(), key=lambda item: item[1][3], reverse=True
+    )
+    return [
+        {
+            "function": pstats.func_std_string(function),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "own_seconds": own_seconds,
+            "cumulative_seconds": cumulative_seconds,
+        }
+        for function, (
+            primitive_calls,
+            calls,
+            own_seconds,
+            cumulative_seconds,
+            _callers,
+        ) in rows[:settings.PROFILE_MAX_FUNCTIONS]
+    ]
+
+
+def _profile_ids():
+    """Return the IDs of the saved profiles, newest first."""
+    try:
+        filenames = os.listdir(settings.PROFILE_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        (name[:-5] for name in filenames if name.endswith(".json")),
+        reverse=True,
+    )
+
+
+def _profile_path(profile_id):
+    return os.path.join(settings.PROFILE_DIR, f"{profile_id}.json")
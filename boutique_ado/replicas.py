@@ -0,0 +1,177 @@
+"""
+Read-replica routing and database connection health checks.
+
+When a "replica" database is configured, the catalogue views read from it
+and everything else, including every write, uses the primary. Checkout,
+webhooks, the admin and product management pages and the background workers
+always read from the primary.
+
+A browser that has just written to the database reads from the primary for
+REPLICA_PIN_SECONDS afterwards, so it sees its own writes even if the replica
+is lagging. If the replica can't be reached, the catalogue views read from
+the primary instead, and the replica isn't tried again for
+REPLICA_RETRY_SECONDS.
+"""
+
+import contextvars
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+REPLICA = "replica"
+PIN_COOKIE = "db_primary_until"
+# Views whose reads can safely be a moment out of date. The bag context is
+# read from the replica on these pages too. The product management views
+# aren't listed, so an admin never edits a product read from a lagging
+# replica.
+CATALOGUE_VIEWS = {
+    "home.views.index",
+    "products.views.all_products",
+    "products.views.product_detail",
+    "bag.views.view_bag",
+    "bag.views.add_to_bag",
+    "bag.views.adjust_bag",
+    "bag.views.remove_from_bag",
+}
+# Apps that are always read from the primary. Sessions hold the bag, which
+# must never go back in time, and the cache table lives on the primary.
+PRIMARY_ONLY_APPS = {"sessions", "django_cache"}
+
+_use_replica = contextvars.ContextVar("use_replica", default=False)
+_wrote = contextvars.ContextVar("wrote", default=False)
+# Aliases whose connections have been checked during the current request, or
+# None outside requests and when the checks are off
+_checked = contextvars.ContextVar("checked_connections", default=None)
+# When to try the replica again after it couldn't be reached
+_replica_down_until = 0.0
+
+
+def replica_configured():
+    """Return True if there's a replica database."""
+    return REPLICA in connections.databases
+
+
+class ReplicaRouter:
+    """Send catalogue reads to the replica and the rest to the primary."""
+
+    def db_for_read(self, model, **hints):
+        alias = "default"
+        if (
+            _use_replica.get()
+            and not _wrote.get()
+            and model._meta.app_label not in PRIMARY_ONLY_APPS
+        ):
+            alias = REPLICA
+        _check_connection(alias)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in PRIMARY_ONLY_APPS:
+            _wrote.set(True)
+        _check_connection("default")
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data as the primary
+        return True
+
+
+class DatabaseMiddleware:
+    """
+    Check pooled connections are healthy, and choose where views read from.
+
+    Persistent connections (CONN_MAX_AGE) can be dropped by the server while
+    idle. With DATABASE_HEALTH_CHECKS on, as with Django's CONN_HEALTH_CHECKS,
+    an open connection is checked the first time a request uses it, and
+    replaced if it's no longer usable, rather than failing the request's
+    first query. Connections a request doesn't use aren't checked.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        checked = _checked.set(
+            set() if settings.DATABASE_HEALTH_CHECKS else None
+        )
+        wrote = _wrote.set(False)
+        use_replica = _use_replica.set(False)
+        try:
+            response = self.get_response(request)
+            if _wrote.get() and replica_configured():
+                response.set_cookie(
+                    PIN_COOKIE,
+                    str(int(time.time()) + settings.REPLICA_PIN_SECONDS),
+                    max_age=settings.REPLICA_PIN_SECONDS,
+                    httponly=True,
+                    samesite="Lax",
+                )
+        finally:
+            _checked.reset(checked)
+            _wrote.reset(wrote)
+            _use_replica.reset(use_replica)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            replica_configured()
+            and _view_path(view_func) in CATALOGUE_VIEWS
+            and not _pinned_to_primary(request)
+            and _replica_available()
+        ):
+            _use_replica.set(True)
+
+
+def _view_path(view_func):
+    """Return the dotted path of a view function."""
+    return f"{view_func.__module__}.{view_func.__name__}"
+
+
+def _pinned_to_primary(request):
+    """Return True if the browser wrote to the database a moment ago."""
+    try:
+        pinned_until = int(request.COOKIES.get(PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    return pinned_until > time.time()
+
+
+def _replica_available():
+    """
+    Return True if the replica can be reached.
+
+    A dropped connection is closed by the health check and reopened here.
+    """
+    global _replica_down_until
+    if time.monotonic() < _replica_down_until:
+        return False
+    try:
+        _check_connection(REPLICA)
+        connections[REPLICA].ensure_connection()
+    except DatabaseError:
+        _replica_down_until = (
+            time.monotonic() + settings.REPLICA_RETRY_SECONDS
+        )
+        return False
+    return True
+
+
+def _check_connection(alias):
+    """
+    Close a connection that no longer works, the first time a request uses it.
+
+    Django opens a new connection for the next query. A connection inside a
+    transaction is left alone, since closing it would lose the transaction.
+    """
+    checked = _checked.get()
+    if checked is None or alias in checked:
+        return
+    checked.add(alias)
+    connection = connections[alias]
+    if (
+        connection.connection is not None
+        and not connection.in_atomic_block
+        and not connection.is_usable()
+    ):
+        connection.close()
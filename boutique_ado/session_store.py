@@ -0,0 +1,42 @@
+"""
+A cache-first session engine, with write-through to the database.
+
+Sessions are read from the cache, falling back to the database, as with
+Django's cached_db engine. The cache is shared by every worker (see CACHES),
+and each save updates it, so every worker sees the latest bag. Saving a
+session whose data hasn't changed since it was loaded is skipped, so views
+that reassign an unchanged bag don't rewrite the session row.
+"""
+
+from django.contrib.sessions.backends.cached_db import (
+    SessionStore as CachedDBSessionStore,
+)
+
+
+class SessionStore(CachedDBSessionStore):
+    """Cached database session store that skips unchanged writes."""
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._loaded_data = None
+
+    def load(self):
+        data = super().load()
+        self._loaded_data = self._encoded(data)
+        return data
+
+    def save(self, must_create=False):
+        unchanged = (
+            not must_create
+            and self.session_key is not None
+            and self._loaded_data is not None
+            and self._loaded_data == self._encoded(self._get_session())
+        )
+        if unchanged:
+            return
+        super().save(must_create=must_create)
+        self._loaded_data = self._encoded(self._get_session())
+
+    def _encoded(self, data):
+        """Return session data in the form it's stored in."""
+        return self.serializer().dumps(data)
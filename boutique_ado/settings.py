@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import tempfile
 import dj_database_url
 from pathlib import Path
 
@@ -65,10 +66,14 @@ CRISPY_TEMPLATE_PACK = "bootstrap4"
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "boutique_ado.metrics.MetricsMiddleware",
+    "boutique_ado.replicas.DatabaseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "boutique_ado.profiling.ProfilerMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -77,7 +82,8 @@ ROOT_URLCONF = "boutique_ado.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        # DjangoTemplates, timing each render for the request metrics
+        "BACKEND": "boutique_ado.metrics.TemplateBackend",
         "DIRS": [
             os.path.join(BASE_DIR, "templates"),
             os.path.join(BASE_DIR, "templates", "allauth"),
@@ -126,9 +132,15 @@ WSGI_APPLICATION = "boutique_ado.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# Connections are kept open between requests, and checked by
+# boutique_ado.replicas.DatabaseMiddleware before they're reused.
+CONN_MAX_AGE = 600  # Seconds
+
 if "DATABASE_URL" in os.environ:
     DATABASES = {
-        "default": dj_database_url.parse(os.environ.get("DATABASE_URL")),
+        "default": dj_database_url.parse(
+            os.environ.get("DATABASE_URL"), conn_max_age=CONN_MAX_AGE
+        ),
     }
 else:
     DATABASES = {
@@ -138,6 +150,49 @@ else:
         }
     }
 
+# An optional read replica for the catalogue pages
+if "REPLICA_DATABASE_URL" in os.environ:
+    DATABASES["replica"] = dj_database_url.parse(
+        os.environ.get("REPLICA_DATABASE_URL"), conn_max_age=CONN_MAX_AGE
+    )
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+
+DATABASE_ROUTERS = ["boutique_ado.replicas.ReplicaRouter"]
+DATABASE_HEALTH_CHECKS = True
+REPLICA_PIN_SECONDS = 15  # Read from the primary for this long after a write
+REPLICA_RETRY_SECONDS = 10  # Wait this long to retry an unreachable replica
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+# Every dyno shares the cache, so a catalogue change saved on one dyno
+# invalidates the cached listings on all of them. Set MEMCACHED_SERVERS to a
+# comma-separated list of host:port addresses to keep it in memcached, where
+# a hit costs a network round trip rather than a database query. Without
+# it, the cache is kept in the database, which needs no other service but
+# costs a query or two per lookup. Run createcachetable to create its table.
+if "MEMCACHED_SERVERS" in os.environ:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+            "LOCATION": os.environ.get("MEMCACHED_SERVERS").split(","),
+            # An unreachable server is a cache miss, not an error
+            "OPTIONS": {"no_delay": True, "ignore_exc": True},
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "boutique_ado_cache",
+            "OPTIONS": {"MAX_ENTRIES": 10000},
+        }
+    }
+
+# Sessions are read from the shared cache first and written through to the
+# database, skipping writes that change nothing
+SESSION_ENGINE = "boutique_ado.session_store"
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -187,6 +242,15 @@ USE_TZ = True
 
 STATIC_URL = "/static/"
 STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
+STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
+# collectstatic writes content-hashed copies of each file, plus gzip and
+# brotli versions, which WhiteNoiseMiddleware serves with far-future caching.
+# With DEBUG off, pages can't render until it has run. On Heroku the Python
+# buildpack runs it while building the slug, so DISABLE_COLLECTSTATIC must
+# not be set. It can't go in the release phase, whose files are discarded.
+STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+# Tests don't need collectstatic to have been run
+TEST_RUNNER = "boutique_ado.test_runner.TestRunner"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
@@ -199,10 +263,51 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Boutique Ado constants
 FREE_DELIVERY_THRESHOLD = 50
 STANDARD_DELIVERY_PERCENTAGE = 10
+CATALOGUE_CACHE_TIMEOUT = 60 * 15
+CATALOGUE_VERSION_TTL = 5  # Seconds each worker trusts the version it read
+PRODUCTS_PER_PAGE = 24
+PRODUCT_SNAPSHOT_CACHE_SIZE = 2000  # Products cached by each worker
+PRODUCT_SNAPSHOT_TTL = 60  # Seconds before a cached product is re-read
+PRODUCT_IMAGE_WIDTHS = (300, 600, 1200)  # Pixels, for the srcset variants
+PRODUCT_IMAGE_QUALITY = 80
+ORDERS_PER_PAGE = 10
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60  # Seconds, doubled after each failed attempt
+EMAIL_OUTBOX_LEASE = 300  # Seconds a worker has to send the emails it claims
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_DELAY = 30  # Seconds, doubled after each failed attempt
 STRIPE_CURRENCY = "gbp"
 STRIPE_PUBLIC_KEY = os.getenv("STRIPE_PUBLIC_KEY", "")
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
 STRIPE_WH_SECRET = os.getenv("STRIPE_WH_SECRET", "")
+# Point this at a local fake Stripe server to test payments offline
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "https://api.stripe.com")
+STRIPE_TIMEOUT = (3.05, 10)  # Connect and read timeouts, in seconds
+STRIPE_MAX_RETRIES = 2
+STRIPE_RETRY_BUDGET_RATIO = 0.1  # At most one retry per ten calls
+STRIPE_RETRY_BACKOFF = 0.2  # Seconds, doubled after each failed attempt
+STRIPE_MAX_RETRY_BACKOFF = 2  # Seconds
+STRIPE_CIRCUIT_FAILURE_THRESHOLD = 5
+STRIPE_CIRCUIT_RESET_TIMEOUT = 30  # Seconds
+# Each worker writes its request metrics to a file in this directory
+METRICS_DIR = os.environ.get(
+    "METRICS_DIR",
+    os.path.join(tempfile.gettempdir(), "boutique_ado_metrics"),
+)
+METRICS_FLUSH_INTERVAL = 5  # Seconds
+METRICS_FILE_TTL = 60 * 60  # Seconds before a dead process's file is deleted
+# Lets a Prometheus scraper read /metrics with "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 1))
+SLOW_REQUEST_MAX_QUERIES = 50  # Queries logged for each slow request
+# Superusers' request profiles are kept in this directory
+PROFILE_DIR = os.environ.get(
+    "PROFILE_DIR",
+    os.path.join(tempfile.gettempdir(), "boutique_ado_profiles"),
+)
+PROFILE_HISTORY = 50  # The oldest profiles are dropped after this many
+PROFILE_MAX_FUNCTIONS = 200  # Slowest functions kept for each profile
+PROFILE_MAX_QUERIES = 500  # Queries kept for each profile
 
 if "USE_AWS" in os.environ:
     # Cache for static and media files
@@ -235,3 +340,7 @@ else:
     EMAIL_HOST_USER = os.environ.get("EMAIL_HOST_USER")
     EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_HOST_PASS")
     DEFAULT_FROM_EMAIL = os.environ.get("EMAIL_HOST_USER")
+
+# Send email through a wrapper that times it for the request metrics
+METRICS_EMAIL_BACKEND = EMAIL_BACKEND
+EMAIL_BACKEND = "boutique_ado.metrics.EmailBackend"
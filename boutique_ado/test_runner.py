@@ -0,0 +1,37 @@
+"""
+The test runner, for manage.py test.
+
+Tests render pages with DEBUG off, where the manifest static files storage
+needs collectstatic to have been run. They use the plain static files
+storage instead, so they run on a fresh checkout.
+
+The replica tests create their own replica database, so the runner doesn't
+set one up.
+"""
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from .replicas import REPLICA
+
+STATICFILES_STORAGE = "django.contrib.staticfiles.storage.StaticFilesStorage"
+
+
+class TestRunner(DiscoverRunner):
+    """Run the tests with static files served without a manifest."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.static_files = override_settings(
+            STATICFILES_STORAGE=STATICFILES_STORAGE
+        )
+        self.static_files.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.static_files.disable()
+        super().teardown_test_environment(**kwargs)
+
+    def get_databases(self, suite):
+        databases = super().get_databases(suite)
+        databases.discard(REPLICA)
+        return databases
@@ -0,0 +1,304 @@
+import copy
+import json
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import OperationalError, connections
+from django.conf import settings
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.urls import reverse
+
+from products.models import Product
+
+from . import metrics, replicas
+from .replicas import PIN_COOKIE, REPLICA
+
+
+class ReplicaTestCase(TestCase):
+    """
+    A TestCase with a replica database.
+
+    The replica is a separate test database rather than a mirror of the
+    primary, so each test can tell which database a page read from. It's
+    created for the test case, standing in for any configured replica.
+    """
+
+    databases = {"default", REPLICA}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.configured_replica = connections.databases.get(REPLICA)
+        if cls.configured_replica is not None:
+            connections[REPLICA].close()
+            del connections[REPLICA]
+        settings_dict = copy.deepcopy(connections["default"].settings_dict)
+        settings_dict["TEST"].update(NAME=None, MIRROR=None)
+        connections.databases[REPLICA] = settings_dict
+        cls.primary_name = settings_dict["NAME"]
+        connections[REPLICA].creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        replica = connections[REPLICA]
+        replica.creation.destroy_test_db(cls.primary_name, verbosity=0)
+        # Closing is a no-op for an in-memory SQLite database, which would
+        # otherwise outlive the test case
+        replica._close()
+        del connections[REPLICA]
+        if cls.configured_replica is None:
+            del connections.databases[REPLICA]
+        else:
+            connections.databases[REPLICA] = cls.configured_replica
+
+    def setUp(self):
+        patcher = mock.patch.object(replicas, "_replica_down_until", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The replica lags behind with an old name for the product
+        self.product = self.create_product("Primary Shirt", "Replica Shirt")
+
+    def create_product(self, name, replica_name=None):
+        """Create a product on the primary and the replica."""
+        product = Product.objects.create(
+            name=name, description="A shirt.", price=Decimal("20.00")
+        )
+        replica_product = copy.copy(product)
+        replica_product.name = replica_name or name
+        Product.objects.using(REPLICA).bulk_create([replica_product])
+        return product
+
+    def login_superuser(self):
+        """Log in as a superuser who has been replicated to the replica."""
+        user = User.objects.create_superuser(
+            "admin", "admin@example.com", "password"
+        )
+        User.objects.using(REPLICA).bulk_create([user])
+        self.client.force_login(user)
+
+
+class ReplicaRouterTests(ReplicaTestCase):
+    def test_catalogue_views_read_from_the_replica(self):
+        response = self.client.get(
+            reverse("product_detail", args=[self.product.pk])
+        )
+
+        self.assertContains(response, "Replica Shirt")
+        self.assertNotContains(response, "Primary Shirt")
+
+    def test_other_views_read_from_the_primary(self):
+        self.login_superuser()
+
+        response = self.client.get(
+            reverse(
+                "admin:products_product_change", args=[self.product.pk]
+            )
+        )
+
+        self.assertContains(response, "Primary Shirt")
+        self.assertNotContains(response, "Replica Shirt")
+
+    def test_product_management_views_read_from_the_primary(self):
+        self.login_superuser()
+
+        response = self.client.get(
+            reverse("edit_product", args=[self.product.pk])
+        )
+
+        self.assertContains(response, "Primary Shirt")
+        self.assertNotContains(response, "Replica Shirt")
+
+    def test_writes_go_to_the_primary(self):
+        self.login_superuser()
+
+        self.client.get(reverse("delete_product", args=[self.product.pk]))
+
+        products = Product.objects.filter(pk=self.product.pk)
+        self.assertFalse(products.using("default").exists())
+        self.assertTrue(products.using(REPLICA).exists())
+
+
+class ReplicaPinTests(ReplicaTestCase):
+    def test_a_write_pins_the_browser_to_the_primary(self):
+        self.login_superuser()
+        other = self.create_product("Other Shirt")
+
+        response = self.client.get(
+            reverse("delete_product", args=[other.pk])
+        )
+
+        pinned_until = int(response.cookies[PIN_COOKIE].value)
+        self.assertAlmostEqual(pinned_until, time.time() + 15, delta=2)
+        response = self.client.get(
+            reverse("product_detail", args=[self.product.pk])
+        )
+        self.assertContains(response, "Primary Shirt")
+
+    def test_reads_do_not_pin_the_browser(self):
+        response = self.client.get(
+            reverse("product_detail", args=[self.product.pk])
+        )
+
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_the_pin_expires(self):
+        self.client.cookies[PIN_COOKIE] = str(int(time.time()) - 1)
+
+        response = self.client.get(
+            reverse("product_detail", args=[self.product.pk])
+        )
+
+        self.assertContains(response, "Replica Shirt")
+
+
+class ReplicaFallbackTests(ReplicaTestCase):
+    def replica_down(self):
+        return mock.patch.object(
+            connections[REPLICA],
+            "ensure_connection",
+            side_effect=OperationalError("could not connect to server"),
+        )
+
+    def test_reads_from_the_primary_when_the_replica_is_down(self):
+        with self.replica_down():
+            response = self.client.get(
+                reverse("product_detail", args=[self.product.pk])
+            )
+
+        self.assertContains(response, "Primary Shirt")
+
+    def test_does_not_retry_the_replica_straight_away(self):
+        with self.replica_down() as ensure_connection:
+            for _ in range(2):
+                self.client.get(
+                    reverse("product_detail", args=[self.product.pk])
+                )
+
+        self.assertEqual(ensure_connection.call_count, 1)
+
+    def test_reads_from_the_replica_again_once_it_is_back(self):
+        with self.replica_down():
+            self.client.get(
+                reverse("product_detail", args=[self.product.pk])
+            )
+        replicas._replica_down_until = time.monotonic()
+
+        response = self.client.get(
+            reverse("product_detail", args=[self.product.pk])
+        )
+
+        self.assertContains(response, "Replica Shirt")
+
+
+class HealthCheckTests(TransactionTestCase):
+    def setUp(self):
+        Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+        self.connection = connections["default"]
+        self.connection.ensure_connection()
+
+    def get_with_dropped_connection(self):
+        """Request a page, with the connection looking dropped."""
+        with mock.patch.object(
+            self.connection, "is_usable", return_value=False
+        ) as is_usable, mock.patch.object(
+            self.connection, "close", wraps=self.connection.close
+        ) as close:
+            response = self.client.get(reverse("products"))
+        self.assertEqual(response.status_code, 200)
+        return is_usable.call_count, close.call_count
+
+    def test_checks_a_connection_once_when_a_request_first_uses_it(self):
+        self.assertEqual(self.get_with_dropped_connection(), (1, 1))
+
+    @override_settings(DATABASE_HEALTH_CHECKS=False)
+    def test_does_not_check_connections_when_turned_off(self):
+        self.assertEqual(self.get_with_dropped_connection(), (0, 0))
+
+
+class SessionStoreTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+
+    def add_to_bag(self, client, quantity):
+        client.post(
+            reverse("add_to_bag", args=[self.product.pk]),
+            {"quantity": quantity, "redirect_url": reverse("view_bag")},
+        )
+
+    def product_count(self, client):
+        response = client.get(reverse("view_bag"))
+        return response.context["product_count"]()
+
+    def test_every_worker_sees_the_latest_bag(self):
+        # Another worker, serving the same browser
+        other_client = Client()
+        self.add_to_bag(self.client, 1)
+        other_client.cookies[settings.SESSION_COOKIE_NAME] = (
+            self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        )
+        self.assertEqual(self.product_count(other_client), 1)
+
+        self.add_to_bag(self.client, 2)
+
+        self.assertEqual(self.product_count(other_client), 3)
+        self.add_to_bag(other_client, 1)
+        self.assertEqual(self.product_count(self.client), 4)
+
+
+class MetricsFileTests(SimpleTestCase):
+    def setUp(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        settings_override = override_settings(
+            METRICS_DIR=metrics_dir, METRICS_FILE_TTL=60
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.metrics_dir = metrics_dir
+
+    def write_process_file(self, filename, age):
+        path = os.path.join(self.metrics_dir, filename)
+        with open(path, "w") as metrics_file:
+            json.dump({"histograms": [], "counters": []}, metrics_file)
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+        return path
+
+    def test_reads_recently_written_files(self):
+        self.write_process_file("web-1.json", age=30)
+
+        self.assertEqual(len(list(metrics._read_process_files())), 1)
+
+    def test_deletes_files_that_have_not_been_written_for_a_while(self):
+        dead = self.write_process_file("web-1.json", age=120)
+        temporary = self.write_process_file("web-1.json.tmp", age=120)
+
+        self.assertEqual(list(metrics._read_process_files()), [])
+        self.assertFalse(os.path.exists(dead))
+        self.assertFalse(os.path.exists(temporary))
+
+    def test_a_process_deletes_its_file_when_it_exits(self):
+        metrics.flush()
+        self.assertTrue(os.path.exists(metrics._process_file()))
+
+        metrics._remove_process_file()
+
+        self.assertFalse(os.path.exists(metrics._process_file()))
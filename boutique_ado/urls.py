@@ -19,6 +19,8 @@ from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from . import views
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("accounts/", include("allauth.urls")),
@@ -26,6 +28,15 @@ urlpatterns = [
     path("checkout/", include("checkout.urls")),
     path("products/", include("products.urls")),
     path("profile/", include("profiles.urls")),
+    path("metrics/", views.metrics, name="metrics"),
+    path(
+        "profiling/", views.request_profiles, name="request_profiles"
+    ),
+    path(
+        "profiling/<slug:profile_id>/",
+        views.request_profile,
+        name="request_profile",
+    ),
     path("", include("home.urls")),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
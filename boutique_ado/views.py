@@ -1,7 +1,62 @@
+import hmac
 from http import HTTPStatus
-from django.shortcuts import render
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from django.shortcuts import redirect, render
+from django.urls import reverse
+
+from .metrics import export_metrics
+from .profiling import list_profiles, load_profile
 
 
 def handler404(request, exception):
     """Handle page not found errors"""
     return render(request, "errors/404.html", status=HTTPStatus.NOT_FOUND)
+
+
+def metrics(request):
+    """
+    Return the request metrics for every worker, for Prometheus.
+
+    Only staff, or a scraper sending the METRICS_TOKEN, can see them.
+    """
+    if not (request.user.is_staff or _has_metrics_token(request)):
+        raise PermissionDenied
+    return HttpResponse(
+        export_metrics(), content_type="text/plain; version=0.0.4"
+    )
+
+
+@login_required
+def request_profiles(request):
+    """Show a list of the saved request profiles"""
+    if not request.user.is_superuser:
+        messages.error(request, "Sorry, only administrators can do that.")
+        return redirect(reverse("home"))
+    context = {"profiles": list_profiles()}
+    return render(request, "profiling/request_profiles.html", context)
+
+
+@login_required
+def request_profile(request, profile_id):
+    """Show a saved request profile"""
+    if not request.user.is_superuser:
+        messages.error(request, "Sorry, only administrators can do that.")
+        return redirect(reverse("home"))
+    profile = load_profile(profile_id)
+    if profile is None:
+        raise Http404("That profile has been dropped.")
+    context = {"profile": profile}
+    return render(request, "profiling/request_profile.html", context)
+
+
+def _has_metrics_token(request):
+    if not settings.METRICS_TOKEN:
+        return False
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    given = request.headers.get("Authorization", "")
+    return hmac.compare_digest(given.encode(), expected.encode())
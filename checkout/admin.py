@@ -1,5 +1,11 @@
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from .models import (
+    Order,
+    OrderLineItem,
+    OutboundEmail,
+    ProcessedEvent,
+    WebhookEvent,
+)
 
 
 class OrderLineItemAdminInline(admin.TabularInline):
@@ -53,3 +59,56 @@ class OrderAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Order, OrderAdmin)
+
+
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = (
+        "subject",
+        "to_email",
+        "status",
+        "attempts",
+        "created",
+        "sent",
+    )
+    list_filter = ("status",)
+    readonly_fields = ("created", "sent", "attempts", "last_error")
+    ordering = ("-created",)
+
+
+admin.site.register(OutboundEmail, OutboundEmailAdmin)
+
+
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "event_id",
+        "event_type",
+        "payment_intent_id",
+        "status",
+        "attempts",
+        "duplicates",
+        "received",
+        "processed",
+    )
+    list_filter = ("status", "event_type")
+    search_fields = ("event_id", "payment_intent_id")
+    readonly_fields = ("received", "processed", "attempts", "last_error")
+    ordering = ("-received",)
+
+
+admin.site.register(WebhookEvent, WebhookEventAdmin)
+
+
+class ProcessedEventAdmin(admin.ModelAdmin):
+    list_display = (
+        "event_id",
+        "event_type",
+        "payment_intent_id",
+        "duplicates",
+        "processed",
+    )
+    list_filter = ("event_type",)
+    search_fields = ("event_id", "payment_intent_id")
+    ordering = ("-processed",)
+
+
+admin.site.register(ProcessedEvent, ProcessedEventAdmin)
@@ -0,0 +1,285 @@
+import json
+from datetime import timedelta
+from http import HTTPStatus
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Sum
+from django.utils import timezone
+import stripe
+
+from .models import Order, ProcessedEvent, WebhookEvent
+from .stripe_client import stripe_client
+from .webhook_handler import StripeWH_Handler
+
+
+def receive_event(event, payload):
+    """
+    Add a verified Stripe event to the inbox.
+
+    The event is processed later by the process_webhooks worker. Stripe may
+    deliver an event more than once. A redelivered event is counted as a
+    duplicate and otherwise ignored, with one indexed lookup if it's already
+    been processed.
+
+    Return (bool): False if the event is a duplicate.
+    """
+    redelivered = ProcessedEvent.objects.filter(event_id=event.id).update(
+        duplicates=F("duplicates") + 1
+    )
+    if redelivered:
+        return False
+    data_object = event.data.object
+    payment_intent_id = ""
+    if data_object.get("object") == "payment_intent":
+        payment_intent_id = data_object.id
+    inbox_event, created = WebhookEvent.objects.get_or_create(
+        event_id=event.id,
+        defaults={
+            "event_type": event["type"],
+            "payment_intent_id": payment_intent_id,
+            "payload": payload,
+        },
+    )
+    if not created:
+        WebhookEvent.objects.filter(pk=inbox_event.pk).update(
+            duplicates=F("duplicates") + 1
+        )
+    return created
+
+
+def duplicate_rates():
+    """
+    Return how often Stripe redelivers each type of event.
+
+    Return (list): A dict for each event type, with its number of events,
+    its number of duplicate deliveries and the share of deliveries that were
+    duplicates.
+    """
+    totals = {}
+    for model in (ProcessedEvent, WebhookEvent):
+        events = model.objects.all()
+        if model is WebhookEvent:
+            # Processed events are counted in the ledger
+            events = events.exclude(status=WebhookEvent.PROCESSED)
+        rows = events.values("event_type").annotate(
+            events=Count("pk"), duplicates=Sum("duplicates")
+        )
+        for row in rows:
+            total = totals.setdefault(
+                row["event_type"], {"events": 0, "duplicates": 0}
+            )
+            total["events"] += row["events"]
+            total["duplicates"] += row["duplicates"]
+    rates = []
+    for event_type, total in sorted(totals.items()):
+        deliveries = total["events"] + total["duplicates"]
+        rates.append(
+            {
+                "event_type": event_type,
+                "events": total["events"],
+                "duplicates": total["duplicates"],
+                "duplicate_rate": total["duplicates"] / deliveries,
+            }
+        )
+    return rates
+
+
+def process_events(batch_size):
+    """
+    Process a batch of due events from the inbox.
+
+    Events for the same payment intent are processed in the order they were
+    received: an event isn't due while an earlier event for its payment intent
+    is still pending. Each event is locked while it's processed, so several
+    workers can share the inbox. Anything needed from Stripe is fetched
+    before the event is locked, so no lock is held while waiting for Stripe.
+    Failed events are retried with exponential backoff, until they've been
+    tried WEBHOOK_MAX_ATTEMPTS times, and are then dead-lettered.
+
+    Return (tuple): The number of events processed and the number that failed.
+    """
+    processed = failed = 0
+    for pk in _due_event_ids(batch_size):
+        event = WebhookEvent.objects.filter(
+            pk=pk, status=WebhookEvent.PENDING
+        ).first()
+        if event is None:
+            continue
+        try:
+            charges = _retrieve_charges(event)
+        except Exception as error:
+            with transaction.atomic():
+                event = _lock_event(pk)
+                if event is not None:
+                    event.attempts += 1
+                    _record_failure(event, error)
+                    failed += 1
+            continue
+        with transaction.atomic():
+            event = _lock_event(pk)
+            if event is None or _waiting_on_earlier_event(event):
+                continue
+            if _process(event, charges):
+                processed += 1
+            else:
+                failed += 1
+    return processed, failed
+
+
+def handle_event(event, charges=None):
+    """
+    Handle a Stripe event and return the handler's response.
+
+    charges is a dict of Stripe charges already retrieved for the event, by
+    ID, so the handler doesn't have to call Stripe for them.
+    """
+    wh_handler = StripeWH_Handler(None, charges=charges)
+    event_handler_map = {
+        "payment_intent.succeeded": wh_handler.handle_payment_succeeded,
+        "payment_intent.payment_failed": wh_handler.handle_payment_failed,
+    }
+    handler_method = event_handler_map.get(
+        event["type"], wh_handler.handle_other_event
+    )
+    return handler_method(event)
+
+
+def _due_event_ids(batch_size):
+    """Return the IDs of the oldest events that are due to be processed."""
+    earlier_pending = WebhookEvent.objects.filter(
+        payment_intent_id=OuterRef("payment_intent_id"),
+        status=WebhookEvent.PENDING,
+        pk__lt=OuterRef("pk"),
+    )
+    return list(
+        WebhookEvent.objects.filter(
+            Q(payment_intent_id="") | ~Exists(earlier_pending),
+            status=WebhookEvent.PENDING,
+            next_attempt__lte=timezone.now(),
+        )
+        .order_by("received", "pk")
+        .values_list("pk", flat=True)[:batch_size]
+    )
+
+
+def _retrieve_charges(event):
+    """
+    Return the Stripe charges needed to handle an event, by ID.
+
+    This is called before the event is locked. Only a payment that succeeded
+    without an order from the checkout view needs its charge.
+    """
+    if event.event_type != "payment_intent.succeeded":
+        return {}
+    if Order.objects.filter(stripe_pid=event.payment_intent_id).exists():
+        return {}
+    charge_id = json.loads(event.payload)["data"]["object"].get(
+        "latest_charge"
+    )
+    if not charge_id:
+        return {}
+    return {charge_id: stripe_client().retrieve_charge(charge_id)}
+
+
+def _lock_event(pk):
+    """
+    Return a pending event, locked for the rest of the transaction.
+
+    Return None if another worker has it locked, or has already processed it.
+    """
+    events = WebhookEvent.objects.filter(pk=pk, status=WebhookEvent.PENDING)
+    if connection.features.has_select_for_update_skip_locked:
+        events = events.select_for_update(skip_locked=True)
+    else:
+        events = events.select_for_update()
+    return events.first()
+
+
+def _waiting_on_earlier_event(event):
+    """Return True if an earlier event for the payment intent is pending."""
+    if not event.payment_intent_id:
+        return False
+    return WebhookEvent.objects.filter(
+        payment_intent_id=event.payment_intent_id,
+        status=WebhookEvent.PENDING,
+        pk__lt=event.pk,
+    ).exists()
+
+
+def _process(event, charges):
+    """
+    Process one event and record the result.
+
+    Return (bool): True if the event was processed successfully.
+    """
+    event.attempts += 1
+    try:
+        with transaction.atomic():
+            if _record_in_ledger(event):
+                stripe_event = stripe.Event.construct_from(
+                    json.loads(event.payload), settings.STRIPE_SECRET_KEY
+                )
+                response = handle_event(stripe_event, charges)
+                if response.status_code != HTTPStatus.OK:
+                    raise WebhookProcessingError(response.content.decode())
+    except Exception as error:
+        _record_failure(event, error)
+        return False
+    event.status = WebhookEvent.PROCESSED
+    event.processed = timezone.now()
+    event.last_error = ""
+    event.save()
+    return True
+
+
+def _record_in_ledger(event):
+    """
+    Add an event to the processed-event ledger.
+
+    The entry is rolled back with the rest of the transaction if handling the
+    event fails.
+
+    Return (bool): False if the event, or another event saying its payment
+    intent succeeded, has already been handled.
+    """
+    try:
+        with transaction.atomic():
+            ProcessedEvent.objects.create(
+                event_id=event.event_id,
+                event_type=event.event_type,
+                payment_intent_id=event.payment_intent_id,
+                duplicates=event.duplicates,
+            )
+    except IntegrityError:
+        handled = Q(event_id=event.event_id)
+        if event.payment_intent_id:
+            handled |= Q(
+                event_type=event.event_type,
+                payment_intent_id=event.payment_intent_id,
+            )
+        ProcessedEvent.objects.filter(handled).update(
+            duplicates=F("duplicates") + 1 + event.duplicates
+        )
+        return False
+    return True
+
+
+def _record_failure(event, error):
+    """
+    Record a failed attempt to process an event.
+
+    The event is retried with exponential backoff, or dead-lettered once it's
+    used up its attempts.
+    """
+    event.last_error = str(error)
+    if event.attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+        event.status = WebhookEvent.DEAD
+    else:
+        delay = settings.WEBHOOK_RETRY_DELAY * 2 ** (event.attempts - 1)
+        event.next_attempt = timezone.now() + timedelta(seconds=delay)
+    event.save()
+
+
+class WebhookProcessingError(Exception):
+    """Raised when a webhook handler doesn't succeed."""
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from checkout.inbox import process_events
+
+
+class Command(BaseCommand):
+    help = "Process the Stripe webhook events waiting in the inbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="The number of events to take from the inbox at a time.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the inbox instead of exiting when it's empty.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1,
+            help="Seconds to wait between polls when the inbox is empty.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            processed, failed = process_events(options["batch_size"])
+            if processed or failed:
+                self.stdout.write(
+                    f"Processed {processed} events, {failed} failed."
+                )
+            elif not options["loop"]:
+                break
+            else:
+                time.sleep(options["interval"])
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from checkout.outbox import send_queued_emails
+
+
+class Command(BaseCommand):
+    help = "Send the emails waiting in the outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="The number of emails to send over each mail connection.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the outbox instead of exiting when it's empty.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between polls when the outbox is empty.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_queued_emails(options["batch_size"])
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} emails, {failed} failed.")
+            elif not options["loop"]:
+                break
+            else:
+                time.sleep(options["interval"])
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from checkout.inbox import duplicate_rates
+
+
+class Command(BaseCommand):
+    help = "Report how often Stripe redelivers each type of webhook event."
+
+    def handle(self, *args, **options):
+        rates = duplicate_rates()
+        if not rates:
+            self.stdout.write("No webhook events received yet.")
+            return
+        for rate in rates:
+            self.stdout.write(
+                f'{rate["event_type"]}: {rate["events"]} events, '
+                f'{rate["duplicates"]} duplicates '
+                f'({rate["duplicate_rate"]:.1%} of deliveries)'
+            )
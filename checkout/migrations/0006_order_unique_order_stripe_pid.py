@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:10
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicate_stripe_pids(apps, schema_editor):
+    """
+    Rename the stripe_pid of every order but the first for each payment.
+
+    Before the constraint, the webhook could create a second order for a
+    payment once it gave up waiting for the checkout view's. The later
+    orders are kept, so nothing is lost, but no longer claim the payment.
+    """
+    Order = apps.get_model("checkout", "Order")
+    duplicated_pids = (
+        Order.objects.exclude(stripe_pid="")
+        .order_by()
+        .values("stripe_pid")
+        .annotate(orders=Count("pk"))
+        .filter(orders__gt=1)
+        .values_list("stripe_pid", flat=True)
+    )
+    for pid in list(duplicated_pids):
+        orders = Order.objects.filter(stripe_pid=pid).order_by("date", "pk")
+        for pk in orders.values_list("pk", flat=True)[1:]:
+            Order.objects.filter(pk=pk).update(
+                stripe_pid=f"{pid}_duplicate_{pk}"
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0005_auto_20261018_1909'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            rename_duplicate_stripe_pids, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('stripe_pid', ''), _negated=True), fields=('stripe_pid',), name='unique_order_stripe_pid'),
+        ),
+    ]
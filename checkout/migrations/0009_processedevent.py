@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0008_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=254, unique=True)),
+                ('event_type', models.CharField(max_length=254)),
+                ('payment_intent_id', models.CharField(blank=True, default='', max_length=254)),
+                ('duplicates', models.IntegerField(default=0)),
+                ('processed', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='duplicates',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name='processedevent',
+            constraint=models.UniqueConstraint(condition=models.Q(('event_type', 'payment_intent.succeeded')), fields=('payment_intent_id',), name='unique_processed_payment_succeeded'),
+        ),
+    ]
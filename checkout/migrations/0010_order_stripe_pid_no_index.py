@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0009_processedevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(default='', max_length=254),
+        ),
+    ]
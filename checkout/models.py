@@ -1,7 +1,8 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Sum
 from django.conf import settings
+from django.utils import timezone
 from django_countries.fields import CountryField
 
 from products.models import Product
@@ -11,7 +12,9 @@ from profiles.models import UserProfile
 class Order(models.Model):
     """A customer's order"""
 
-    order_number = models.CharField(max_length=32, null=False, editable=False)
+    order_number = models.CharField(
+        max_length=32, null=False, editable=False, unique=True
+    )
     user_profile = models.ForeignKey(
         UserProfile,
         on_delete=models.SET_NULL,
@@ -39,14 +42,48 @@ class Order(models.Model):
         max_digits=10, decimal_places=2, null=False, default=0
     )
     original_bag = models.TextField(null=False, blank=False, default="")
+    # Indexed for the webhook's lookups as well as constrained below: the
+    # partial unique index can't be used for a plain stripe_pid = %s lookup
     stripe_pid = models.CharField(
-        max_length=254, null=False, blank=False, default=""
+        max_length=254, null=False, blank=False, default="", db_index=True
     )
 
     def _new_order_number(self):
         """Generate a unique order number."""
         return uuid.uuid4().hex.upper()
 
+    def add_line_items(self, bag_items):
+        """
+        Add line items to the saved order, then update its totals once.
+
+        bag_items are shopping bag context items, with a product, a quantity
+        and an optional size. The line items are created with a single
+        bulk_create, which skips the per-line-item post_save signal.
+        """
+        line_items = []
+        for bag_item in bag_items:
+            product = bag_item["product"]
+            quantity = bag_item["quantity"]
+            line_items.append(
+                OrderLineItem(
+                    order=self,
+                    product=product,
+                    quantity=quantity,
+                    product_size=bag_item.get("size"),
+                    lineitem_total=product.price * quantity,
+                )
+            )
+        with transaction.atomic():
+            OrderLineItem.objects.bulk_create(line_items)
+            self.order_total += sum(
+                line_item.lineitem_total for line_item in line_items
+            )
+            self.update_delivery_cost()
+            self.grand_total = self.order_total + self.delivery_cost
+            self.save(
+                update_fields=["order_total", "delivery_cost", "grand_total"]
+            )
+
     def update_grand_total(self):
         """Update the grand total."""
         self.update_order_total()
@@ -77,6 +114,16 @@ class Order(models.Model):
     def __str__(self):
         return self.order_number
 
+    class Meta:
+        constraints = [
+            # Each Stripe payment intent pays for exactly one order
+            models.UniqueConstraint(
+                fields=["stripe_pid"],
+                condition=~models.Q(stripe_pid=""),
+                name="unique_order_stripe_pid",
+            ),
+        ]
+
 
 class OrderLineItem(models.Model):
     """A collection of order items with unique characteristics."""
@@ -106,3 +153,112 @@ class OrderLineItem(models.Model):
 
     def __str__(self):
         return f"SKU {self.product.sku} on order {self.order}"
+
+
+class OutboundEmail(models.Model):
+    """An email waiting in the outbox to be sent by the email worker."""
+
+    PENDING = "pending"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    ]
+
+    subject = models.CharField(max_length=254, null=False, blank=False)
+    body = models.TextField(null=False, blank=False)
+    from_email = models.EmailField(max_length=254, null=False, blank=False)
+    to_email = models.EmailField(max_length=254, null=False, blank=False)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.IntegerField(null=False, blank=False, default=0)
+    last_error = models.TextField(null=False, blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    # While the email is sending, when the sending worker's lease runs out
+    next_attempt = models.DateTimeField(default=timezone.now)
+    sent = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # For the email worker's "what's due?" query
+            models.Index(
+                fields=["status", "next_attempt"], name="outbox_due_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} to {self.to_email} ({self.status})"
+
+
+class WebhookEvent(models.Model):
+    """A verified Stripe webhook event waiting in the inbox to be handled."""
+
+    PENDING = "pending"
+    PROCESSED = "processed"
+    DEAD = "dead"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSED, "Processed"),
+        (DEAD, "Dead"),
+    ]
+
+    event_id = models.CharField(max_length=254, unique=True)
+    event_type = models.CharField(max_length=254, null=False, blank=False)
+    payment_intent_id = models.CharField(
+        max_length=254, null=False, blank=True, default="", db_index=True
+    )
+    payload = models.TextField(null=False, blank=False)
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=PENDING
+    )
+    attempts = models.IntegerField(null=False, blank=False, default=0)
+    duplicates = models.IntegerField(null=False, blank=False, default=0)
+    last_error = models.TextField(null=False, blank=True, default="")
+    received = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # For the webhook worker's "what's due?" query
+            models.Index(
+                fields=["status", "next_attempt"], name="inbox_due_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} ({self.status})"
+
+
+class ProcessedEvent(models.Model):
+    """
+    A ledger entry for a Stripe event that's been handled.
+
+    Each event is handled once, and each payment intent succeeds once, however
+    many times Stripe delivers its events.
+    """
+
+    event_id = models.CharField(max_length=254, unique=True)
+    event_type = models.CharField(max_length=254, null=False, blank=False)
+    payment_intent_id = models.CharField(
+        max_length=254, null=False, blank=True, default=""
+    )
+    duplicates = models.IntegerField(null=False, blank=False, default=0)
+    processed = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["payment_intent_id"],
+                condition=models.Q(event_type="payment_intent.succeeded"),
+                name="unique_processed_payment_succeeded",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+
+def queue_email(subject, body, to_email):
+    """
+    Add an email to the outbox.
+
+    The email is sent later by the send_queued_emails worker, so the caller
+    never waits for the mail server.
+    """
+    return OutboundEmail.objects.create(
+        subject=" ".join(subject.split()),
+        body=body,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to_email=to_email,
+    )
+
+
+def send_queued_emails(batch_size):
+    """
+    Send a batch of due emails from the outbox over one mail connection.
+
+    Failed emails are retried with exponential backoff, until they've been
+    tried EMAIL_OUTBOX_MAX_ATTEMPTS times.
+
+    Return (tuple): The number of emails sent and the number that failed.
+    """
+    sent = failed = 0
+    emails = _claim_due_emails(batch_size)
+    if not emails:
+        return sent, failed
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+    except Exception as error:
+        for email in emails:
+            _record_failure(email, error)
+        return sent, len(emails)
+    try:
+        for email in emails:
+            if _send(email, mail_connection):
+                sent += 1
+            else:
+                failed += 1
+    finally:
+        mail_connection.close()
+    return sent, failed
+
+
+def _claim_due_emails(batch_size):
+    """
+    Claim a batch of due emails for this worker, oldest first.
+
+    The emails are marked as sending, with a lease of EMAIL_OUTBOX_LEASE
+    seconds, in a short transaction. They're sent after it commits, so no row
+    stays locked while the mail server is slow. If a worker dies while
+    sending, its emails are claimed again once their lease runs out.
+    """
+    now = timezone.now()
+    lease_expires = now + timedelta(seconds=settings.EMAIL_OUTBOX_LEASE)
+    with transaction.atomic():
+        emails = list(_due_emails(now)[:batch_size])
+        OutboundEmail.objects.filter(
+            pk__in=[email.pk for email in emails]
+        ).update(status=OutboundEmail.SENDING, next_attempt=lease_expires)
+    for email in emails:
+        email.status = OutboundEmail.SENDING
+        email.next_attempt = lease_expires
+    return emails
+
+
+def _due_emails(now):
+    """
+    Return the emails that are due to be sent, oldest first.
+
+    These are pending emails whose next attempt is due, and emails whose
+    sending lease has run out. Where the database supports it, the rows are
+    locked and rows locked by another worker are skipped, so several workers
+    can share the outbox.
+    """
+    emails = OutboundEmail.objects.filter(
+        status__in=[OutboundEmail.PENDING, OutboundEmail.SENDING],
+        next_attempt__lte=now,
+    ).order_by("next_attempt", "pk")
+    if connection.features.has_select_for_update_skip_locked:
+        emails = emails.select_for_update(skip_locked=True)
+    return emails
+
+
+def _send(email, mail_connection):
+    """
+    Send one email and record the result.
+
+    Return (bool): True if the email was sent.
+    """
+    message = EmailMessage(
+        email.subject,
+        email.body,
+        email.from_email,
+        [email.to_email],
+        connection=mail_connection,
+    )
+    try:
+        message.send()
+    except Exception as error:
+        _record_failure(email, error)
+        return False
+    email.attempts += 1
+    email.status = OutboundEmail.SENT
+    email.sent = timezone.now()
+    email.save()
+    return True
+
+
+def _record_failure(email, error):
+    """
+    Record a failed attempt to send an email.
+
+    The email is retried with exponential backoff, or marked as failed once
+    it's used up its attempts.
+    """
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+        email.status = OutboundEmail.FAILED
+    else:
+        email.status = OutboundEmail.PENDING
+        delay = settings.EMAIL_OUTBOX_RETRY_DELAY * 2 ** (email.attempts - 1)
+        email.next_attempt = timezone.now() + timedelta(seconds=delay)
+    email.save()
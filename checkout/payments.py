@@ -0,0 +1,154 @@
+"""
+Stripe PaymentIntents for the checkout page.
+
+Each session keeps one PaymentIntent, which is reused for as long as it can
+still be paid. Refreshing the checkout page with an unchanged bag only
+retrieves the intent to check its status. When the total changes, the same
+intent is updated, with the new amount and the new bag metadata in a single
+call. When only the bag metadata changes, the intent is retrieved to check
+it's unpaid before its metadata is updated.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+import stripe
+
+from bag.bags import serialize_bag
+from bag.contexts import request_bag_context
+
+from .stripe_client import stripe_client
+
+SESSION_KEY = "payment_intent"
+# A PaymentIntent in any other status has been paid, is being paid, or has
+# been cancelled, so a new one is needed
+REUSABLE_STATUSES = {
+    "requires_payment_method",
+    "requires_confirmation",
+    "requires_action",
+}
+
+
+def checkout_client_secret(request):
+    """
+    Return the client secret of the PaymentIntent for the current bag.
+
+    The amount is priced from the products in the database.
+    """
+    bag_context = request_bag_context(request, current_prices=True)
+    amount = round(bag_context["grand_total"] * 100)
+    bag = json.dumps(serialize_bag(bag_context.bag))
+    metadata = {"bag": bag, "username": request.user.username}
+    stored = request.session.get(SESSION_KEY)
+    if stored and _update_intent(request, stored, amount, metadata):
+        return stored["client_secret"]
+    intent = stripe_client().create_payment_intent(
+        {
+            "amount": amount,
+            "currency": settings.STRIPE_CURRENCY,
+            "metadata": metadata,
+        }
+    )
+    request.session[SESSION_KEY] = {
+        "id": intent.id,
+        "client_secret": intent.client_secret,
+        "amount": amount,
+        "fingerprint": _fingerprint(bag),
+        "metadata": {"username": metadata["username"]},
+    }
+    return intent.client_secret
+
+
+def update_payment_metadata(request, payment_id, metadata):
+    """
+    Update a PaymentIntent's metadata.
+
+    Stripe is only called if the metadata has changed since it was last sent
+    for the session's PaymentIntent, and only the changed values are sent.
+    """
+    stored = request.session.get(SESSION_KEY)
+    if not stored or stored["id"] != payment_id:
+        stripe_client().update_payment_intent(
+            payment_id, {"metadata": metadata}
+        )
+        return
+    changes = _changed_metadata(stored, metadata)
+    if changes:
+        stripe_client().update_payment_intent(
+            payment_id, {"metadata": changes}
+        )
+        _remember_metadata(request, stored, changes)
+
+
+def forget_payment_intent(request):
+    """Stop reusing the session's PaymentIntent, e.g. once it's been paid."""
+    request.session.pop(SESSION_KEY, None)
+
+
+def _update_intent(request, stored, amount, metadata):
+    """
+    Bring the session's PaymentIntent up to date with the bag.
+
+    Stripe accepts metadata changes for an intent that's already been paid,
+    and the webhook builds orders from that metadata. So when only the
+    metadata has changed, the intent is retrieved first, and only updated if
+    it can still be reused. Stripe refuses to change a paid intent's amount,
+    so a new amount is sent along with any metadata changes.
+
+    Return (bool): False if the intent can no longer be reused, for example
+    because it's been paid or cancelled.
+    """
+    changes = _changed_metadata(stored, metadata)
+    try:
+        if stored["amount"] != amount:
+            params = {"amount": amount}
+            if changes:
+                params["metadata"] = changes
+            intent = stripe_client().update_payment_intent(
+                stored["id"], params
+            )
+        else:
+            intent = stripe_client().retrieve_payment_intent(stored["id"])
+            if changes and intent.status in REUSABLE_STATUSES:
+                intent = stripe_client().update_payment_intent(
+                    stored["id"], {"metadata": changes}
+                )
+    except stripe.error.InvalidRequestError:
+        forget_payment_intent(request)
+        return False
+    if intent.status not in REUSABLE_STATUSES:
+        forget_payment_intent(request)
+        return False
+    if stored["amount"] != amount or changes:
+        stored["amount"] = amount
+        _remember_metadata(request, stored, changes)
+    return True
+
+
+def _changed_metadata(stored, metadata):
+    """Return the metadata values that differ from those already sent."""
+    changes = {}
+    for key, value in metadata.items():
+        if key == "bag":
+            if stored["fingerprint"] != _fingerprint(value):
+                changes[key] = value
+        elif stored["metadata"].get(key) != value:
+            changes[key] = value
+    return changes
+
+
+def _remember_metadata(request, stored, changes):
+    """Save the metadata sent to Stripe in the session."""
+    for key, value in changes.items():
+        if key == "bag":
+            stored["fingerprint"] = _fingerprint(value)
+        else:
+            stored["metadata"][key] = value
+    request.session[SESSION_KEY] = stored
+
+
+def _fingerprint(bag):
+    """Return a short fingerprint of a serialized bag."""
+    return hashlib.sha256(bag.encode("utf-8")).hexdigest()
+
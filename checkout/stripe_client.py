@@ -0,0 +1,289 @@
+"""
+The site's shared Stripe client.
+
+Every Stripe API call goes through one StripeClient per worker process. It
+reuses pooled keep-alive HTTP connections, applies a timeout to every call,
+retries transient failures within a retry budget, backing off exponentially
+with jitter between attempts, and stops calling Stripe
+for a while when it keeps failing, so checkout fails fast instead of tying up
+workers. Latency and error counters are kept for each operation.
+"""
+
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+import requests
+import stripe
+
+from boutique_ado.metrics import record_external_call
+
+# Errors worth retrying, which also count towards opening the circuit
+TRANSIENT_ERRORS = (stripe.error.APIConnectionError, stripe.error.APIError)
+
+
+class CircuitOpenError(stripe.error.StripeError):
+    """Raised instead of calling Stripe while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing service for a while.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are rejected. After reset_timeout seconds one trial call is let through;
+    if it succeeds the circuit closes again.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go ahead."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this call through as a trial
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class RetryBudget:
+    """
+    Limit retries to a fraction of recent calls.
+
+    Each call deposits ratio tokens, up to max_tokens, and each retry spends
+    one, so a Stripe outage can't multiply our traffic.
+    """
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Return True if there's budget for a retry, and spend it."""
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class StripeClient:
+    """Instrumented Stripe client shared by the checkout views and webhooks."""
+
+    def __init__(
+        self,
+        api_key,
+        api_base,
+        timeout,
+        max_retries,
+        retry_budget_ratio,
+        retry_backoff,
+        max_retry_backoff,
+        failure_threshold,
+        reset_timeout,
+    ):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=10)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.client = stripe.StripeClient(
+            api_key,
+            base_addresses={"api": api_base},
+            http_client=stripe.RequestsClient(
+                timeout=timeout, session=session
+            ),
+            max_network_retries=0,
+        )
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.retry_budget = RetryBudget(retry_budget_ratio, max_tokens=10)
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def create_payment_intent(self, params):
+        """Create a PaymentIntent."""
+        return self._call(
+            "payment_intent.create",
+            self.client.v1.payment_intents.create,
+            params,
+            idempotent=True,
+        )
+
+    def update_payment_intent(self, intent_id, params):
+        """Update a PaymentIntent."""
+        return self._call(
+            "payment_intent.update",
+            self.client.v1.payment_intents.update,
+            intent_id,
+            params,
+            idempotent=True,
+        )
+
+    def retrieve_payment_intent(self, intent_id):
+        """Retrieve a PaymentIntent."""
+        return self._call(
+            "payment_intent.retrieve",
+            self.client.v1.payment_intents.retrieve,
+            intent_id,
+        )
+
+    def retrieve_charge(self, charge_id):
+        """Retrieve a Charge."""
+        return self._call(
+            "charge.retrieve", self.client.v1.charges.retrieve, charge_id
+        )
+
+    def construct_event(self, payload, sig_header, secret):
+        """
+        Return a verified webhook event.
+
+        This checks the signature locally, so it never calls Stripe.
+        """
+        return self.client.construct_event(payload, sig_header, secret)
+
+    def _call(self, operation, method, *args, idempotent=False):
+        """
+        Call a Stripe API method through the circuit breaker.
+
+        POST requests reuse one idempotency key across retries, so a retried
+        create can't create twice.
+        """
+        if not self.circuit_breaker.allow():
+            self._record(operation, 0, error=True, rejected=True)
+            raise CircuitOpenError("Stripe is unavailable right now.")
+        options = {}
+        if idempotent:
+            options["idempotency_key"] = str(uuid.uuid4())
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                result = method(*args, options=options)
+            except TRANSIENT_ERRORS:
+                self._record(operation, time.perf_counter() - start, True)
+                self.circuit_breaker.record_failure()
+                attempt += 1
+                can_retry = (
+                    attempt <= self.max_retries
+                    and not self.circuit_breaker.is_open
+                    and self.retry_budget.withdraw()
+                )
+                if not can_retry:
+                    raise
+                self._record_retry(operation)
+                time.sleep(self._backoff(attempt))
+                continue
+            except stripe.error.StripeError:
+                # Stripe answered, so it's up, but rejected the request
+                self._record(operation, time.perf_counter() - start, True)
+                self.circuit_breaker.record_success()
+                raise
+            self._record(operation, time.perf_counter() - start, False)
+            self.circuit_breaker.record_success()
+            self.retry_budget.deposit()
+            return result
+
+    def _backoff(self, attempt):
+        """
+        Return the seconds to wait before a retry.
+
+        The wait doubles with each attempt, up to max_retry_backoff, and is
+        picked at random from zero up to that (full jitter), so workers
+        retrying at once don't all hit Stripe together.
+        """
+        ceiling = min(
+            self.max_retry_backoff, self.retry_backoff * 2 ** (attempt - 1)
+        )
+        return random.uniform(0, ceiling)
+
+    def _record(self, operation, latency, error, rejected=False):
+        """Add a call to the operation's counters."""
+        with self._stats_lock:
+            stats = self.stats.setdefault(operation, _empty_stats())
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["rejected"] += int(rejected)
+            stats["latency_seconds_total"] += latency
+            stats["latency_seconds_max"] = max(
+                stats["latency_seconds_max"], latency
+            )
+        if not rejected:
+            record_external_call("stripe", operation, latency)
+
+    def _record_retry(self, operation):
+        with self._stats_lock:
+            self.stats[operation]["retries"] += 1
+
+
+def stripe_client():
+    """Return the worker process's shared StripeClient."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = StripeClient(
+                api_key=settings.STRIPE_SECRET_KEY,
+                api_base=settings.STRIPE_API_BASE,
+                timeout=settings.STRIPE_TIMEOUT,
+                max_retries=settings.STRIPE_MAX_RETRIES,
+                retry_budget_ratio=settings.STRIPE_RETRY_BUDGET_RATIO,
+                retry_backoff=settings.STRIPE_RETRY_BACKOFF,
+                max_retry_backoff=settings.STRIPE_MAX_RETRY_BACKOFF,
+                failure_threshold=settings.STRIPE_CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=settings.STRIPE_CIRCUIT_RESET_TIMEOUT,
+            )
+        return _client
+
+
+def reset_stripe_client():
+    """Discard the shared StripeClient, e.g. after changing its settings."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def _empty_stats():
+    return {
+        "calls": 0,
+        "errors": 0,
+        "rejected": 0,
+        "retries": 0,
+        "latency_seconds_total": 0.0,
+        "latency_seconds_max": 0.0,
+    }
+
+
+_client = None
+_client_lock = threading.Lock()
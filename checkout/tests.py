@@ -1,3 +1,596 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import connection
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+import stripe
+
+from bag.bags import serialize_bag
+from boutique_ado.session_store import SessionStore
+from home.benchmark import offline_services, payment_succeeded_event
+from home.fake_stripe import FakeStripeHandler
+from products.models import Product
+from products.snapshots import clear_snapshots, product_snapshots
+
+from .inbox import process_events
+from .models import Order, OutboundEmail, ProcessedEvent, WebhookEvent
+from .outbox import queue_email, send_queued_emails
+from .payments import SESSION_KEY, checkout_client_secret
+from .stripe_client import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    StripeClient,
+)
+
+FROM_EMAIL = "orders@boutique-ado.test"
+INTENT = {"id": "pi_test", "object": "payment_intent", "status": "succeeded"}
+SERVER_ERROR = (500, {"error": {"type": "api_error", "message": "Oops"}})
+BAD_REQUEST = (
+    400,
+    {"error": {"type": "invalid_request_error", "message": "No such thing"}},
+)
+
+
+class FailingEmailBackend(EmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError("The mail server is down.")
+
+
+class StatusRecordingEmailBackend(EmailBackend):
+    statuses = []
+
+    def send_messages(self, messages):
+        self.statuses.extend(
+            OutboundEmail.objects.values_list("status", flat=True)
+        )
+        return super().send_messages(messages)
+
+
+@override_settings(DEFAULT_FROM_EMAIL=FROM_EMAIL)
+class OutboxTests(TestCase):
+    def test_sends_due_emails(self):
+        email = queue_email("Order  confirmed", "Thanks!", "shopper@test.com")
+
+        self.assertEqual(send_queued_emails(10), (1, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Order confirmed")
+        self.assertEqual(mail.outbox[0].to, ["shopper@test.com"])
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.SENT)
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.sent)
+
+    def test_does_not_send_emails_that_are_not_due(self):
+        email = queue_email("Order confirmed", "Thanks!", "shopper@test.com")
+        email.next_attempt = timezone.now() + timedelta(minutes=1)
+        email.save()
+
+        self.assertEqual(send_queued_emails(10), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_sends_at_most_one_batch(self):
+        for number in range(3):
+            queue_email(f"Email {number}", "Thanks!", "shopper@test.com")
+
+        self.assertEqual(send_queued_emails(2), (2, 0))
+
+        self.assertEqual(
+            [message.subject for message in mail.outbox],
+            ["Email 0", "Email 1"],
+        )
+
+    @override_settings(
+        EMAIL_BACKEND="checkout.tests.FailingEmailBackend",
+        EMAIL_OUTBOX_MAX_ATTEMPTS=2,
+    )
+    def test_retries_failed_emails_then_gives_up(self):
+        email = queue_email("Order confirmed", "Thanks!", "shopper@test.com")
+
+        self.assertEqual(send_queued_emails(10), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.PENDING)
+        self.assertEqual(email.attempts, 1)
+        self.assertGreater(email.next_attempt, timezone.now())
+        self.assertIn("The mail server is down.", email.last_error)
+
+        email.next_attempt = timezone.now()
+        email.save()
+        self.assertEqual(send_queued_emails(10), (0, 1))
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.FAILED)
+        self.assertEqual(email.attempts, 2)
+
+    @override_settings(
+        EMAIL_BACKEND="checkout.tests.StatusRecordingEmailBackend"
+    )
+    def test_claims_emails_before_sending_them(self):
+        queue_email("Order confirmed", "Thanks!", "shopper@test.com")
+        StatusRecordingEmailBackend.statuses = []
+
+        send_queued_emails(10)
+
+        self.assertEqual(
+            StatusRecordingEmailBackend.statuses, [OutboundEmail.SENDING]
+        )
+
+    def test_does_not_send_emails_claimed_by_another_worker(self):
+        email = queue_email("Order confirmed", "Thanks!", "shopper@test.com")
+        email.status = OutboundEmail.SENDING
+        email.next_attempt = timezone.now() + timedelta(minutes=5)
+        email.save()
+
+        self.assertEqual(send_queued_emails(10), (0, 0))
+        self.assertEqual(mail.outbox, [])
+
+    def test_sends_emails_whose_lease_has_run_out(self):
+        email = queue_email("Order confirmed", "Thanks!", "shopper@test.com")
+        email.status = OutboundEmail.SENDING
+        email.next_attempt = timezone.now() - timedelta(seconds=1)
+        email.save()
+
+        self.assertEqual(send_queued_emails(10), (1, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboundEmail.SENT)
+
+
+class OfflineServicesMixin:
+    """Send Stripe calls to the fake Stripe server, and emails to memory."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.services = offline_services()
+        cls.services.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.services.__exit__(None, None, None)
+        super().tearDownClass()
+
+
+class PaymentIntentTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        clear_snapshots()
+        self.product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+        self.session = SessionStore()
+        self.set_quantity(1)
+
+    def set_quantity(self, quantity, size=""):
+        self.session["bag"] = serialize_bag(
+            {str(self.product.pk): {size: quantity}}
+        )
+
+    def client_secret(self):
+        request = RequestFactory().get("/checkout/")
+        request.session = self.session
+        request.user = AnonymousUser()
+        return checkout_client_secret(request)
+
+    def stored_intent(self):
+        return FakeStripeHandler.intents[self.session[SESSION_KEY]["id"]]
+
+    def test_creates_an_intent_for_the_bag(self):
+        self.client_secret()
+
+        intent = self.stored_intent()
+        self.assertEqual(intent["status"], "requires_payment_method")
+        self.assertEqual(intent["amount"], self.session[SESSION_KEY]["amount"])
+
+    def test_reuses_the_intent_while_the_bag_is_unchanged(self):
+        client_secret = self.client_secret()
+
+        self.assertEqual(self.client_secret(), client_secret)
+
+    def test_updates_the_intent_when_the_bag_changes(self):
+        client_secret = self.client_secret()
+        amount = self.stored_intent()["amount"]
+
+        self.set_quantity(2)
+
+        self.assertEqual(self.client_secret(), client_secret)
+        self.assertGreater(self.stored_intent()["amount"], amount)
+        self.assertEqual(
+            self.session[SESSION_KEY]["amount"],
+            self.stored_intent()["amount"],
+        )
+
+    def test_replaces_an_intent_that_has_been_paid(self):
+        client_secret = self.client_secret()
+        self.stored_intent()["status"] = "succeeded"
+
+        self.assertNotEqual(self.client_secret(), client_secret)
+        self.assertEqual(
+            self.stored_intent()["status"], "requires_payment_method"
+        )
+
+    def test_replaces_a_paid_intent_when_the_bag_changes(self):
+        client_secret = self.client_secret()
+        self.stored_intent()["status"] = "succeeded"
+
+        self.set_quantity(2)
+
+        self.assertNotEqual(self.client_secret(), client_secret)
+
+    def test_leaves_the_metadata_of_a_paid_intent_alone(self):
+        client_secret = self.client_secret()
+        self.stored_intent()["status"] = "succeeded"
+        paid_metadata = dict(self.stored_intent()["metadata"])
+
+        # The same total, so only the bag metadata changes
+        self.set_quantity(1, size="m")
+
+        self.assertNotEqual(self.client_secret(), client_secret)
+        paid_id = client_secret.split("_secret")[0]
+        self.assertEqual(
+            FakeStripeHandler.intents[paid_id]["metadata"], paid_metadata
+        )
+
+    def test_updates_the_metadata_of_an_unpaid_intent(self):
+        client_secret = self.client_secret()
+
+        self.set_quantity(1, size="m")
+
+        self.assertEqual(self.client_secret(), client_secret)
+        self.assertEqual(
+            self.stored_intent()["metadata"]["bag"],
+            json.dumps(self.session["bag"]),
+        )
+
+    def test_reuses_an_intent_that_still_needs_action(self):
+        client_secret = self.client_secret()
+        self.stored_intent()["status"] = "requires_action"
+
+        self.assertEqual(self.client_secret(), client_secret)
+
+    def test_charges_the_current_price_rather_than_a_snapshot(self):
+        product_snapshots([self.product.pk])
+        # A bulk update doesn't bump the catalogue version
+        Product.objects.filter(pk=self.product.pk).update(price=30)
+
+        self.client_secret()
+
+        self.assertEqual(self.stored_intent()["amount"], 3300)
+
+
+def inbox_event(key, product, **fields):
+    """Add a payment_intent.succeeded event to the inbox."""
+    fields = {"payment_intent_id": f"pi_bench_{key}", **fields}
+    return WebhookEvent.objects.create(
+        event_id=f"evt_bench_{key}",
+        event_type="payment_intent.succeeded",
+        payload=payment_succeeded_event(key, product.pk),
+        **fields,
+    )
+
+
+@override_settings(DEFAULT_FROM_EMAIL=FROM_EMAIL)
+class InboxTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        clear_snapshots()
+        self.product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+
+    def test_creates_an_order_for_a_successful_payment(self):
+        event = inbox_event("paid", self.product)
+
+        self.assertEqual(process_events(10), (1, 0))
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.PROCESSED)
+        order = Order.objects.get(stripe_pid="pi_bench_paid")
+        self.assertEqual(order.lineitems.get().product, self.product)
+
+    def test_prices_line_items_from_the_database(self):
+        product_snapshots([self.product.pk])
+        Product.objects.filter(pk=self.product.pk).update(price=30)
+        inbox_event("paid", self.product)
+
+        process_events(10)
+
+        order = Order.objects.get(stripe_pid="pi_bench_paid")
+        self.assertEqual(order.lineitems.get().lineitem_total, 30)
+
+    def test_skips_events_waiting_on_an_earlier_event(self):
+        retrying = inbox_event(
+            "retrying",
+            self.product,
+            next_attempt=timezone.now() + timedelta(minutes=5),
+        )
+        waiting = inbox_event(
+            "waiting", self.product, payment_intent_id="pi_bench_retrying"
+        )
+        inbox_event("other", self.product)
+
+        # The waiting event mustn't take up the batch
+        self.assertEqual(process_events(1), (1, 0))
+
+        self.assertTrue(Order.objects.filter(stripe_pid="pi_bench_other"))
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, WebhookEvent.PENDING)
+        self.assertEqual(waiting.attempts, 0)
+
+        # Once the earlier event is processed, the waiting one is due
+        retrying.next_attempt = timezone.now()
+        retrying.save()
+        self.assertEqual(process_events(10), (1, 0))
+        self.assertEqual(process_events(10), (1, 0))
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, WebhookEvent.PROCESSED)
+
+    def test_counts_a_redelivery_against_its_own_ledger_entry(self):
+        for event_id in ("evt_refund_1", "evt_refund_2"):
+            ProcessedEvent.objects.create(
+                event_id=event_id, event_type="charge.refunded"
+            )
+        event = WebhookEvent.objects.create(
+            event_id="evt_refund_1", event_type="charge.refunded", payload="{}"
+        )
+
+        self.assertEqual(process_events(10), (1, 0))
+
+        event.refresh_from_db()
+        self.assertEqual(event.status, WebhookEvent.PROCESSED)
+        self.assertEqual(
+            dict(ProcessedEvent.objects.values_list("event_id", "duplicates")),
+            {"evt_refund_1": 1, "evt_refund_2": 0},
+        )
+
+
+@override_settings(DEFAULT_FROM_EMAIL=FROM_EMAIL)
+class InboxTransactionTests(OfflineServicesMixin, TransactionTestCase):
+    def test_calls_stripe_outside_the_transaction(self):
+        product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+        inbox_event("paid", product)
+        retrieve_charge = StripeClient.retrieve_charge
+        in_transaction = []
+
+        def record_transaction(client, charge_id):
+            in_transaction.append(connection.in_atomic_block)
+            return retrieve_charge(client, charge_id)
+
+        with mock.patch.object(
+            StripeClient, "retrieve_charge", record_transaction
+        ):
+            self.assertEqual(process_events(10), (1, 0))
+
+        self.assertEqual(in_transaction, [False])
+
+
+class StubHTTPClient(stripe.HTTPClient):
+    """Answer Stripe requests with canned responses, in order."""
+
+    name = "stub"
+
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers, post_data=None, **kwargs):
+        self.requests.append((method, url, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, body = response
+        return json.dumps(body), status, {}
+
+
+def stub_stripe_client(responses, **options):
+    """Return a StripeClient whose requests go to a StubHTTPClient."""
+    options = {
+        "api_key": "sk_test_stub",
+        "api_base": "https://api.stripe.test",
+        "timeout": 1,
+        "max_retries": 2,
+        "retry_budget_ratio": 0.1,
+        "retry_backoff": 0,
+        "max_retry_backoff": 0,
+        "failure_threshold": 5,
+        "reset_timeout": 30,
+        **options,
+    }
+    client = StripeClient(**options)
+    http_client = StubHTTPClient(responses)
+    client.client = stripe.StripeClient(
+        options["api_key"],
+        base_addresses={"api": options["api_base"]},
+        http_client=http_client,
+        max_network_retries=0,
+    )
+    return client, http_client
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+
+        self.assertFalse(breaker.is_open)
+
+    @mock.patch("checkout.stripe_client.time.monotonic")
+    def test_lets_one_trial_call_through_after_the_reset_timeout(
+        self, monotonic
+    ):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        monotonic.return_value = 100
+        breaker.record_failure()
+
+        monotonic.return_value = 129
+        self.assertFalse(breaker.allow())
+        monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    @mock.patch("checkout.stripe_client.time.monotonic")
+    def test_reopens_if_the_trial_call_fails(self, monotonic):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        monotonic.return_value = 100
+        breaker.record_failure()
+        monotonic.return_value = 130
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+
+        monotonic.return_value = 159
+        self.assertFalse(breaker.allow())
+        monotonic.return_value = 160
+        self.assertTrue(breaker.allow())
+
+
+class RetryBudgetTests(SimpleTestCase):
+    def test_starts_full_and_spends_one_token_per_retry(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_each_call_deposits_the_ratio(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+        budget.tokens = 0
+
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_never_holds_more_than_max_tokens(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=2)
+
+        for _ in range(10):
+            budget.deposit()
+
+        self.assertEqual(budget.tokens, 2)
+
+
+class StripeClientTests(SimpleTestCase):
+    def test_returns_the_result(self):
+        client, http_client = stub_stripe_client([(200, INTENT)])
+
+        intent = client.retrieve_payment_intent("pi_test")
+
+        self.assertEqual(intent.status, "succeeded")
+        self.assertEqual(len(http_client.requests), 1)
+        self.assertEqual(client.stats["payment_intent.retrieve"]["calls"], 1)
+
+    def test_retries_transient_errors_with_the_same_idempotency_key(self):
+        client, http_client = stub_stripe_client(
+            [
+                stripe.error.APIConnectionError("Connection reset"),
+                SERVER_ERROR,
+                (200, INTENT),
+            ]
+        )
+
+        client.update_payment_intent("pi_test", {"amount": 100})
+
+        keys = {
+            headers["Idempotency-Key"]
+            for _, _, headers in http_client.requests
+        }
+        self.assertEqual(len(http_client.requests), 3)
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(client.stats["payment_intent.update"]["retries"], 2)
+        self.assertFalse(client.circuit_breaker.is_open)
+
+    def test_gives_up_after_max_retries(self):
+        client, http_client = stub_stripe_client(
+            [SERVER_ERROR, SERVER_ERROR], max_retries=1
+        )
+
+        with self.assertRaises(stripe.error.APIError):
+            client.retrieve_payment_intent("pi_test")
+        self.assertEqual(len(http_client.requests), 2)
+
+    def test_does_not_retry_rejected_requests(self):
+        client, http_client = stub_stripe_client([BAD_REQUEST])
+
+        with self.assertRaises(stripe.error.InvalidRequestError):
+            client.retrieve_payment_intent("pi_missing")
+        self.assertEqual(len(http_client.requests), 1)
+        self.assertEqual(client.circuit_breaker.failures, 0)
+
+    def test_stops_retrying_when_the_budget_is_spent(self):
+        client, http_client = stub_stripe_client([SERVER_ERROR, (200, INTENT)])
+        client.retry_budget.tokens = 0
+
+        with self.assertRaises(stripe.error.APIError):
+            client.retrieve_payment_intent("pi_test")
+        self.assertEqual(len(http_client.requests), 1)
+
+    def test_rejects_calls_without_calling_stripe_while_open(self):
+        client, http_client = stub_stripe_client(
+            [SERVER_ERROR, SERVER_ERROR], failure_threshold=2
+        )
+        with self.assertRaises(stripe.error.APIError):
+            client.retrieve_payment_intent("pi_test")
+        self.assertTrue(client.circuit_breaker.is_open)
+
+        with self.assertRaises(CircuitOpenError):
+            client.retrieve_payment_intent("pi_test")
+        self.assertEqual(len(http_client.requests), 2)
+        self.assertEqual(
+            client.stats["payment_intent.retrieve"]["rejected"], 1
+        )
+
+    @mock.patch("checkout.stripe_client.time.sleep")
+    @mock.patch("checkout.stripe_client.random.uniform")
+    def test_backs_off_exponentially_with_jitter(self, uniform, sleep):
+        uniform.side_effect = lambda low, high: high / 2
+        client, http_client = stub_stripe_client(
+            [SERVER_ERROR] * 4 + [(200, INTENT)],
+            max_retries=4,
+            retry_backoff=0.2,
+            max_retry_backoff=0.5,
+        )
+
+        client.retrieve_payment_intent("pi_test")
+
+        self.assertEqual(
+            [call.args for call in uniform.call_args_list],
+            [(0, 0.2), (0, 0.4), (0, 0.5), (0, 0.5)],
+        )
+        self.assertEqual(
+            [call.args for call in sleep.call_args_list],
+            [(0.1,), (0.2,), (0.25,), (0.25,)],
+        )
@@ -3,6 +3,7 @@ import json
 
 from django.conf import settings
 from django.contrib import messages
+from django.db import IntegrityError, transaction
 from django.shortcuts import (
     get_object_or_404,
     HttpResponse,
@@ -13,8 +14,8 @@ from django.shortcuts import (
 from django.views.decorators.http import require_POST
 import stripe
 
-from bag.contexts import bag_contents
-from products.models import Product
+from bag.bags import serialize_bag
+from bag.contexts import invalidate_bag_context, request_bag_context
 from profiles.forms import UserProfileForm
 from profiles.models import UserProfile
 
@@ -26,7 +27,12 @@ from .checkout_messages import (
     product_error_message,
 )
 from .forms import OrderForm
-from .models import Order, OrderLineItem  # noqa: F401
+from .models import Order
+from .payments import (
+    checkout_client_secret,
+    forget_payment_intent,
+    update_payment_metadata,
+)
 
 
 def checkout(request):
@@ -34,7 +40,8 @@ def checkout(request):
     if request.method == "POST":
         response = _save_order(request)
         return response
-    bag_is_empty = not request.session.get("bag")
+    # Show the totals the customer will be charged, not product snapshots
+    bag_is_empty = not request_bag_context(request, current_prices=True).bag
     if bag_is_empty:
         messages.error(request, empty_bag_error_message())
         return redirect(reverse("products"))
@@ -62,46 +69,49 @@ def checkout(request):
     else:
         order_form = OrderForm()
 
+    try:
+        client_secret = checkout_client_secret(request)
+    except stripe.error.StripeError:
+        messages.error(request, payment_error_message())
+        return redirect(reverse("view_bag"))
+
     context = {
         "order_form": order_form,
         "stripe_public_key": settings.STRIPE_PUBLIC_KEY,
-        "client_secret": _payment_intent(request).client_secret,
+        "client_secret": client_secret,
     }
     template = "checkout/checkout.html"
     return render(request, template, context)
 
 
-def _payment_intent(request):
-    """Return a Stripe payment intent for the current bag."""
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-    grand_total_in_subunits = round(bag_contents(request)["grand_total"] * 100)
-    intent = stripe.PaymentIntent.create(
-        amount=grand_total_in_subunits, currency=settings.STRIPE_CURRENCY
-    )
-    return intent
-
-
 def _save_order(request):
     """
     Save an order from a post request.
 
+    The order and its line items are saved in one transaction, so the Stripe
+    webhook never sees a partly saved order. If the webhook already saved the
+    order for this payment, that order is used instead.
+
+    The line items are priced from the products in the database.
+
     Return (HTTPRedirectResponse): Redirect user to the next page.
     """
-    bag = request.session.get("bag", {})
+    bag_context = request_bag_context(request, current_prices=True)
     order_form = OrderForm(_order_form_data(request))
     if order_form.is_valid():
+        if bag_context.has_missing_products():
+            messages.error(request, product_error_message())
+            return redirect(reverse("view_bag"))
         order = order_form.save(commit=False)
         pid = request.POST.get("client_secret").split("_secret")[0]
         order.stripe_pid = pid
-        order.original_bag = json.dumps(bag)
-        order.save()
-        for item_id, item_data in bag.items():
-            try:
-                _add_order_line_item(order, item_id, item_data)
-            except Product.DoesNotExist:
-                order.delete()
-                messages.error(request, product_error_message())
-                return redirect(reverse("view_bag"))
+        order.original_bag = json.dumps(serialize_bag(bag_context.bag))
+        try:
+            with transaction.atomic():
+                order.save()
+                order.add_line_items(bag_context["bag_items"])
+        except IntegrityError:
+            order = get_object_or_404(Order, stripe_pid=pid)
         request.session["save_info"] = "save-info" in request.POST
         return redirect(reverse("checkout_success", args=[order.order_number]))
     else:
@@ -109,27 +119,6 @@ def _save_order(request):
         return redirect(reverse("view_bag"))
 
 
-def _add_order_line_item(order, item_id, item_data):
-    """Add an order line item to the order."""
-    product = Product.objects.get(id=item_id)
-    if isinstance(item_data, int):
-        order_line_item = OrderLineItem(
-            order=order,
-            product=product,
-            quantity=item_data,
-        )
-        order_line_item.save()
-    else:
-        for size, quantity in item_data["items_by_size"].items():
-            order_line_item = OrderLineItem(
-                order=order,
-                product=product,
-                quantity=quantity,
-                product_size=size,
-            )
-            order_line_item.save()
-
-
 def _order_form_data(request):
     """Return a dict of form data extracted from the post request."""
     return {
@@ -148,7 +137,10 @@ def _order_form_data(request):
 def checkout_success(request, order_number):
     """Handle successful checkouts."""
     save_info = request.session.get("save_info")
-    order = get_object_or_404(Order, order_number=order_number)
+    order = get_object_or_404(
+        Order.objects.prefetch_related("lineitems__product"),
+        order_number=order_number,
+    )
 
     if request.user.is_authenticated:
         # Attach the user's profile to the order
@@ -173,6 +165,8 @@ def checkout_success(request, order_number):
 
     messages.success(request, order_success_message(order))
     request.session.pop("bag", None)
+    invalidate_bag_context(request)
+    forget_payment_intent(request)
     return render(request, "checkout/checkout_success.html", {"order": order})
 
 
@@ -181,11 +175,13 @@ def cache_checkout_data(request):
     """Cache data when the checkout form is submitted."""
     try:
         payment_id = request.POST.get("client_secret").split("_secret")[0]
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        stripe.PaymentIntent.modify(
+        update_payment_metadata(
+            request,
             payment_id,
-            metadata={
-                "bag": json.dumps(request.session.get("bag", {})),
+            {
+                "bag": json.dumps(
+                    serialize_bag(request_bag_context(request).bag)
+                ),
                 "save_info": request.POST.get("save_info"),
                 "username": request.user.username,
             },
@@ -1,27 +1,36 @@
 from http import HTTPStatus
 import json
-import time
 
 from django.conf import settings
-from django.core.mail import send_mail
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
 from django.template.loader import render_to_string
-import stripe
 
+from bag.bags import parse_bag
+from bag.contexts import compute_bag_context, current_bag_products
 from profiles.models import UserProfile
 
-from .models import Order, OrderLineItem
+from .models import Order
+from .outbox import queue_email
+from .stripe_client import stripe_client
 from products.models import Product
 
 
 class StripeWH_Handler:
     """Handle Stripe webhooks."""
 
-    def __init__(self, request):
+    def __init__(self, request, charges=None):
         self.request = request
+        # Stripe charges already retrieved, by ID
+        self.charges = charges or {}
 
     def _send_confirmation_email(self, order):
-        """Send a confirmation email to the user."""
+        """
+        Queue a confirmation email to the user.
+
+        The email is sent by the send_queued_emails worker, so a slow mail
+        server can't hold up the webhook response.
+        """
         template = "checkout/emails/confirmation_email_subject.txt"
         context = {"order": order}
         email_subject = render_to_string(template, context)
@@ -31,13 +40,7 @@ class StripeWH_Handler:
             "contact_email": settings.DEFAULT_FROM_EMAIL,
         }
         email_body = render_to_string(template, context)
-        to_email = order.email
-        send_mail(
-            email_subject,
-            email_body,
-            settings.DEFAULT_FROM_EMAIL,
-            [to_email],
-        )
+        queue_email(email_subject, email_body, order.email)
 
     def handle_other_event(self, event):
         """Handle a generic, unknown or unexpected webhook event."""
@@ -51,7 +54,19 @@ class StripeWH_Handler:
         intent = event.data.object
         pi_id = intent.id
         bag = intent.metadata.bag
-        stripe_charge = stripe.Charge.retrieve(intent.latest_charge)
+
+        # The checkout view usually saves the order first. If it's saving the
+        # order right now, the unique stripe_pid makes the insert below wait
+        # for it in the database, then fail with an IntegrityError.
+        order = Order.objects.filter(stripe_pid=pi_id).first()
+        if order:
+            return self._order_exists_response(event, order)
+
+        stripe_charge = self.charges.get(intent.latest_charge)
+        if stripe_charge is None:
+            stripe_charge = stripe_client().retrieve_charge(
+                intent.latest_charge
+            )
         billing_details = stripe_charge.billing_details
         shipping_details = intent.shipping
         grand_total = round(stripe_charge.amount / 100, 2)
@@ -81,41 +96,8 @@ class StripeWH_Handler:
                 )
                 profile.default_county = shipping_details.address.state
 
-        order_exists = False
-        attempt = 1
-        MAX_ATTEMPTS = 5
-        while attempt <= MAX_ATTEMPTS:
-            try:
-                order = Order.objects.get(
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pi_id,
-                )
-                order_exists = True
-                break
-            except Order.DoesNotExist:
-                attempt += 1
-                ONE_SECOND = 1
-                time.sleep(ONE_SECOND)
-        if order_exists:
-            self._send_confirmation_email(order)
-            response_message = (
-                f"Webhook received: {event["type"]} | "
-                "SUCCESS: Verified order already in database"
-            )
-            return HttpResponse(content=response_message, status=HTTPStatus.OK)
-        else:
-            order = None
-            try:
+        try:
+            with transaction.atomic():
                 order = Order.objects.create(
                     full_name=shipping_details.name,
                     user_profile=profile,
@@ -131,33 +113,15 @@ class StripeWH_Handler:
                     original_bag=bag,
                     stripe_pid=pi_id,
                 )
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data[
-                            "items_by_size"
-                        ].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-            except Exception as e:
-                if order:
-                    order.delete()
-                content = f'Webhook received: {event["type"]} | ERROR: {e}'
-                return HttpResponse(
-                    content=content, status=HTTPStatus.INTERNAL_SERVER_ERROR
-                )
+                order.add_line_items(self._bag_items(bag))
+        except IntegrityError:
+            order = Order.objects.get(stripe_pid=pi_id)
+            return self._order_exists_response(event, order)
+        except Exception as e:
+            content = f'Webhook received: {event["type"]} | ERROR: {e}'
+            return HttpResponse(
+                content=content, status=HTTPStatus.INTERNAL_SERVER_ERROR
+            )
         self._send_confirmation_email(order)
         return HttpResponse(
             content=(
@@ -167,6 +131,31 @@ class StripeWH_Handler:
             status=HTTPStatus.OK,
         )
 
+    def _bag_items(self, bag):
+        """
+        Return the bag context items for a bag from the payment metadata.
+
+        The items are priced from the products in the database, never from
+        product snapshots. Raise Product.DoesNotExist if a product in the bag
+        isn't in the database.
+        """
+        bag = parse_bag(json.loads(bag))
+        products = current_bag_products(bag)
+        if len(products) < len(bag):
+            raise Product.DoesNotExist(
+                "Product matching query does not exist."
+            )
+        return compute_bag_context(bag, products)["bag_items"]
+
+    def _order_exists_response(self, event, order):
+        """Confirm an order that was already saved by the checkout view."""
+        self._send_confirmation_email(order)
+        response_message = (
+            f"Webhook received: {event["type"]} | "
+            "SUCCESS: Verified order already in database"
+        )
+        return HttpResponse(content=response_message, status=HTTPStatus.OK)
+
     def handle_payment_failed(self, event):
         """Handle Stripe's payment_intent.payment_failed event."""
         return HttpResponse(
@@ -0,0 +1,381 @@
+"""
+An in-process load and latency benchmark for the storefront's hot views.
+
+Each run seeds a synthetic catalogue and order history of a given size into
+a throwaway test database, then drives the views through the WSGI handler
+with several concurrent clients. Stripe is replaced by a fake API server on
+localhost and emails go to the in-memory backend, so nothing leaves the
+machine.
+"""
+
+import hashlib
+import hmac
+import itertools
+import json
+import math
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    teardown_databases,
+)
+
+from bag.bags import serialize_bag
+from checkout.stripe_client import reset_stripe_client
+from products.models import Product
+
+from .fake_stripe import BILLING_EMAIL, start_fake_stripe
+from .seeding import CATEGORIES, seed_store
+
+# Words that appear in the seeded products' names and descriptions
+WORDS = (
+    "classic", "cotton", "denim", "linen", "wool", "slim", "relaxed",
+    "striped", "vintage", "navy", "olive", "shirt", "jeans", "hoodie",
+    "joggers", "towel", "mug", "machine", "stitching",
+)
+SORTS = (
+    ("price", "asc"),
+    ("price", "desc"),
+    ("rating", "desc"),
+    ("name", "asc"),
+    ("category", "asc"),
+)
+USERS = 10
+BAG_ITEMS = 5
+WEBHOOK_SECRET = "whsec_benchmark"
+ORDER_FORM = {
+    "full_name": "Bench Mark",
+    "email": BILLING_EMAIL,
+    "phone_number": "01234567890",
+    "country": "GB",
+    "postcode": "AB1 2CD",
+    "town_or_city": "London",
+    "street_address1": "1 High Street",
+    "street_address2": "",
+    "county": "",
+}
+
+
+def run_benchmark(sizes, clients, requests, seed=0, views=None, log=None):
+    """
+    Benchmark the hot views at each catalogue size.
+
+    Return (dict): The results, ready to be dumped as JSON.
+    """
+    log = log or (lambda message: None)
+    results = {
+        "clients": clients,
+        "requests_per_view": requests,
+        "seed": seed,
+        "database": connection.vendor,
+        "runs": [],
+    }
+    with offline_services():
+        for size in sizes:
+            results["runs"].append(
+                _run_size(size, clients, requests, seed, views, log)
+            )
+    return results
+
+
+@contextmanager
+def offline_services():
+    """
+    Send Stripe calls to a fake local server, and emails to memory.
+
+    The cache is swapped for an in-memory one, so a run neither reads nor
+    pollutes the live cache. Static files are served without a manifest, so
+    pages render with DEBUG off even if collectstatic hasn't been run.
+    """
+    server, stripe_url = start_fake_stripe()
+    overrides = override_settings(
+        ALLOWED_HOSTS=["testserver"],
+        CACHES={
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            },
+        },
+        EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+        STATICFILES_STORAGE=(
+            "django.contrib.staticfiles.storage.StaticFilesStorage"
+        ),
+        STRIPE_API_BASE=stripe_url,
+        STRIPE_SECRET_KEY="sk_test_benchmark",
+        STRIPE_WH_SECRET=WEBHOOK_SECRET,
+    )
+    try:
+        with overrides:
+            reset_stripe_client()
+            yield
+    finally:
+        reset_stripe_client()
+        server.shutdown()
+
+
+def percentile(sorted_values, percent):
+    """Return a percentile of sorted values, using the nearest rank."""
+    if not sorted_values:
+        return None
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def _run_size(size, clients, requests, seed, views, log):
+    """Seed a fresh database with size products and benchmark every view."""
+    with tempfile.TemporaryDirectory() as directory:
+        _use_file_test_databases(directory)
+        old_config = setup_databases(
+            verbosity=0, interactive=False, aliases=set(connections)
+        )
+        try:
+            log(f"Seeding {size} products...")
+            start = time.perf_counter()
+            catalogue = seed_catalogue(size, seed, log)
+            seed_seconds = time.perf_counter() - start
+            run = {
+                "products": size,
+                "orders": catalogue["orders"],
+                "seed_seconds": round(seed_seconds, 3),
+                "views": {},
+            }
+            for name, scenario in _scenarios(catalogue, size).items():
+                if views and name not in views:
+                    continue
+                log(f"Benchmarking {name} with {size} products...")
+                run["views"][name] = _run_scenario(scenario, clients, requests)
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+    return run
+
+
+def seed_catalogue(size, seed, log):
+    """
+    Seed a store of size products, with USERS customers and their orders.
+
+    The store is seeded by seed_store in this process, as worker processes
+    would connect to the configured database rather than the test one.
+
+    Return (dict): The seeded product IDs, the IDs of products with sizes,
+    the category names and the number of orders.
+    """
+    created = seed_store(
+        seed, size, USERS, max(size // 100, USERS), workers=1, log=log
+    )
+    products = list(Product.objects.values_list("pk", "has_sizes"))
+    return {
+        "product_ids": [pk for pk, _ in products],
+        "sized_ids": [pk for pk, has_sizes in products if has_sizes],
+        "categories": list(CATEGORIES),
+        "orders": created["orders"],
+    }
+
+
+def _scenarios(catalogue, size):
+    """
+    Return the benchmark scenarios, by view name.
+
+    Each scenario has an optional untimed setup, run once per client, an
+    optional untimed prepare, run before each request, and the timed
+    request. Each is called with the client and the request number.
+    """
+    product_ids = catalogue["product_ids"]
+    sized_ids = set(catalogue["sized_ids"])
+    categories = catalogue["categories"]
+
+    def fill_bag(client, number):
+        bag = {}
+        for pk in random.Random(number).sample(product_ids, BAG_ITEMS):
+            bag[pk] = {"m" if pk in sized_ids else "": 1}
+        session = client.session
+        session["bag"] = serialize_bag(bag)
+        session.save()
+
+    def start_checkout(client, number):
+        fill_bag(client, number)
+        client.get("/checkout/")
+
+    def place_order(client, number):
+        secret = client.session["payment_intent"]["client_secret"]
+        return client.post(
+            "/checkout/", {**ORDER_FORM, "client_secret": secret}
+        )
+
+    def webhook(client, number):
+        pk = product_ids[number % len(product_ids)]
+        payload = payment_succeeded_event(f"{size}_{number}", pk)
+        return client.post(
+            "/checkout/wh/",
+            payload,
+            content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=stripe_signature(payload),
+        )
+
+    return {
+        "all_products": _scenario(lambda c, n: c.get("/products/")),
+        "all_products_search": _scenario(
+            lambda c, n: c.get("/products/", {"q": WORDS[n % len(WORDS)]})
+        ),
+        "all_products_sort": _scenario(
+            lambda c, n: c.get(
+                "/products/",
+                dict(zip(("sort", "direction"), SORTS[n % len(SORTS)])),
+            )
+        ),
+        "all_products_category": _scenario(
+            lambda c, n: c.get(
+                "/products/", {"category": categories[n % len(categories)]}
+            )
+        ),
+        "product_detail": _scenario(
+            lambda c, n: c.get(
+                f"/products/{product_ids[(n * 7919) % len(product_ids)]}/"
+            )
+        ),
+        "view_bag": _scenario(lambda c, n: c.get("/bag/"), setup=fill_bag),
+        "checkout_get": _scenario(
+            lambda c, n: c.get("/checkout/"), setup=fill_bag
+        ),
+        "checkout_post": _scenario(
+            place_order, prepare=start_checkout, expected=302
+        ),
+        "webhook": _scenario(webhook),
+    }
+
+
+def _scenario(request, setup=None, prepare=None, expected=200):
+    return {
+        "request": request,
+        "setup": setup,
+        "prepare": prepare,
+        "expected": expected,
+    }
+
+
+def _run_scenario(scenario, clients, requests):
+    """
+    Send requests to a view from concurrent clients.
+
+    Return (dict): The view's throughput and latency percentiles. The wall
+    time, and so the throughput, includes any untimed prepare steps.
+    """
+    numbers = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client_loop(client_number):
+        client = Client(raise_request_exception=False)
+        try:
+            if scenario["setup"]:
+                scenario["setup"](client, client_number)
+            while True:
+                with lock:
+                    number = next(numbers)
+                if number >= requests:
+                    return
+                if scenario["prepare"]:
+                    scenario["prepare"](client, number)
+                start = time.perf_counter()
+                response = scenario["request"](client, number)
+                latency = time.perf_counter() - start
+                with lock:
+                    latencies.append(latency)
+                    if response.status_code != scenario["expected"]:
+                        errors.append(response.status_code)
+        finally:
+            connections.close_all()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for future in [
+            executor.submit(client_loop, number) for number in range(clients)
+        ]:
+            future.result()
+    wall_seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "error_statuses": sorted(set(errors)),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 1),
+        "mean_ms": _ms(sum(latencies) / len(latencies)),
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "max_ms": _ms(latencies[-1]),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def _use_file_test_databases(directory):
+    """
+    Put SQLite test databases in files, rather than in memory.
+
+    An in-memory database would flatter the results, and can't be shared
+    between the client threads.
+    """
+    for alias in connections:
+        settings_dict = connections[alias].settings_dict
+        if settings_dict["ENGINE"] == "django.db.backends.sqlite3":
+            settings_dict["TEST"]["NAME"] = f"{directory}/{alias}.sqlite3"
+            settings_dict.setdefault("OPTIONS", {})["timeout"] = 30
+
+
+def payment_succeeded_event(key, product_id):
+    """Return the JSON payload of a payment_intent.succeeded event."""
+    bag = json.dumps(serialize_bag({str(product_id): {"": 1}}))
+    return json.dumps(
+        {
+            "id": f"evt_bench_{key}",
+            "object": "event",
+            "type": "payment_intent.succeeded",
+            "data": {
+                "object": {
+                    "id": f"pi_bench_{key}",
+                    "object": "payment_intent",
+                    "latest_charge": f"ch_bench_{key}",
+                    "metadata": {
+                        "bag": bag,
+                        "save_info": "",
+                        "username": "AnonymousUser",
+                    },
+                    "shipping": {
+                        "name": ORDER_FORM["full_name"],
+                        "phone": ORDER_FORM["phone_number"],
+                        "address": {
+                            "country": ORDER_FORM["country"],
+                            "postal_code": ORDER_FORM["postcode"],
+                            "city": ORDER_FORM["town_or_city"],
+                            "line1": ORDER_FORM["street_address1"],
+                            "line2": "",
+                            "state": "",
+                        },
+                    },
+                }
+            },
+        }
+    )
+
+
+def stripe_signature(payload):
+    """Return a Stripe-Signature header for a payload."""
+    timestamp = int(time.time())
+    signature = hmac.new(
+        WEBHOOK_SECRET.encode(),
+        f"{timestamp}.{payload}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return f"t={timestamp},v1={signature}"
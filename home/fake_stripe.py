@@ -0,0 +1,123 @@
+"""
+A fake Stripe API server, for the benchmark, query budgets and tests.
+
+It answers the Stripe calls the checkout and webhook code make, keeping
+PaymentIntents in memory, so nothing leaves the machine. Like Stripe, it
+accepts metadata updates for an intent in any status, but refuses to change
+the amount of an intent that's being paid, has been paid or was cancelled.
+"""
+
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BILLING_EMAIL = "bench@example.com"
+# PaymentIntent statuses in which the amount can't be changed
+FINISHED_STATUSES = {"processing", "succeeded", "canceled"}
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """Answer the Stripe API calls the checkout makes."""
+
+    protocol_version = "HTTP/1.1"
+    # Every PaymentIntent created, by ID
+    intents = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        path = self.path.split("?")[0].rstrip("/")
+        if path == "/v1/payment_intents":
+            intent_id = f"pi_{uuid.uuid4().hex}"
+            intent = {
+                "id": intent_id,
+                "object": "payment_intent",
+                "client_secret": f"{intent_id}_secret_benchmark",
+                "amount": int(params["amount"][0]),
+                "status": "requires_payment_method",
+                "metadata": _metadata(params),
+            }
+            with self.lock:
+                self.intents[intent_id] = intent
+            self._respond(200, intent)
+        elif path.startswith("/v1/payment_intents/"):
+            with self.lock:
+                intent = self.intents.get(path.rsplit("/", 1)[1])
+            if intent is None:
+                self._respond(404, stripe_error("No such payment_intent"))
+                return
+            if "amount" in params and intent["status"] in FINISHED_STATUSES:
+                self._respond(
+                    400,
+                    stripe_error(
+                        f"This PaymentIntent's amount could not be updated "
+                        f"because it has a status of {intent['status']}."
+                    ),
+                )
+                return
+            if "amount" in params:
+                intent["amount"] = int(params["amount"][0])
+            intent["metadata"].update(_metadata(params))
+            self._respond(200, intent)
+        else:
+            self._respond(404, stripe_error("Unrecognized request URL"))
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.startswith("/v1/payment_intents/"):
+            with self.lock:
+                intent = self.intents.get(path.rsplit("/", 1)[1])
+            if intent is None:
+                self._respond(404, stripe_error("No such payment_intent"))
+            else:
+                self._respond(200, intent)
+        elif path.startswith("/v1/charges/"):
+            charge = {
+                "id": path.rsplit("/", 1)[1],
+                "object": "charge",
+                "amount": 1000,
+                "billing_details": {"email": BILLING_EMAIL},
+            }
+            self._respond(200, charge)
+        else:
+            self._respond(404, stripe_error("Unrecognized request URL"))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def stripe_error(message):
+    """Return the body of a Stripe invalid request error."""
+    return {"error": {"type": "invalid_request_error", "message": message}}
+
+
+def start_fake_stripe():
+    """
+    Start a fake Stripe API server on a free local port.
+
+    Return (tuple): The server and its base URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStripeHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _metadata(params):
+    """Return the metadata in a request's form-encoded parameters."""
+    return {
+        key[len("metadata["):-1]: values[0]
+        for key, values in params.items()
+        if key.startswith("metadata[")
+    }
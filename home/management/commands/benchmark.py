@@ -0,0 +1,67 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.benchmark import run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the storefront's hot views in-process, against throwaway "
+        "test databases, and report the results as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default="1000,10000,100000",
+            help="Comma-separated catalogue sizes, in products.",
+        )
+        parser.add_argument(
+            "--clients",
+            type=int,
+            default=8,
+            help="The number of concurrent clients.",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=200,
+            help="The number of requests to send to each view.",
+        )
+        parser.add_argument(
+            "--views",
+            default="",
+            help="Comma-separated views to benchmark. Defaults to all.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed for the synthetic catalogue.",
+        )
+        parser.add_argument(
+            "--output",
+            help="Write the JSON results to this file, not stdout.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError("--sizes must be a list of numbers.")
+        views = [view for view in options["views"].split(",") if view]
+        results = run_benchmark(
+            sizes,
+            options["clients"],
+            options["requests"],
+            seed=options["seed"],
+            views=views,
+            log=self.stderr.write,
+        )
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                output_file.write(output + "\n")
+        else:
+            self.stdout.write(output)
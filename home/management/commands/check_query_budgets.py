@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.query_budgets import check_query_budgets
+
+
+class Command(BaseCommand):
+    help = (
+        "Check every view against its SQL query budget, at two data "
+        "scales, in throwaway test databases."
+    )
+
+    def handle(self, *args, **options):
+        log = self.stderr.write if options["verbosity"] > 1 else None
+        failures = check_query_budgets(log=log)
+        for failure in failures:
+            self.stdout.write(f"FAIL  {failure}\n")
+        if failures:
+            raise CommandError(
+                f"{len(failures)} query budget checks failed."
+            )
+        self.stdout.write(
+            self.style.SUCCESS("Every view is within its query budget.")
+        )
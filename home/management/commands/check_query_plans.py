@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+
+from checkout.models import Order
+from products.models import Category, Product
+
+
+def hot_queries():
+    """Return a dict of {description: queryset} for the site's hot queries."""
+    return {
+        "Order by order_number (checkout_success, order_history)": (
+            Order.objects.filter(order_number="0" * 32)
+        ),
+        "Order by stripe_pid (webhook)": (
+            Order.objects.filter(stripe_pid="pi_0")
+        ),
+        "Category by name (category filter)": (
+            Category.objects.filter(name__in=["deals", "clearance"])
+        ),
+        "Product by sku": Product.objects.filter(sku="sku"),
+        "Products sorted by name (products page)": (
+            Product.objects.annotate(lower_name=Lower("name"))
+            .order_by("lower_name", "id")
+            .values_list("id", "lower_name")[:24]
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = "Check that the site's hot queries use index scans."
+
+    def handle(self, *args, **options):
+        failures = []
+        for description, queryset in hot_queries().items():
+            plan = self._query_plan(queryset)
+            if self._uses_index(plan):
+                self.stdout.write(f"OK    {description}")
+            else:
+                self.stdout.write(f"FAIL  {description}\n{plan}")
+                failures.append(description)
+        if failures:
+            raise CommandError(
+                f"{len(failures)} hot queries don't use an index scan."
+            )
+        self.stdout.write(self.style.SUCCESS("All hot queries use indexes."))
+
+    def _query_plan(self, queryset):
+        """
+        Return the query plan for a queryset.
+
+        On Postgres, sequential scans are disabled for the check, since small
+        development tables would otherwise always be scanned.
+        """
+        with transaction.atomic():
+            if connection.vendor == "postgresql":
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+            return queryset.explain()
+
+    def _uses_index(self, plan):
+        """
+        Return True if the query plan doesn't scan or sort a whole table.
+        """
+        for line in plan.splitlines():
+            step = line.strip().lstrip("->").strip()
+            if connection.vendor == "postgresql":
+                if step.startswith(("Seq Scan", "Sort")):
+                    return False
+            elif "TEMP B-TREE" in step:
+                return False
+            elif " SCAN " in f" {step}" and "USING" not in step:
+                return False
+        return True
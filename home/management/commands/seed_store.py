@@ -0,0 +1,67 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from home.seeding import PASSWORD, USERNAME_PREFIX, seed_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a large synthetic store, for benchmarks and "
+        "query plan checks. Running it again with the same seed resumes an "
+        "interrupted load; another seed adds a second store."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed for the synthetic store.",
+        )
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=10000,
+            help="The number of products.",
+        )
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=10000,
+            help="The number of customers, each with a profile.",
+        )
+        parser.add_argument(
+            "--orders",
+            type=int,
+            default=1000000,
+            help="The number of orders, averaging 2.2 line items each.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="The number of processes inserting rows at once.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            created = seed_store(
+                options["seed"],
+                options["products"],
+                options["users"],
+                options["orders"],
+                options["workers"],
+                log=self.stderr.write,
+            )
+        except ValueError as error:
+            raise CommandError(error)
+        summary = ", ".join(
+            f"{count} {kind}" for kind, count in created.items()
+        )
+        self.stdout.write(self.style.SUCCESS(f"Created {summary}."))
+        first_customer = f"{USERNAME_PREFIX}{options['seed']}-0000000"
+        self.stdout.write(
+            f"Customers can log in as {first_customer} and so on, with the "
+            f'password "{PASSWORD}".'
+        )
@@ -0,0 +1,454 @@
+"""
+SQL query budgets for every view, and a harness that enforces them.
+
+QUERY_BUDGETS gives the most queries each URL name may run. The harness
+requests each view against a throwaway test database seeded at a small and
+a large scale, with empty caches, and reports a view that runs more queries
+than its budget, or more queries at the large scale than at the small one,
+which is the mark of an N+1. Reports include the offending SQL and where in
+the code each query was run.
+"""
+
+import re
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from http import HTTPStatus
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import setup_databases, teardown_databases
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+
+from bag.bags import serialize_bag
+from checkout.models import OrderLineItem
+from products.models import Product
+from products.catalogue import forget_catalogue_version
+from products.snapshots import clear_snapshots
+
+from .benchmark import (
+    ORDER_FORM,
+    offline_services,
+    payment_succeeded_event,
+    stripe_signature,
+)
+from .seeding import USERNAME_PREFIX, seed_store
+
+# The most queries each view may run, by URL name
+QUERY_BUDGETS = {
+    "home": 0,
+    "products": 5,
+    "product_detail": 2,
+    "add_product": 3,
+    "edit_product": 4,
+    "delete_product": 8,
+    "view_bag": 4,
+    "add_to_bag": 5,
+    "adjust_bag": 5,
+    "remove_from_bag": 5,
+    "checkout": 11,
+    "cache_checkout_data": 1,
+    "checkout_success": 7,
+    "webhook": 4,
+    "profile": 7,
+    "order_history": 5,
+    "metrics": 2,
+    "request_profiles": 2,
+    "request_profile": 2,
+}
+# Apps whose URL names must all have a budget. Views from other packages,
+# such as the admin and allauth, aren't budgeted.
+PROJECT_APPS = (
+    "boutique_ado",
+    "home",
+    "products",
+    "bag",
+    "checkout",
+    "profiles",
+)
+SCALES = (1, 4)
+PRODUCTS_PER_SCALE = 20
+ORDERS_PER_SCALE = 3
+LINE_ITEMS_PER_SCALE = 2
+BAG_ITEMS_PER_SCALE = 2
+STACK_DEPTH = 4
+
+
+def _case(url_name, args=(), method="get", data=None, user=None, **options):
+    """
+    Return a request to measure.
+
+    args and data may be callables, which are passed the seeded fixtures.
+    user is None, "customer" or "superuser". Set bag to True to fill the
+    session's bag first, and prepare to a URL name to request (unmeasured)
+    before the measured request.
+    """
+    return {
+        "url_name": url_name,
+        "args": args,
+        "method": method,
+        "data": data,
+        "user": user,
+        **options,
+    }
+
+
+def _product_id(fixtures):
+    return [fixtures["product_ids"][0]]
+
+
+def _order_number(fixtures):
+    return [fixtures["order_number"]]
+
+
+def _client_secret(fixtures):
+    intent = fixtures["client"].session["payment_intent"]
+    return {"client_secret": intent["client_secret"]}
+
+
+def _order_data(fixtures):
+    return {**ORDER_FORM, **_client_secret(fixtures)}
+
+
+def _profile_id(fixtures):
+    response = fixtures["client"].get(reverse("home"), {"profile": 1})
+    return [response["X-Profile-Id"]]
+
+
+def _webhook_event(fixtures):
+    return payment_succeeded_event(
+        f"budget_{fixtures['scale']}", fixtures["product_ids"][0]
+    )
+
+
+CASES = [
+    _case("home"),
+    _case("products"),
+    _case("products", data={"q": "cotton"}),
+    _case("products", data={"sort": "price", "direction": "desc"}),
+    _case("products", data={"category": "shirts,jeans"}),
+    _case("product_detail", _product_id),
+    _case("add_product", user="superuser"),
+    _case("edit_product", _product_id, user="superuser"),
+    _case(
+        "delete_product",
+        lambda fixtures: [fixtures["unordered_product_id"]],
+        user="superuser",
+    ),
+    _case("view_bag", bag=True),
+    _case("view_bag", user="customer", bag=True),
+    _case(
+        "add_to_bag",
+        _product_id,
+        "post",
+        {"quantity": 1, "redirect_url": "/"},
+        bag=True,
+    ),
+    _case("adjust_bag", _product_id, "post", {"quantity": 3}, bag=True),
+    _case("remove_from_bag", _product_id, "post", {}, bag=True),
+    _case("checkout", bag=True),
+    _case("checkout", user="customer", bag=True),
+    _case(
+        "checkout",
+        method="post",
+        data=_order_data,
+        bag=True,
+        prepare="checkout",
+    ),
+    _case(
+        "cache_checkout_data",
+        method="post",
+        data=_client_secret,
+        bag=True,
+        prepare="checkout",
+    ),
+    _case("checkout_success", _order_number, user="customer"),
+    _case("webhook", method="post", data=_webhook_event, signed=True),
+    _case("profile", user="customer"),
+    _case("order_history", _order_number, user="customer"),
+    _case("metrics", user="superuser"),
+    _case("request_profiles", user="superuser"),
+    _case("request_profile", _profile_id, user="superuser"),
+]
+
+
+def check_query_budgets(log=None, databases=None):
+    """
+    Measure every case at each scale, and check it against its budget.
+
+    databases returns a context manager that provides empty databases for
+    one scale. By default, throwaway test databases are created for each
+    scale. Tests, which already run against test databases, can pass one
+    that empties them afterwards instead.
+
+    Return (list): A failure report for each case over budget, whose query
+    count grows with the data, or that couldn't be measured, plus one for
+    each project URL name without a budget.
+    """
+    log = log or (lambda message: None)
+    databases = databases or _test_databases
+    failures = [
+        f"{url_name}: no query budget in QUERY_BUDGETS"
+        for url_name in sorted(set(project_url_names()) - set(QUERY_BUDGETS))
+    ]
+    measured = {}
+    errors = {}
+    with offline_services():
+        for scale in SCALES:
+            log(f"Measuring at scale {scale}...")
+            with databases():
+                fixtures = seed_fixtures(scale)
+                for number, case in enumerate(CASES):
+                    try:
+                        queries = _measure(case, fixtures)
+                    except CaseError as error:
+                        errors.setdefault(number, str(error))
+                        continue
+                    measured.setdefault(number, []).append(queries)
+    for number, case in enumerate(CASES):
+        if number in errors:
+            failures.append(f"{_label(case)}: {errors[number]}")
+            continue
+        counts = [len(queries) for queries in measured[number]]
+        log(f"{_label(case)}: {counts} queries")
+        failure = _check(case, measured[number])
+        if failure:
+            failures.append(failure)
+    return failures
+
+
+def project_url_names():
+    """Return the URL names of every view in the project's apps."""
+    names = []
+    patterns = list(get_resolver().url_patterns)
+    while patterns:
+        pattern = patterns.pop()
+        if isinstance(pattern, URLResolver):
+            patterns.extend(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            module = pattern.lookup_str.split(".")[0]
+            if module in PROJECT_APPS:
+                names.append(pattern.name)
+    return names
+
+
+def seed_fixtures(scale):
+    """
+    Seed a store with one customer, and a superuser.
+
+    The store is seeded by seed_store, with the number of products, orders
+    and bag items growing with scale. The line items of the customer's first
+    order are topped up, so they grow with scale too.
+
+    Return (dict): What the cases need to know about the seeded data.
+    """
+    seed_store(
+        0,
+        PRODUCTS_PER_SCALE * scale,
+        1,
+        ORDERS_PER_SCALE * scale,
+        workers=1,
+        log=lambda message: None,
+    )
+    products = list(
+        Product.objects.order_by("pk").values_list("pk", "price", "has_sizes")
+    )
+    product_ids = [pk for pk, _, _ in products]
+    customer = User.objects.get(username__startswith=USERNAME_PREFIX)
+    User.objects.create_superuser("budget_admin", "admin@example.com", "b")
+    order = customer.userprofile.orders.order_by("pk").first()
+    OrderLineItem.objects.bulk_create(
+        OrderLineItem(
+            order=order, product_id=pk, quantity=1, lineitem_total=price
+        )
+        for pk, price, _ in products[: LINE_ITEMS_PER_SCALE * scale]
+    )
+    bag = {
+        str(pk): {"m" if has_sizes else "": 1}
+        for pk, _, has_sizes in products[: BAG_ITEMS_PER_SCALE * scale]
+    }
+    return {
+        "scale": scale,
+        "product_ids": product_ids,
+        # Deleting a product that's been ordered deletes its line items too
+        "unordered_product_id": Product.objects.filter(
+            orderlineitem=None
+        ).values_list("pk", flat=True).last(),
+        "customer": customer.username,
+        "order_number": order.order_number,
+        "bag": serialize_bag(bag),
+    }
+
+
+def _measure(case, fixtures):
+    """
+    Request a case's view with empty caches.
+
+    Return (list): The queries the view ran, each a dict with its SQL and
+    the stack it was run from.
+    """
+    client = Client(raise_request_exception=False)
+    if case["user"] == "customer":
+        client.force_login(User.objects.get(username=fixtures["customer"]))
+    elif case["user"] == "superuser":
+        client.force_login(User.objects.get(username="budget_admin"))
+    if case.get("bag"):
+        session = client.session
+        session["bag"] = fixtures["bag"]
+        session.save()
+    if case.get("prepare"):
+        prepare_url = reverse(case["prepare"])
+        response = client.get(prepare_url)
+        if response.status_code != HTTPStatus.OK:
+            raise CaseError(
+                f"couldn't be measured, preparing with GET {prepare_url} "
+                f"returned HTTP {response.status_code}"
+                f"{_request_error(response)}"
+            )
+    fixtures = {**fixtures, "client": client}
+    args = case["args"](fixtures) if callable(case["args"]) else case["args"]
+    data = case["data"](fixtures) if callable(case["data"]) else case["data"]
+    url = reverse(case["url_name"], args=args)
+    options = {}
+    if case.get("signed"):
+        options = {
+            "content_type": "application/json",
+            "HTTP_STRIPE_SIGNATURE": stripe_signature(data),
+        }
+    cache.clear()
+    clear_snapshots()
+    forget_catalogue_version()
+    with _recorded_queries() as queries:
+        response = getattr(client, case["method"])(url, data, **options)
+    if response.status_code >= 500:
+        raise CaseError(
+            f"couldn't be measured, it returned HTTP {response.status_code}"
+            f"{_request_error(response)}"
+        )
+    return queries
+
+
+def _request_error(response):
+    """Return the exception a test client request raised, if it did."""
+    exc_info = getattr(response, "exc_info", None)
+    if not exc_info:
+        return ""
+    error = traceback.format_exception_only(exc_info[0], exc_info[1])
+    return f": {''.join(error).strip()}"
+
+
+@contextmanager
+def _recorded_queries():
+    """Record the SQL and the calling stack of every query run."""
+    queries = []
+
+    def record(execute, sql, params, many, context):
+        queries.append({"sql": sql, "stack": _project_stack()})
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(record):
+        yield queries
+
+
+def _project_stack():
+    """Return the innermost frames of the current stack in project code."""
+    frames = [
+        frame
+        for frame in traceback.extract_stack()[:-2]
+        if frame.filename.startswith(str(settings.BASE_DIR))
+        and "site-packages" not in frame.filename
+        and not frame.filename.endswith(("query_budgets.py", "manage.py"))
+    ]
+    return "".join(traceback.format_list(frames[-STACK_DEPTH:]))
+
+
+def _check(case, runs):
+    """
+    Return a failure report for a case's runs, or None if it passed.
+
+    runs holds the queries recorded at each scale, smallest first.
+    """
+    budget = QUERY_BUDGETS.get(case["url_name"])
+    label = _label(case)
+    counts = [len(queries) for queries in runs]
+    counts_text = ", ".join(
+        f"{count} at scale {scale}" for scale, count in zip(SCALES, counts)
+    )
+    if counts[-1] > counts[0]:
+        grown = _grown_queries(runs[0], runs[-1])
+        return (
+            f"{label}: query count grows with the data ({counts_text})\n"
+            + _format_queries(grown)
+        )
+    if budget is not None and counts[-1] > budget:
+        return (
+            f"{label}: {counts[-1]} queries, over its budget of {budget} "
+            f"({counts_text})\n" + _format_queries(runs[-1])
+        )
+    return None
+
+
+def _label(case):
+    label = f"{case['method'].upper()} {case['url_name']}"
+    if case["user"]:
+        label += f" as {case['user']}"
+    if isinstance(case["data"], dict):
+        label += f" {case['data']}"
+    return label
+
+
+def _grown_queries(small_run, large_run):
+    """Return the large run's queries that ran more often than the small's."""
+    small = Counter(_normalize(query["sql"]) for query in small_run)
+    large = Counter(_normalize(query["sql"]) for query in large_run)
+    grown = {sql for sql, count in large.items() if count > small[sql]}
+    return [
+        query for query in large_run if _normalize(query["sql"]) in grown
+    ]
+
+
+def _normalize(sql):
+    """Return SQL with its literal values replaced, to group similar SQL."""
+    sql = sql.replace("%s", "?")
+    sql = re.sub(r"'[^']*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    return re.sub(r"\((\?, )+\?\)", "(?)", sql)
+
+
+def _format_queries(queries):
+    """Return a report of queries, grouping repeats of the same SQL."""
+    groups = {}
+    for query in queries:
+        group = groups.setdefault(_normalize(query["sql"]), [query, 0])
+        group[1] += 1
+    lines = []
+    for number, (query, count) in enumerate(groups.values(), start=1):
+        repeats = f" (run {count} times)" if count > 1 else ""
+        lines.append(f"  {number}. {query['sql']}{repeats}")
+        if query["stack"]:
+            lines.append(_indent(query["stack"], "       "))
+    return "\n".join(lines)
+
+
+def _indent(text, prefix):
+    return "\n".join(prefix + line for line in text.rstrip().splitlines())
+
+
+@contextmanager
+def _test_databases():
+    """Create empty test databases, and destroy them afterwards."""
+    old_config = setup_databases(
+        verbosity=0, interactive=False, aliases=set(connections)
+    )
+    try:
+        yield
+    finally:
+        connections.close_all()
+        teardown_databases(old_config, verbosity=0)
+
+
+class CaseError(Exception):
+    """Raised when a case's requests fail, so it can't be measured."""
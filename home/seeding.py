@@ -0,0 +1,598 @@
+"""
+Fill the database with a large synthetic store.
+
+The store is seeded in chunks of CHUNK_SIZE rows: categories, then products,
+then customers with their profiles, then orders with their line items. Each
+chunk is generated from its own random generator, seeded from the seed and
+the chunk's number, so a seed always produces the same store, whatever the
+number of workers. Each chunk is inserted in one transaction, and chunks
+whose first row already exists are skipped, so an interrupted load can be
+resumed by running it again. The seed is part of every row's natural key,
+so a run with another seed adds a second store rather than resuming the
+first.
+
+Rows are bulk created, so their post_save signals don't run. In particular
+the per-line-item signal doesn't recalculate each order's totals; they're
+calculated as the orders are generated instead. Profiles are created
+alongside their users, and the search index is rebuilt and the catalogue
+version bumped once the products are in. An order's date is set when it's
+added, so the generated dates are written with an update afterwards.
+"""
+
+import hashlib
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from decimal import Decimal
+from functools import partial
+
+import django
+from allauth.account.models import EmailAddress
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from bag.bags import serialize_bag
+from checkout.models import Order, OrderLineItem
+from products.catalogue import bump_catalogue_version
+from products.models import Category, Product
+from products.search import rebuild_index
+from profiles.models import UserProfile
+
+CHUNK_SIZE = 5000
+SKU_PREFIX = "SEED"
+USERNAME_PREFIX = "shopper"
+PASSWORD = "boutique-seed"
+GUEST_ORDER_RATE = 0.1
+ORDER_HISTORY_DAYS = 730
+CENT = Decimal("0.01")
+
+APPAREL_MATERIALS = (
+    "cotton", "organic cotton", "linen", "merino wool", "recycled polyester",
+    "bamboo jersey", "brushed cotton", "cotton twill",
+)
+APPAREL = {"materials": APPAREL_MATERIALS, "has_sizes": True}
+CATEGORIES = {
+    "activewear": {
+        **APPAREL,
+        "friendly_name": "Activewear",
+        "types": (
+            ("Running Tights", 20, 60),
+            ("Sports Bra", 15, 45),
+            ("Track Jacket", 35, 90),
+            ("Training Shorts", 15, 40),
+            ("Zip Hoodie", 30, 70),
+        ),
+    },
+    "essentials": {
+        **APPAREL,
+        "friendly_name": "Essentials",
+        "types": (
+            ("T-Shirt", 8, 25),
+            ("Crew Neck Jumper", 20, 60),
+            ("Vest", 6, 18),
+            ("Polo Shirt", 15, 40),
+            ("Joggers", 20, 45),
+        ),
+    },
+    "jeans": {
+        **APPAREL,
+        "friendly_name": "Jeans",
+        "materials": ("denim", "stretch denim", "selvedge denim"),
+        "types": (
+            ("Skinny Jeans", 30, 80),
+            ("Straight Leg Jeans", 30, 90),
+            ("Bootcut Jeans", 35, 85),
+            ("Denim Shorts", 20, 45),
+        ),
+    },
+    "shirts": {
+        **APPAREL,
+        "friendly_name": "Shirts",
+        "types": (
+            ("Oxford Shirt", 25, 70),
+            ("Flannel Shirt", 25, 60),
+            ("Short Sleeve Shirt", 20, 50),
+            ("Blouse", 25, 65),
+        ),
+    },
+    "bed_bath": {
+        "friendly_name": "Bed & Bath",
+        "has_sizes": False,
+        "materials": ("Egyptian cotton", "waffle cotton", "linen", "bamboo"),
+        "types": (
+            ("Duvet Cover", 30, 120),
+            ("Pillowcase Pair", 12, 35),
+            ("Bath Towel", 8, 30),
+            ("Bath Mat", 12, 30),
+        ),
+    },
+    "kitchen_dining": {
+        "friendly_name": "Kitchen & Dining",
+        "has_sizes": False,
+        "materials": ("stoneware", "porcelain", "stainless steel", "oak"),
+        "types": (
+            ("Mug Set", 12, 35),
+            ("Dinner Plate Set", 25, 80),
+            ("Serving Bowl", 15, 45),
+            ("Chopping Board", 15, 50),
+        ),
+    },
+    # These hold products of the other categories' types
+    "new_arrivals": {"friendly_name": "New Arrivals", "discount": 1},
+    "deals": {"friendly_name": "Deals", "discount": Decimal("0.8")},
+    "clearance": {"friendly_name": "Clearance", "discount": Decimal("0.5")},
+}
+ADJECTIVES = (
+    "Classic", "Relaxed", "Slim", "Everyday", "Premium", "Lightweight",
+    "Heavyweight", "Vintage", "Striped", "Essential", "Washed", "Tailored",
+)
+COLOURS = (
+    "Black", "White", "Navy", "Stone", "Olive", "Charcoal", "Rust", "Sage",
+    "Sky Blue", "Burgundy", "Oatmeal", "Forest Green",
+)
+OPENINGS = (
+    "A {adjective} {noun} in {colour} {material}.",
+    "Our {adjective} {noun}, made from {material} and finished in {colour}.",
+    "The {adjective} {noun} you'll reach for again and again, in {colour} "
+    "{material}.",
+)
+APPAREL_DETAILS = (
+    "Cut for an easy, relaxed fit.",
+    "Pre-washed for softness from the first wear.",
+    "Reinforced seams stand up to everyday wear.",
+    "Machine washable at 30 degrees.",
+    "Designed to layer through every season.",
+    "Finished with tonal stitching and a woven label.",
+    "Breathable and quick drying.",
+    "Our model is 6ft and wears a size M.",
+)
+HOME_DETAILS = (
+    "Made to last through years of daily use.",
+    "Designed in our London studio.",
+    "Pairs with the rest of the collection.",
+    "Arrives gift boxed.",
+    "Machine washable at 40 degrees.",
+    "Dishwasher and microwave safe.",
+)
+SIZES = ("xs", "s", "m", "l", "xl")
+FIRST_NAMES = (
+    "Olivia", "Amelia", "Isla", "Ava", "Mia", "Grace", "Sophia", "Lily",
+    "Oliver", "George", "Noah", "Arthur", "Leo", "Harry", "Oscar", "Jack",
+    "Aisha", "Priya", "Mohammed", "Yusuf", "Chen", "Siobhan", "Niamh",
+    "Tomasz",
+)
+LAST_NAMES = (
+    "Smith", "Jones", "Taylor", "Brown", "Williams", "Wilson", "Johnson",
+    "Davies", "Patel", "Robinson", "Wright", "Thompson", "Evans", "Walker",
+    "White", "Roberts", "Green", "Hall", "Khan", "Murphy", "O'Brien",
+    "Kowalski", "Clarke", "Hughes",
+)
+STREETS = (
+    "High Street", "Station Road", "Church Lane", "Victoria Road",
+    "Green Lane", "Manor Road", "Park Avenue", "Queens Road", "Mill Lane",
+    "Kings Road", "The Crescent", "Orchard Way",
+)
+# (Town, county, postcode area, country)
+TOWNS = (
+    ("London", "Greater London", "SE", "GB"),
+    ("Manchester", "Greater Manchester", "M", "GB"),
+    ("Birmingham", "West Midlands", "B", "GB"),
+    ("Leeds", "West Yorkshire", "LS", "GB"),
+    ("Bristol", "Bristol", "BS", "GB"),
+    ("Brighton", "East Sussex", "BN", "GB"),
+    ("Norwich", "Norfolk", "NR", "GB"),
+    ("York", "North Yorkshire", "YO", "GB"),
+    ("Cardiff", "South Glamorgan", "CF", "GB"),
+    ("Edinburgh", "Midlothian", "EH", "GB"),
+    ("Glasgow", "Lanarkshire", "G", "GB"),
+    ("Belfast", "County Antrim", "BT", "GB"),
+    ("Dublin", "County Dublin", "D", "IE"),
+    ("Cork", "County Cork", "T", "IE"),
+)
+
+
+def seed_store(seed, products, users, orders, workers, log):
+    """
+    Seed a store with the given numbers of products, users and orders.
+
+    Running it again with the same arguments resumes an interrupted load.
+    Raise ValueError if rows were seeded with different numbers.
+
+    Return (dict): The number of rows of each kind created by this run.
+    """
+    # Dates are relative to today, so a run repeated on the same day matches
+    start = timezone.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    created = {"categories": _seed_categories()}
+    categories = dict(
+        Category.objects.filter(name__in=CATEGORIES).values_list("name", "pk")
+    )
+    created["products"] = _run_chunks(
+        _seed_products,
+        partial(_sku, seed),
+        Product.objects.values_list("sku", flat=True),
+        "sku",
+        products,
+        {"seed": seed, "categories": categories},
+        workers,
+        log,
+    )
+    if created["products"]:
+        rebuild_index()
+        bump_catalogue_version()
+    created["users"] = _run_chunks(
+        _seed_users,
+        partial(_username, seed),
+        User.objects.values_list("username", flat=True),
+        "username",
+        users,
+        {"seed": seed, "start": start, "password": make_password(PASSWORD)},
+        workers,
+        log,
+    )
+    shared = {
+        "seed": seed,
+        "start": start,
+        "products": list(
+            Product.objects.filter(sku__startswith=_sku_prefix(seed))
+            .order_by("sku")
+            .values_list("pk", "price", "has_sizes")[:products]
+        ),
+        "customers": list(
+            UserProfile.objects.filter(
+                user__username__startswith=_username_prefix(seed)
+            )
+            .order_by("user__username")
+            .values_list(
+                "pk",
+                "user__first_name",
+                "user__last_name",
+                "user__email",
+                "default_phone_number",
+                "default_street_address1",
+                "default_town_or_city",
+                "default_county",
+                "default_postcode",
+                "default_country",
+            )[:users]
+        ),
+    }
+    if orders and not shared["products"]:
+        log("There are no seeded products to order, so no orders were made.")
+        created["orders"] = 0
+        return created
+    created["orders"] = _run_chunks(
+        _seed_orders,
+        partial(_order_number, seed),
+        Order.objects.values_list("order_number", flat=True),
+        "order_number",
+        orders,
+        shared,
+        workers,
+        log,
+    )
+    return created
+
+
+def _seed_categories():
+    """Create the categories that don't exist yet."""
+    existing = set(
+        Category.objects.filter(name__in=CATEGORIES).values_list(
+            "name", flat=True
+        )
+    )
+    new = [
+        Category(name=name, friendly_name=details["friendly_name"])
+        for name, details in CATEGORIES.items()
+        if name not in existing
+    ]
+    Category.objects.bulk_create(new)
+    return len(new)
+
+
+def _run_chunks(function, key, keys, key_field, count, shared, workers, log):
+    """
+    Seed count rows in chunks, skipping the chunks that already exist.
+
+    function is passed a chunk's number and the indexes its rows start and
+    stop at, and returns the number of rows it created. key returns the
+    natural key of the row with a given index, which is looked up in the
+    keys queryset's key_field. A chunk is inserted in one transaction, so
+    it exists if its last row does.
+
+    Return (int): The number of rows created.
+    """
+    chunks = [
+        (start // CHUNK_SIZE, start, min(start + CHUNK_SIZE, count))
+        for start in range(0, count, CHUNK_SIZE)
+    ]
+    label = function.__name__.replace("_seed_", "")
+    edge_keys = [key(start) for _, start, _ in chunks]
+    edge_keys += [key(stop - 1) for _, _, stop in chunks]
+    found = set()
+    for batch in range(0, len(edge_keys), 500):
+        found.update(
+            keys.filter(**{f"{key_field}__in": edge_keys[batch:batch + 500]})
+        )
+    pending = []
+    for chunk in chunks:
+        first, last = key(chunk[1]) in found, key(chunk[2] - 1) in found
+        if first and not last:
+            raise ValueError(
+                f"The {label} were seeded with different numbers. Seed them "
+                f"with the same numbers, or into an empty database."
+            )
+        if not last:
+            pending.append(chunk)
+    log(
+        f"Seeding {label}: {len(chunks) - len(pending)} of {len(chunks)} "
+        f"chunks already exist."
+    )
+    if not pending:
+        return 0
+    if connection.vendor == "sqlite":
+        # SQLite only allows one writer at a time
+        workers = 1
+    created = finished = 0
+    if workers <= 1:
+        _init_worker(shared, setup=False)
+        for chunk in pending:
+            created += function(*chunk)
+            finished += 1
+            log(f"Seeded {finished} of {len(pending)} chunks of {label}.")
+        return created
+    # Forked workers mustn't share the parent's database connections
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(shared,)
+    ) as executor:
+        futures = [executor.submit(function, *chunk) for chunk in pending]
+        for future in as_completed(futures):
+            created += future.result()
+            finished += 1
+            log(f"Seeded {finished} of {len(pending)} chunks of {label}.")
+    return created
+
+
+def _init_worker(shared, setup=True):
+    """Set up a seeding process, with the data its chunks need."""
+    global _shared
+    if setup:
+        django.setup()
+    _shared = shared
+
+
+def _seed_products(number, start, stop):
+    rng = _chunk_random("products", number)
+    categories = _shared["categories"]
+    products = []
+    for index in range(start, stop):
+        name = rng.choice(list(CATEGORIES))
+        category = CATEGORIES[name]
+        discount = category.get("discount", 1)
+        if "types" not in category:
+            category = CATEGORIES[
+                rng.choice(("activewear", "essentials", "jeans", "shirts"))
+            ]
+        noun, low, high = rng.choice(category["types"])
+        words = {
+            "adjective": rng.choice(ADJECTIVES),
+            "colour": rng.choice(COLOURS),
+            "material": rng.choice(category["materials"]),
+            "noun": noun,
+        }
+        details = APPAREL_DETAILS if category["has_sizes"] else HOME_DETAILS
+        description = " ".join(
+            [rng.choice(OPENINGS).format(**_lower(words))]
+            + rng.sample(details, 2)
+        )
+        price = Decimal(rng.randint(low * 100, high * 100)) / 100 * discount
+        products.append(
+            Product(
+                category_id=categories[name],
+                sku=_sku(_shared["seed"], index),
+                name=(
+                    f"{words['adjective']} {words['colour']} "
+                    f"{words['material'].title()} {noun}"
+                ),
+                description=description,
+                has_sizes=category["has_sizes"],
+                price=max(price.quantize(CENT), CENT),
+                rating=rng.choice(
+                    [None, Decimal(rng.randint(10, 50)) / 10]
+                ),
+            )
+        )
+    with transaction.atomic():
+        Product.objects.bulk_create(products)
+    return len(products)
+
+
+def _seed_users(number, start, stop):
+    rng = _chunk_random("users", number)
+    users = []
+    addresses = {}
+    for index in range(start, stop):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        username = _username(_shared["seed"], index)
+        email_name = f"{first_name}.{last_name}".lower().replace("'", "")
+        email_name += f".{_shared['seed']}.{index}"
+        users.append(
+            User(
+                username=username,
+                email=f"{email_name}@example.com",
+                first_name=first_name,
+                last_name=last_name,
+                password=_shared["password"],
+                date_joined=_shared["start"]
+                - timedelta(days=rng.randint(0, ORDER_HISTORY_DAYS)),
+            )
+        )
+        addresses[username] = _address(rng)
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        _set_pks(users, "username")
+        UserProfile.objects.bulk_create(
+            UserProfile(
+                user=user,
+                default_phone_number=addresses[user.username][0],
+                default_street_address1=addresses[user.username][1],
+                default_town_or_city=addresses[user.username][2],
+                default_county=addresses[user.username][3],
+                default_postcode=addresses[user.username][4],
+                default_country=addresses[user.username][5],
+            )
+            for user in users
+        )
+        # Let the customers log in without confirming their email address
+        EmailAddress.objects.bulk_create(
+            EmailAddress(
+                user=user, email=user.email, verified=True, primary=True
+            )
+            for user in users
+        )
+    return len(users)
+
+
+def _seed_orders(number, start, stop):
+    rng = _chunk_random("orders", number)
+    products = _shared["products"]
+    customers = _shared["customers"]
+    orders = []
+    line_items = []
+    for index in range(start, stop):
+        if customers and rng.random() >= GUEST_ORDER_RATE:
+            # Skewed, so a few customers have very long order histories
+            customer = customers[int(len(customers) * rng.random() ** 3)]
+            profile_id, first_name, last_name, email = customer[:4]
+            address = customer[4:]
+        else:
+            profile_id = None
+            first_name = rng.choice(FIRST_NAMES)
+            last_name = rng.choice(LAST_NAMES)
+            email = f"guest{index}@example.com"
+            address = _address(rng)
+        order = Order(
+            order_number=_order_number(_shared["seed"], index),
+            user_profile_id=profile_id,
+            full_name=f"{first_name} {last_name}",
+            email=email,
+            phone_number=address[0],
+            street_address1=address[1],
+            town_or_city=address[2],
+            county=address[3],
+            postcode=address[4],
+            country=address[5],
+            date=_shared["start"]
+            - timedelta(seconds=rng.randint(0, ORDER_HISTORY_DAYS * 86400)),
+        )
+        order.stripe_pid = f"pi_{order.order_number[:24].lower()}"
+        items = {}
+        order_lines = []
+        lines = rng.choices((1, 2, 3, 4, 5), weights=(35, 30, 20, 10, 5))[0]
+        for product_id, price, has_sizes in rng.sample(
+            products, min(lines, len(products))
+        ):
+            quantity = rng.choices((1, 2, 3), weights=(80, 15, 5))[0]
+            size = rng.choice(SIZES) if has_sizes else None
+            items.setdefault(str(product_id), {})[size or ""] = quantity
+            order_lines.append(
+                OrderLineItem(
+                    order=order,
+                    product_id=product_id,
+                    product_size=size,
+                    quantity=quantity,
+                    lineitem_total=price * quantity,
+                )
+            )
+        # The totals are worked out here, not by the line item signal
+        order.order_total = sum(line.lineitem_total for line in order_lines)
+        order.update_delivery_cost()
+        order.delivery_cost = Decimal(order.delivery_cost).quantize(CENT)
+        order.grand_total = order.order_total + order.delivery_cost
+        order.original_bag = json.dumps(serialize_bag(items))
+        orders.append(order)
+        line_items.extend(order_lines)
+    # Creating an order replaces its date with the current time
+    dates = [order.date for order in orders]
+    with transaction.atomic():
+        Order.objects.bulk_create(orders)
+        _set_pks(orders, "order_number")
+        OrderLineItem.objects.bulk_create(line_items)
+        for order, date in zip(orders, dates):
+            order.date = date
+        Order.objects.bulk_update(orders, ["date"])
+    return len(orders)
+
+
+def _set_pks(objects, key_field):
+    """Set the primary keys of bulk created objects, if they weren't set."""
+    if connection.features.can_return_rows_from_bulk_insert:
+        return
+    # SQLite doesn't return the primary keys of bulk created rows
+    model = type(objects[0])
+    pks = dict(
+        model.objects.filter(
+            **{f"{key_field}__in": [getattr(o, key_field) for o in objects]}
+        ).values_list(key_field, "pk")
+    )
+    for obj in objects:
+        obj.pk = pks[getattr(obj, key_field)]
+
+
+def _address(rng):
+    """Return a random phone number, street, town, county and postcode."""
+    town, county, area, country = rng.choice(TOWNS)
+    if country == "GB":
+        postcode = (
+            f"{area}{rng.randint(1, 20)} {rng.randint(1, 9)}"
+            f"{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}"
+            f"{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}"
+        )
+    else:
+        postcode = f"{area}{rng.randint(10, 99)} {rng.randint(1000, 9999)}"
+    return (
+        f"07{rng.randrange(10 ** 9):09d}",
+        f"{rng.randint(1, 250)} {rng.choice(STREETS)}",
+        town,
+        county,
+        postcode,
+        country,
+    )
+
+
+def _chunk_random(kind, number):
+    """Return the random generator for one chunk of rows."""
+    return random.Random(f"{_shared['seed']}:{kind}:{number}")
+
+
+def _lower(words):
+    return {name: word.lower() for name, word in words.items()}
+
+
+def _sku_prefix(seed):
+    return f"{SKU_PREFIX}{seed}-"
+
+
+def _sku(seed, index):
+    return f"{_sku_prefix(seed)}{index:08d}"
+
+
+def _username_prefix(seed):
+    return f"{USERNAME_PREFIX}{seed}-"
+
+
+def _username(seed, index):
+    return f"{_username_prefix(seed)}{index:07d}"
+
+
+def _order_number(seed, index):
+    """Return the order number of the seeded order with a given index."""
+    key = f"seeded-order-{seed}-{index}"
+    return hashlib.md5(key.encode()).hexdigest().upper()
+
+
+_shared = {}
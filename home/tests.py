@@ -1,3 +1,65 @@
-from django.test import TestCase
+from contextlib import contextmanager
 
-# Create your tests here.
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from checkout.models import Order
+from products.models import Product
+
+from .query_budgets import check_query_budgets
+from .seeding import seed_store
+
+
+class QueryBudgetTests(TransactionTestCase):
+    @contextmanager
+    def emptied_databases(self):
+        """Empty the test database after measuring a scale."""
+        try:
+            yield
+        finally:
+            call_command("flush", interactive=False, verbosity=0)
+
+    def test_every_view_is_within_its_query_budget(self):
+        failures = check_query_budgets(databases=self.emptied_databases)
+
+        self.assertEqual(failures, [], "\n\n".join(failures))
+
+
+class SeedStoreTests(TestCase):
+    def seed(self, seed):
+        return seed_store(
+            seed, 10, 5, 20, workers=1, log=lambda message: None
+        )
+
+    def test_running_again_with_the_same_seed_resumes(self):
+        self.seed(1)
+
+        created = self.seed(1)
+
+        self.assertEqual(
+            created, {"categories": 0, "products": 0, "users": 0, "orders": 0}
+        )
+
+    def test_another_seed_adds_a_second_store(self):
+        self.seed(1)
+
+        created = self.seed(2)
+
+        self.assertEqual(
+            created,
+            {"categories": 0, "products": 10, "users": 5, "orders": 20},
+        )
+        self.assertEqual(Product.objects.count(), 20)
+        self.assertEqual(Order.objects.count(), 40)
+
+    def test_orders_keep_their_generated_dates(self):
+        self.seed(1)
+
+        today = timezone.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        self.assertFalse(Order.objects.filter(date__gt=today).exists())
+        self.assertGreater(
+            Order.objects.values("date").distinct().count(), 1
+        )
@@ -0,0 +1,91 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import F
+
+from .models import CatalogueVersion
+
+
+def catalogue_version():
+    """
+    Return the current catalogue version.
+
+    Each worker reads the version from the database at most once every
+    CATALOGUE_VERSION_TTL seconds, so a change saved on another worker is
+    seen within that time. A change saved on this worker is seen at once.
+    """
+    global _version
+    version, expires = _version
+    now = time.monotonic()
+    if version is not None and expires > now:
+        return version
+    # Always read from the primary, so a lagging replica can't hand out an
+    # old version after a change
+    version = (
+        CatalogueVersion.objects.using(DEFAULT_DB_ALIAS)
+        .filter(pk=1)
+        .values_list("version", flat=True)
+        .first()
+    ) or 1
+    _version = (version, now + settings.CATALOGUE_VERSION_TTL)
+    return version
+
+
+def forget_catalogue_version():
+    """Make this worker read the catalogue version from the database again."""
+    global _version
+    _version = (None, 0.0)
+
+
+def bump_catalogue_version():
+    """
+    Bump the catalogue version.
+
+    Every cached catalogue listing is keyed on the version, so bumping it
+    invalidates all of them at once. The version is incremented in the
+    database, so concurrent bumps are never lost.
+    """
+    bumped = CatalogueVersion.objects.filter(pk=1).update(
+        version=F("version") + 1
+    )
+    if not bumped:
+        CatalogueVersion.objects.get_or_create(pk=1, defaults={"version": 2})
+    # Until the bump is committed, other threads may still read the old one
+    forget_catalogue_version()
+    transaction.on_commit(forget_catalogue_version)
+
+
+def listing_cache_key(query, version):
+    """
+    Return the cache key for a product listing query.
+
+    The query is a dict of normalized listing parameters.
+    """
+    params = "&".join(f"{key}={query[key]}" for key in sorted(query))
+    digest = hashlib.md5(params.encode("utf-8")).hexdigest()
+    return f"catalogue:{version}:listing:{digest}"
+
+
+def cached_listing(query, compute, version=None):
+    """
+    Return the cached result for a listing query.
+
+    If the result isn't cached for the catalogue version, call compute() and
+    cache what it returns. Pass the version if it's already been read, so
+    the listing and its count are cached under the same one.
+    """
+    if version is None:
+        version = catalogue_version()
+    key = listing_cache_key(query, version)
+    result = cache.get(key)
+    if result is None:
+        result = compute()
+        cache.set(key, result, settings.CATALOGUE_CACHE_TIMEOUT)
+    return result
+
+
+# (version, expiry time) of the version this worker last read
+_version = (None, 0.0)
@@ -0,0 +1,113 @@
+"""
+Resized and WebP variants of product images.
+
+Each product image gets a variant at every PRODUCT_IMAGE_WIDTHS width, up to
+the original's width, in the original's format and in WebP. Variants are
+stored next to the originals, in whichever storage holds them, under names
+that can be worked out from the original's name. So templates can build
+srcset attributes without touching the storage.
+"""
+
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .catalogue import bump_catalogue_version
+
+VARIANTS_DIR = "variants"
+WEBP = "webp"
+# Variant file extensions and their formats. Variants of images in any other
+# format are saved as JPEG.
+FORMATS = {"jpg": "JPEG", "png": "PNG", WEBP: "WEBP"}
+
+
+def variant_name(name, width, extension=None):
+    """Return the storage name of one variant of an image."""
+    base, original_extension = os.path.splitext(name)
+    directory, filename = os.path.split(base)
+    if extension is None:
+        extension = original_extension.lstrip(".").lower()
+        if extension not in ("jpg", "png"):
+            extension = "jpg"
+    return os.path.join(
+        directory, VARIANTS_DIR, f"{filename}-{width}w.{extension}"
+    )
+
+
+def generate_variants(storage, name, widths=None):
+    """
+    Create the variants of an image, replacing any that already exist.
+
+    Return (list): The widths that variants were created at.
+    """
+    widths = widths or settings.PRODUCT_IMAGE_WIDTHS
+    with storage.open(name, "rb") as image_file:
+        original = ImageOps.exif_transpose(Image.open(image_file))
+        original.load()
+    has_alpha = original.mode in ("RGBA", "LA", "PA") or (
+        "transparency" in original.info
+    )
+    original = original.convert("RGBA" if has_alpha else "RGB")
+    # Widths beyond the original's are capped at it, so the largest variant
+    # is the original image in the variant formats
+    widths = sorted({min(width, original.width) for width in widths})
+    created = []
+    for width in widths:
+        height = round(original.height * width / original.width)
+        variant = original.resize((width, height), Image.LANCZOS)
+        _save(storage, variant_name(name, width), variant)
+        _save(storage, variant_name(name, width, WEBP), variant)
+        created.append(width)
+    return created
+
+
+def delete_variants(storage, name, widths):
+    """Delete the variants of an image."""
+    for width in widths:
+        storage.delete(variant_name(name, width))
+        storage.delete(variant_name(name, width, WEBP))
+
+
+def update_product_variants(product, old_name=None, old_widths=()):
+    """
+    Create the variants of a product's image, and record their widths.
+
+    The variants of the product's previous image, if it had one, are deleted.
+    The widths are saved with an update, so the post_save signals don't run
+    a second time, and the catalogue version is bumped so no worker keeps a
+    snapshot of the product without them.
+    """
+    image = product.image
+    if old_name and old_name != image.name:
+        delete_variants(image.storage, old_name, old_widths)
+    widths = generate_variants(image.storage, image.name) if image else []
+    product.image_variants = widths
+    type(product).objects.filter(pk=product.pk).update(image_variants=widths)
+    bump_catalogue_version()
+
+
+def srcset(image, widths, extension=None):
+    """Return a srcset attribute value for an image's variants."""
+    return ", ".join(
+        f"{image.storage.url(variant_name(image.name, width, extension))}"
+        f" {width}w"
+        for width in widths
+    )
+
+
+def _save(storage, name, image):
+    """Save a Pillow image to the storage, replacing any existing file."""
+    image_format = FORMATS[os.path.splitext(name)[1].lstrip(".")]
+    options = {"quality": settings.PRODUCT_IMAGE_QUALITY}
+    if image_format == "JPEG":
+        image = image.convert("RGB")
+        options.update(optimize=True, progressive=True)
+    elif image_format == "PNG":
+        options = {"optimize": True}
+    buffer = BytesIO()
+    image.save(buffer, format=image_format, **options)
+    storage.delete(name)
+    storage.save(name, ContentFile(buffer.getvalue()))
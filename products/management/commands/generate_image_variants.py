@@ -0,0 +1,67 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from products.catalogue import bump_catalogue_version
+from products.images import generate_variants
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = "Create the resized and WebP variants of product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="The number of processes resizing images at once.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recreate variants for images that already have them.",
+        )
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image="").exclude(image=None)
+        if not options["all"]:
+            products = products.filter(image_variants=[])
+        images = list(products.values_list("pk", "image"))
+        # Forked workers mustn't share the parent's database connections
+        connections.close_all()
+        done = failed = 0
+        with ProcessPoolExecutor(
+            max_workers=options["workers"], initializer=django.setup
+        ) as executor:
+            futures = {
+                executor.submit(_generate_variants, name): pk
+                for pk, name in images
+            }
+            for future in as_completed(futures):
+                pk = futures[future]
+                try:
+                    widths = future.result()
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f"Product {pk}: {error}")
+                    continue
+                # An update doesn't run the post_save signals
+                Product.objects.filter(pk=pk).update(image_variants=widths)
+                done += 1
+        if done:
+            bump_catalogue_version()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created variants for {done} images, {failed} failed."
+            )
+        )
+
+
+def _generate_variants(name):
+    """Create the variants of an image in the media storage."""
+    return generate_variants(default_storage, name)
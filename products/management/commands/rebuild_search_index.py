@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from products.search import rebuild_index, search_backend
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index for every product."
+
+    def handle(self, *args, **options):
+        backend = search_backend()
+        count = rebuild_index()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {count} products with the {backend} search backend."
+            )
+        )
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def create_search_index(apps, schema_editor):
+    db = schema_editor.connection
+    db.__dict__.pop("_product_search_tables", None)
+    if db.vendor == "postgresql":
+        schema_editor.execute(
+            "ALTER TABLE products_product "
+            "ADD COLUMN IF NOT EXISTS search_vector tsvector"
+        )
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS products_product_search_vector_idx "
+            "ON products_product USING GIN (search_vector)"
+        )
+        schema_editor.execute(
+            f"UPDATE products_product SET search_vector = {SEARCH_VECTOR_SQL}"
+        )
+    elif db.vendor == "sqlite" and _sqlite_has_fts5(db):
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS products_product_fts "
+            "USING fts5(name, description)"
+        )
+        schema_editor.execute(
+            "INSERT INTO products_product_fts (rowid, name, description) "
+            "SELECT id, name, description FROM products_product"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    db = schema_editor.connection
+    db.__dict__.pop("_product_search_tables", None)
+    if db.vendor == "postgresql":
+        schema_editor.execute(
+            "ALTER TABLE products_product DROP COLUMN IF EXISTS search_vector"
+        )
+    elif db.vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS products_product_fts")
+
+
+def _sqlite_has_fts5(db):
+    with db.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        options = [row[0] for row in cursor.fetchall()]
+    return "ENABLE_FTS5" in options
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_auto_20260113_0930'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_auto_20261018_1909'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -1,10 +1,22 @@
 from django.db import models
+from django.db.models.functions import Lower
+
+
+class CatalogueVersion(models.Model):
+    """
+    The catalogue's version, bumped whenever a product or category changes.
+
+    There's a single row. It's kept in the database rather than the cache,
+    so it's shared by every dyno and can never be culled.
+    """
+
+    version = models.PositiveBigIntegerField(default=1)
 
 
 class Category(models.Model):
     """A category of products."""
 
-    name = models.CharField(max_length=254)
+    name = models.CharField(max_length=254, db_index=True)
     friendly_name = models.CharField(max_length=254, null=True, blank=True)
 
     def __str__(self):
@@ -23,7 +35,9 @@ class Product(models.Model):
     category = models.ForeignKey(
         "Category", null=True, blank=True, on_delete=models.SET_NULL
     )
-    sku = models.CharField(max_length=254, null=True, blank=True)
+    sku = models.CharField(
+        max_length=254, null=True, blank=True, db_index=True
+    )
     name = models.CharField(max_length=254)
     description = models.TextField()
     has_sizes = models.BooleanField(default=False, blank=True, null=True)
@@ -33,6 +47,14 @@ class Product(models.Model):
     )
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    # Widths of the image's resized variants, see products.images
+    image_variants = models.JSONField(default=list, blank=True, editable=False)
 
     def __str__(self):
         return self.name
+
+    class Meta:
+        indexes = [
+            # For sorting and paginating the products page by name
+            models.Index(Lower("name"), "id", name="product_lower_name_idx"),
+        ]
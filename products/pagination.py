@@ -0,0 +1,160 @@
+import base64
+import binascii
+import json
+import math
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+
+# Map each sort option on the products page to the field it orders by.
+# Searches are sorted by relevance unless the user picks another option.
+SORT_FIELDS = {
+    "price": "price",
+    "rating": "rating",
+    "name": "lower_name",
+    "category": "category__name",
+    "relevance": "search_rank",
+}
+# Only these sort fields can be null, so only they need a nulls modifier to
+# sort nulls the same way on every database. Only the name sort is indexed
+# (product_lower_name_idx); the others are sorted in memory, which is cheap
+# enough at this catalogue's size.
+NULLABLE_SORT_FIELDS = {"rating", "category__name"}
+
+
+def keyset_page(products, sort, direction, page_size, after=None, before=None):
+    """
+    Return one page of a product listing, using keyset (seek) pagination.
+
+    Products are ordered by their sort field, then by primary key so the order
+    is stable. A page starts right after the "after" cursor, or ends right
+    before the "before" cursor, so a deep page costs the same as the first.
+
+    Return (dict): The page's product IDs, plus cursors for the next and
+    previous pages (None if there isn't one).
+    """
+    field = SORT_FIELDS.get(sort)
+    descending = direction == "desc"
+    cursor = _typed_cursor(products, field, decode_cursor(after or before))
+    backwards = cursor is not None and not after
+    if cursor is not None:
+        products = products.filter(
+            _after_cursor(field, cursor, descending != backwards)
+        )
+    products = products.order_by(
+        *_ordering(field, descending != backwards)
+    )
+    fields = ["pk", field] if field else ["pk"]
+    rows = list(products.values_list(*fields)[: page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    page = {
+        "product_ids": [row[0] for row in rows],
+        "next_cursor": None,
+        "previous_cursor": None,
+    }
+    if rows and (has_more or backwards):
+        page["next_cursor"] = encode_cursor(rows[-1], field)
+    if rows and cursor is not None and (has_more or not backwards):
+        page["previous_cursor"] = encode_cursor(rows[0], field)
+    return page
+
+
+def encode_cursor(row, field):
+    """Return a URL-safe cursor for a (pk, sort value) row."""
+    value = row[1] if field else None
+    if value is not None:
+        value = str(value)
+    data = json.dumps([value, row[0]]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Return the (sort value, pk) pair stored in a cursor.
+
+    Return None if there's no cursor, or if it isn't valid.
+    """
+    if not cursor:
+        return None
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, TypeError, ValueError):
+        return None
+    if not isinstance(pk, int):
+        return None
+    if value is not None and not isinstance(value, str):
+        return None
+    return value, pk
+
+
+def _typed_cursor(products, field, cursor):
+    """
+    Return a cursor with its sort value converted to the sort field's type.
+
+    Return None if there's no cursor, or if its value isn't valid for the
+    field, as with a cursor from a listing sorted another way.
+    """
+    if cursor is None:
+        return None
+    value, pk = cursor
+    if value is None:
+        # Only the unsorted listing and nullable fields have no sort value
+        if field and field not in NULLABLE_SORT_FIELDS:
+            return None
+        return cursor
+    if not field:
+        return None
+    output_field = products.all().query.resolve_ref(field).output_field
+    try:
+        value = output_field.to_python(value)
+    except ValidationError:
+        return None
+    if isinstance(value, (Decimal, float)) and not math.isfinite(value):
+        return None
+    return value, pk
+
+
+def _ordering(field, descending):
+    """
+    Return the order_by() arguments for a listing.
+
+    Nulls sort first in ascending order and last in descending order, on every
+    database, so cursors compare the same way everywhere.
+    """
+    ordering = []
+    if field in NULLABLE_SORT_FIELDS:
+        if descending:
+            ordering.append(F(field).desc(nulls_last=True))
+        else:
+            ordering.append(F(field).asc(nulls_first=True))
+    elif field:
+        ordering.append(F(field).desc() if descending else F(field).asc())
+    ordering.append("-pk" if descending else "pk")
+    return ordering
+
+
+def _after_cursor(field, cursor, descending):
+    """Return a filter for the rows that come after a cursor."""
+    value, pk = cursor
+    pk_after = Q(pk__lt=pk) if descending else Q(pk__gt=pk)
+    if not field:
+        return pk_after
+    if field not in NULLABLE_SORT_FIELDS:
+        is_equal = Q(**{field: value})
+        lookup = "lt" if descending else "gt"
+        return Q(**{f"{field}__{lookup}": value}) | (is_equal & pk_after)
+    is_null = Q(**{f"{field}__isnull": True})
+    if value is None:
+        if descending:
+            return is_null & pk_after
+        return (is_null & pk_after) | ~is_null
+    is_equal = Q(**{field: value})
+    if descending:
+        value_after = Q(**{f"{field}__lt": value}) | is_null
+    else:
+        value_after = Q(**{f"{field}__gt": value})
+    return value_after | (is_equal & pk_after)
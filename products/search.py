@@ -0,0 +1,157 @@
+"""
+Full-text product search.
+
+On Postgres, products are indexed in a weighted tsvector column with a GIN
+index. On SQLite, they're indexed in an FTS5 virtual table. Other databases,
+or SQLite builds without FTS5, fall back to case-insensitive scans.
+
+The index is kept up to date by products.signals and can be rebuilt with the
+rebuild_search_index management command.
+"""
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import BooleanField, Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "products_product_fts"
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def search_backend(using=None):
+    """Return the name of the search backend for the database connection."""
+    db = connections[using or DEFAULT_DB_ALIAS]
+    if db.vendor == "postgresql":
+        return "postgresql"
+    if db.vendor == "sqlite" and FTS_TABLE in _table_names(db):
+        return "sqlite"
+    return "fallback"
+
+
+def search_products(products, search_term):
+    """
+    Return the products that match a search, annotated with a search_rank.
+
+    Higher search_rank values are better matches.
+    """
+    backend = search_backend(products.db)
+    if backend == "postgresql":
+        query = "plainto_tsquery('english', %s)"
+        return products.annotate(
+            search_match=RawSQL(
+                f"products_product.search_vector @@ {query}",
+                [search_term],
+                output_field=BooleanField(),
+            ),
+            search_rank=RawSQL(
+                f"ts_rank(products_product.search_vector, {query})",
+                [search_term],
+                output_field=FloatField(),
+            ),
+        ).filter(search_match=True)
+    if backend == "sqlite":
+        fts_query = _fts5_query(search_term)
+        if not fts_query:
+            return products.annotate(
+                search_rank=Value(0.0, output_field=FloatField())
+            ).none()
+        # Join the index once, so the search runs a single time rather than
+        # once for every product
+        return products.extra(
+            tables=[FTS_TABLE],
+            where=[
+                f"{FTS_TABLE}.rowid = products_product.id",
+                f"{FTS_TABLE} MATCH %s",
+            ],
+            params=[fts_query],
+        ).annotate(
+            search_rank=RawSQL(
+                f"-bm25({FTS_TABLE}, 10.0, 1.0)", [], output_field=FloatField()
+            )
+        )
+    return products.filter(
+        Q(name__icontains=search_term) | Q(description__icontains=search_term)
+    ).annotate(
+        search_rank=Case(
+            When(name__icontains=search_term, then=Value(2.0)),
+            default=Value(1.0),
+            output_field=FloatField(),
+        )
+    )
+
+
+def index_product(product):
+    """Add or update a product in the search index."""
+    backend = search_backend()
+    with connection.cursor() as cursor:
+        if backend == "postgresql":
+            cursor.execute(
+                f"UPDATE products_product SET search_vector = "
+                f"{SEARCH_VECTOR_SQL} WHERE id = %s",
+                [product.pk],
+            )
+        elif backend == "sqlite":
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product.pk]
+            )
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+                f"VALUES (%s, %s, %s)",
+                [product.pk, product.name, product.description],
+            )
+
+
+def unindex_product(product):
+    """Remove a product from the search index."""
+    if search_backend() == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product.pk]
+            )
+
+
+def rebuild_index():
+    """
+    Rebuild the search index for every product.
+
+    Return (int): The number of products indexed.
+    """
+    backend = search_backend()
+    with connection.cursor() as cursor:
+        if backend == "postgresql":
+            cursor.execute(
+                f"UPDATE products_product SET search_vector = "
+                f"{SEARCH_VECTOR_SQL}"
+            )
+            return cursor.rowcount
+        if backend == "sqlite":
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description) "
+                f"SELECT id, name, description FROM products_product"
+            )
+            return cursor.rowcount
+    return 0
+
+
+def _fts5_query(search_term):
+    """
+    Return an FTS5 query that matches every word in the search term.
+
+    Each word is quoted, so FTS5 operators in the search are treated as plain
+    text, and matches as a prefix.
+    """
+    words = search_term.split()
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in words)
+
+
+def _table_names(db):
+    """Return the table names for a connection, cached on the connection."""
+    table_names = getattr(db, "_product_search_tables", None)
+    if table_names is None:
+        table_names = set(db.introspection.table_names())
+        db._product_search_tables = table_names
+    return table_names
+
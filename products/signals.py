@@ -0,0 +1,65 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from .catalogue import bump_catalogue_version
+from .images import update_product_variants
+from .models import Category, Product
+from .search import index_product, unindex_product
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def update_catalogue_version(sender, instance, **kwargs):
+    """
+    Invalidate cached listings and product snapshots on catalogue changes.
+
+    The version is bumped once the change is committed, so no worker can
+    cache the old data under the new version.
+    """
+    transaction.on_commit(bump_catalogue_version)
+
+
+@receiver(post_save, sender=Product)
+def update_search_index_on_save(sender, instance, **kwargs):
+    """Update the search index when a product is created/updated."""
+    index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def update_search_index_on_delete(sender, instance, **kwargs):
+    """Remove a product from the search index when it's deleted."""
+    unindex_product(instance)
+
+
+@receiver(pre_save, sender=Product)
+def remember_saved_image(sender, instance, raw=False, **kwargs):
+    """Remember a product's saved image and variants, before it's updated."""
+    saved = None
+    if instance.pk and not raw:
+        saved = (
+            sender.objects.filter(pk=instance.pk)
+            .values_list("image", "image_variants")
+            .first()
+        )
+    instance._saved_image = saved or ("", [])
+
+
+@receiver(post_save, sender=Product)
+def update_image_variants(sender, instance, raw=False, **kwargs):
+    """
+    Create the variants of a product's new image.
+
+    The variants are created once the change is committed, so a rolled back
+    save doesn't leave them behind or delete the old image's variants.
+    """
+    old_name, old_widths = getattr(instance, "_saved_image", ("", []))
+    if raw or (instance.image.name or "") == (old_name or ""):
+        return
+    transaction.on_commit(
+        partial(update_product_variants, instance, old_name, old_widths)
+    )
@@ -0,0 +1,197 @@
+"""
+A per-worker cache of product snapshots, for showing products in the bag.
+
+The bag pages look products up by ID over and over. Each worker process
+keeps read-only snapshots of the products it's recently shown in a bounded
+LRU cache, tagged with the catalogue version they were read at. When any
+product or category is saved on any worker, each worker drops its whole
+cache once it sees the new version, within CATALOGUE_VERSION_TTL seconds. A
+snapshot also expires after PRODUCT_SNAPSHOT_TTL seconds, in case a product
+changes without its signals being sent, as with a bulk update.
+
+Snapshots may be a moment out of date, so they're only for display. Anything
+that charges the customer prices the bag from the products in the database.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .catalogue import catalogue_version
+from .models import Product
+
+
+@dataclass(frozen=True)
+class ImageSnapshot:
+    """A product image, by its name in the image field's storage."""
+
+    name: str
+
+    def __bool__(self):
+        return bool(self.name)
+
+    @property
+    def storage(self):
+        return Product._meta.get_field("image").storage
+
+    @property
+    def url(self):
+        return self.storage.url(self.name)
+
+
+@dataclass(frozen=True)
+class CategorySnapshot:
+    """The fields of a product's category."""
+
+    name: str
+    friendly_name: str | None
+
+    def get_friendly_name(self):
+        return self.friendly_name
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class ProductSnapshot:
+    """The fields of a product that the bag shows."""
+
+    id: int
+    name: str
+    sku: str | None
+    price: Decimal
+    has_sizes: bool
+    category: CategorySnapshot | None
+    image: ImageSnapshot
+    image_variants: tuple
+
+    @property
+    def pk(self):
+        return self.id
+
+    @classmethod
+    def from_product(cls, product):
+        category = None
+        if product.category is not None:
+            category = CategorySnapshot(
+                product.category.name, product.category.friendly_name
+            )
+        return cls(
+            id=product.pk,
+            name=product.name,
+            sku=product.sku,
+            price=product.price,
+            has_sizes=product.has_sizes,
+            category=category,
+            image=ImageSnapshot(product.image.name or ""),
+            image_variants=tuple(product.image_variants),
+        )
+
+    def __str__(self):
+        return self.name
+
+
+class ProductSnapshotCache:
+    """A thread-safe LRU cache of product snapshots."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        # {pk: (snapshot, expiry time)}
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, product_ids):
+        """
+        Return a dict of {pk: snapshot} for the given IDs.
+
+        Products that aren't cached, or whose snapshots have expired, are
+        fetched in a single query. IDs of products that don't exist are left
+        out.
+        """
+        version = catalogue_version()
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            if version != self.version:
+                self._snapshots.clear()
+                self.version = version
+            for pk in product_ids:
+                snapshot, expires = self._snapshots.get(pk, (None, 0))
+                if expires > now:
+                    self._snapshots.move_to_end(pk)
+                    found[pk] = snapshot
+        missing = [pk for pk in product_ids if pk not in found]
+        if missing:
+            # Always read from the primary, so a lagging replica can't
+            # leave stale products in the cache for the new version
+            products = (
+                Product.objects.using(DEFAULT_DB_ALIAS)
+                .select_related("category")
+                .in_bulk(missing)
+            )
+            fetched = {
+                pk: ProductSnapshot.from_product(product)
+                for pk, product in products.items()
+            }
+            found.update(fetched)
+            self._add(version, now + self.ttl, fetched)
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+            self.version = None
+
+    def _add(self, version, expires, snapshots):
+        """Cache snapshots read at a catalogue version."""
+        with self._lock:
+            if version != self.version:
+                return
+            for pk, snapshot in snapshots.items():
+                self._snapshots[pk] = (snapshot, expires)
+                self._snapshots.move_to_end(pk)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+
+def product_snapshots(product_ids):
+    """
+    Return a dict of {pk: snapshot} for the given product IDs.
+
+    IDs that aren't integers, and IDs of products that don't exist, are left
+    out.
+    """
+    pks = {int(pk) for pk in product_ids if str(pk).isdigit()}
+    if not pks:
+        return {}
+    return _cache.get_many(pks)
+
+
+def product_snapshot(product_id):
+    """
+    Return a snapshot of the product with the given ID.
+
+    Raise Product.DoesNotExist if there's no such product.
+    """
+    snapshots = product_snapshots([product_id])
+    if not snapshots:
+        raise Product.DoesNotExist("Product matching query does not exist.")
+    return next(iter(snapshots.values()))
+
+
+def clear_snapshots():
+    """Empty this worker's product snapshot cache."""
+    _cache.clear()
+
+
+_cache = ProductSnapshotCache(
+    settings.PRODUCT_SNAPSHOT_CACHE_SIZE, settings.PRODUCT_SNAPSHOT_TTL
+)
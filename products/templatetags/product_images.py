@@ -0,0 +1,63 @@
+from django import template
+from django.conf import settings
+from django.utils.html import format_html
+
+from products.images import WEBP, srcset, variant_name
+
+register = template.Library()
+
+
+@register.simple_tag
+def product_image(product, sizes, css_class=""):
+    """
+    Return a product's image as a <picture>, with WebP and resized variants.
+
+    sizes is the <img> sizes attribute, describing how wide the image is
+    displayed, so the browser can pick the smallest variant that will do.
+    """
+    image = product.image
+    if not image:
+        return format_html(
+            '<img class="{}" src="{}noimage.png" alt="{}">',
+            css_class,
+            settings.MEDIA_URL,
+            product.name,
+        )
+    widths = product.image_variants
+    if not widths:
+        return format_html(
+            '<img class="{}" src="{}" alt="{}" loading="lazy">',
+            css_class,
+            image.url,
+            product.name,
+        )
+    return format_html(
+        "<picture>"
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img class="{}" src="{}" srcset="{}" sizes="{}" alt="{}"'
+        ' loading="lazy">'
+        "</picture>",
+        srcset(image, widths, WEBP),
+        sizes,
+        css_class,
+        image.url,
+        srcset(image, widths),
+        sizes,
+        product.name,
+    )
+
+
+@register.simple_tag
+def product_image_url(product, width):
+    """
+    Return the URL of a product image's smallest variant at least width wide.
+
+    Return the original image's URL if there's no such variant.
+    """
+    image = product.image
+    for variant_width in sorted(product.image_variants):
+        if variant_width >= width:
+            return image.storage.url(
+                variant_name(image.name, variant_width)
+            )
+    return image.url
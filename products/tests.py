@@ -1,3 +1,182 @@
-from django.test import TestCase
+import base64
+import dataclasses
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from .catalogue import bump_catalogue_version
+from .images import variant_name
+from .models import Category, Product
+from .snapshots import ProductSnapshotCache
+
+
+def uploaded_image(name, width=800, height=600):
+    """Return an uploaded JPEG of the given size."""
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), "teal").save(buffer, format="JPEG")
+    return SimpleUploadedFile(name, buffer.getvalue(), "image/jpeg")
+
+
+@override_settings(PRODUCT_IMAGE_WIDTHS=(300, 600, 1200))
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def create_product(self, **fields):
+        return Product.objects.create(
+            name="Linen Shirt",
+            description="A shirt.",
+            price=Decimal("20.00"),
+            **fields,
+        )
+
+    def test_creates_variants_for_a_new_product_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            product = self.create_product(image=uploaded_image("shirt.jpg"))
+            self.assertEqual(product.image_variants, [])
+
+        for callback in callbacks:
+            callback()
+        product.refresh_from_db()
+        self.assertEqual(product.image_variants, [300, 600, 800])
+        for width in product.image_variants:
+            for extension in (None, "webp"):
+                self.assertTrue(
+                    default_storage.exists(
+                        variant_name(product.image.name, width, extension)
+                    )
+                )
+
+    def test_replaces_the_variants_of_a_changed_image(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.create_product(image=uploaded_image("old.jpg"))
+        old_name = product.image.name
+
+        product = Product.objects.get(pk=product.pk)
+        product.image = uploaded_image("new.jpg", width=400)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.save()
+
+        product.refresh_from_db()
+        self.assertEqual(product.image_variants, [300, 400])
+        self.assertFalse(default_storage.exists(variant_name(old_name, 300)))
+
+    def test_does_not_recreate_variants_when_the_image_is_unchanged(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.create_product(image=uploaded_image("shirt.jpg"))
+
+        product = Product.objects.get(pk=product.pk)
+        product.name = "Cotton Shirt"
+        with self.captureOnCommitCallbacks() as callbacks:
+            product.save()
+
+        self.assertEqual(len(callbacks), 1)  # Only the catalogue version
+
+    def test_does_nothing_for_a_product_without_an_image(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.create_product()
+
+        self.assertEqual(len(callbacks), 1)  # Only the catalogue version
+
+
+class ProductSnapshotTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(
+            name="Linen Shirt", description="A shirt.", price=Decimal("20.00")
+        )
+        self.cache = ProductSnapshotCache(max_size=10, ttl=60)
+
+    def snapshot(self):
+        return self.cache.get_many([self.product.pk])[self.product.pk]
+
+    def test_snapshots_are_read_only(self):
+        snapshot = self.snapshot()
+
+        self.assertEqual(snapshot.price, Decimal("20.00"))
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            snapshot.price = Decimal("1.00")
+
+    def test_snapshots_include_the_category(self):
+        category = Category.objects.create(
+            name="shirts", friendly_name="Shirts"
+        )
+        Product.objects.filter(pk=self.product.pk).update(category=category)
+
+        snapshot = self.snapshot()
+
+        self.assertEqual(str(snapshot.category), "shirts")
+        self.assertEqual(snapshot.category.get_friendly_name(), "Shirts")
+
+    def test_reuses_a_snapshot_within_its_ttl(self):
+        self.snapshot()
+        Product.objects.filter(pk=self.product.pk).update(price=30)
+
+        self.assertEqual(self.snapshot().price, Decimal("20.00"))
+
+    def test_rereads_a_product_once_its_snapshot_expires(self):
+        self.snapshot()
+        Product.objects.filter(pk=self.product.pk).update(price=30)
+
+        with mock.patch("time.monotonic", return_value=10**9):
+            self.assertEqual(self.snapshot().price, 30)
+
+    def test_rereads_every_product_when_the_catalogue_changes(self):
+        self.snapshot()
+        Product.objects.filter(pk=self.product.pk).update(price=30)
+
+        bump_catalogue_version()
+
+        self.assertEqual(self.snapshot().price, 30)
+
+
+class ProductPaginationTests(TestCase):
+    def setUp(self):
+        for number in range(3):
+            Product.objects.create(
+                name=f"Linen Shirt {number}",
+                description="A linen shirt.",
+                price=Decimal("20.00") + number,
+                rating=Decimal("4.00"),
+            )
+
+    def cursor(self, value, pk):
+        data = json.dumps([value, pk]).encode("utf-8")
+        return base64.urlsafe_b64encode(data).decode("ascii")
+
+    def test_a_cursor_for_another_sort_shows_the_first_page(self):
+        cursor = self.cursor("abc", 5)
+        for params in (
+            {"sort": "price", "direction": "asc", "after": cursor},
+            {"sort": "rating", "before": cursor},
+            {"q": "linen", "after": cursor},
+        ):
+            with self.subTest(**params):
+                response = self.client.get(reverse("products"), params)
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.context["products"]), 3)
+                self.assertIsNone(response.context["previous_page_url"])
+
+    def test_a_valid_cursor_shows_the_next_page(self):
+        first = Product.objects.order_by("price").first()
+        cursor = self.cursor(str(first.price), first.pk)
+
+        response = self.client.get(
+            reverse("products"), {"sort": "price", "after": cursor}
+        )
+
+        self.assertEqual(len(response.context["products"]), 2)
+        self.assertNotIn(first, response.context["products"])
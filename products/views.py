@@ -1,10 +1,13 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
 from django.db.models.functions import Lower
 from django.shortcuts import get_object_or_404, redirect, render, reverse
+from .catalogue import cached_listing, catalogue_version
 from .forms import ProductForm
 from .models import Category, Product
+from .pagination import SORT_FIELDS, decode_cursor, keyset_page
+from .search import search_products
 
 
 def all_products(request):
@@ -12,10 +15,12 @@ def all_products(request):
     Show the products page.
 
     Show all products by default.
-    If the user submitted a search, only show matching products. If the search
-    term is blank, show an error message.
+    If the user submitted a search, only show matching products, best matches
+    first. If the search term is blank, show an error message.
     If the user selected a sort option, show sorted products.
     If the user selected categories, show matching products.
+    Products are shown one page at a time. Each page's product IDs, and the
+    listing's total count, are cached until the catalogue changes.
     """
     context = _default_context_for_all_products()
     if request.GET:
@@ -30,9 +35,94 @@ def all_products(request):
             _update_context_for_sort(request, context)
         if "category" in request.GET:
             _update_context_for_category_filter(request, context)
+    _update_context_for_page(request, context)
     return render(request, "products/products.html", context)
 
 
+def _update_context_for_page(request, context):
+    """
+    Update the context to show a single page of products.
+
+    Only the first page of a listing is cached. Later pages are found from
+    a cursor, which is cheap with keyset pagination, and caching them would
+    let any client fill the cache with made-up cursors.
+    """
+    products = context["products"]
+    query = _listing_query(request, context)
+    version = catalogue_version()
+    context["product_total"] = cached_listing(
+        {**query, "count": True}, products.count, version
+    )
+    after = _valid_cursor(request.GET.get("after"))
+    before = _valid_cursor(request.GET.get("before"))
+
+    def compute_page():
+        return keyset_page(
+            products,
+            query["sort"],
+            query["direction"],
+            settings.PRODUCTS_PER_PAGE,
+            after=after,
+            before=before,
+        )
+
+    if after or before:
+        page = compute_page()
+    else:
+        page = cached_listing(query, compute_page, version)
+    context["products"] = _products_in_order(page["product_ids"])
+    context["next_page_url"] = _page_url(request, "after", page["next_cursor"])
+    context["previous_page_url"] = _page_url(
+        request, "before", page["previous_cursor"]
+    )
+
+
+def _valid_cursor(cursor):
+    """Return a page cursor, or None if it isn't valid."""
+    if decode_cursor(cursor) is None:
+        return None
+    return cursor
+
+
+def _page_url(request, cursor_name, cursor):
+    """Return the URL for another page of the current listing."""
+    if not cursor:
+        return None
+    params = request.GET.copy()
+    params.pop("after", None)
+    params.pop("before", None)
+    params[cursor_name] = cursor
+    return f"{reverse('products')}?{params.urlencode()}"
+
+
+def _listing_query(request, context):
+    """Return the normalized listing parameters for the products page."""
+    search_term = context["search_term"]
+    sort = request.GET.get("sort")
+    direction = "desc" if request.GET.get("direction") == "desc" else "asc"
+    if sort not in SORT_FIELDS or (sort == "relevance" and not search_term):
+        # Relevance only means something for a search
+        sort = None
+    if not sort and search_term:
+        sort, direction = "relevance", "desc"
+    query = {
+        "q": (search_term or "").lower(),
+        "sort": sort,
+        "direction": direction if sort else None,
+    }
+    if "category" in request.GET:
+        category_names = set(request.GET["category"].split(","))
+        query["category"] = ",".join(sorted(category_names))
+    return query
+
+
+def _products_in_order(product_ids):
+    """Return a list of products, ordered as in product_ids."""
+    products = Product.objects.select_related("category")
+    products = products.in_bulk(product_ids)
+    return [products[pk] for pk in product_ids if pk in products]
+
+
 def _update_context_for_category_filter(request, context):
     """Update the context to filter products by category."""
     category_names = request.GET["category"].split(",")
@@ -45,19 +135,16 @@ def _update_context_for_category_filter(request, context):
 
 
 def _update_context_for_sort(request, context):
-    """Update the context to sort products."""
+    """
+    Update the context to sort products.
+
+    The products are ordered when the page is selected, in keyset_page().
+    """
     products = context["products"]
     sort = request.GET["sort"]
     direction = request.GET.get("direction")
-    sortkey = sort
     if sort == "name":
         products = products.annotate(lower_name=Lower("name"))
-        sortkey = "lower_name"
-    elif sort == "category":
-        sortkey = "category__name"
-    if direction == "desc":
-        sortkey = f"-{sortkey}"
-    products = products.order_by(sortkey)
     context["products"] = products
     context["current_sorting"] = f"{sort}_{direction}"
 
@@ -80,9 +167,7 @@ def _default_context_for_all_products():
 def _update_context_for_search(search_term, context):
     """Update the context to filter products for a search."""
     context["search_term"] = search_term
-    context["products"] = context["products"].filter(
-        Q(name__icontains=search_term) | Q(description__icontains=search_term)
-    )
+    context["products"] = search_products(context["products"], search_term)
 
 
 def product_detail(request, product_id):
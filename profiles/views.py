@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.core.paginator import Paginator
 from django.shortcuts import get_object_or_404, render
 
 from .models import UserProfile
@@ -24,10 +26,15 @@ def profile(request):
             )
     else:
         form = UserProfileForm(instance=profile)
-    orders = profile.orders.all()
+    orders = profile.orders.prefetch_related("lineitems__product").order_by(
+        "-date"
+    )
+    paginator = Paginator(orders, settings.ORDERS_PER_PAGE)
+    page = paginator.get_page(request.GET.get("page"))
     context = {
         "form": form,
-        "orders": orders,
+        "orders": page.object_list,
+        "orders_page": page,
         "on_profile_page": True,
     }
     return render(request, template, context)
@@ -35,7 +42,10 @@ def profile(request):
 
 def order_history(request, order_number):
     """Display the order history template."""
-    order = get_object_or_404(Order, order_number=order_number)
+    order = get_object_or_404(
+        Order.objects.prefetch_related("lineitems__product"),
+        order_number=order_number,
+    )
     messages.info(
         request,
         (